@@ -1,20 +1,50 @@
 """
 建物ポリゴン × 斜面危険度 による家屋リスク抽出パイプライン
 - Step1: 建物ポリゴン → バイナリラスタ
-- Step2: DEM → 傾斜角（degree）
+- Step2: DEM → 傾斜角（degree）（任意で斜面方位・曲率・TPI などの地形量もまとめて出力）
 - Step3: 傾斜角 → 2値化ラスタ
-- Step4: 建物 × 危険斜面 → ハイリスク家屋ゾーン
+- Step4: 建物 × 危険斜面 → ハイリスク家屋ゾーン（任意で土地被覆による重み付けスコア）
+- Step5: 建物ごとのリスク属性 → GeoPackage（任意）
+
+options.incremental を有効にすると、建物レイヤの変更分だけ Step1・Step4 を再計算して
+既存の出力 GeoTIFF を書き換える。
 """
 
-from dataclasses import dataclass
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass, field, replace
+from functools import cache
 from pathlib import Path
+import math
 import geopandas as gpd
 import numpy as np
 import rasterio
 from rasterio import features
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
 from scipy.ndimage import distance_transform_edt
+import shapely
 import yaml
 
+from building_diff import building_state, diff_buildings, load_state, save_state
+from instrumentation import (
+    InstrumentationConfig,
+    instrumentation_from_dict,
+    instrumented_run,
+    qc_enabled,
+    record_read,
+    record_write,
+    step,
+    value_counts_u8,
+)
+from raster_io import (
+    RasterWriteOptions,
+    open_raster,
+    update_raster,
+    write_options_from_dict,
+    write_raster,
+)
+from step_cache import StepCache
+
 
 # ============================
 # dataclass による設定管理
@@ -38,6 +68,23 @@ class IOConfig:
 
     # Step4: 建物 × 危険斜面 → リスクラスタ
     bld_risk_tif: Path
+    # {risk_radius_m} を含むテンプレート（複数半径の出力先に使う）
+    bld_risk_tif_template: str = ""
+    # 複数半径を1ファイルの複数バンドにまとめるか（False なら半径ごとに1ファイル）
+    bld_risk_multiband: bool = False
+
+    # Step5: 建物ごとのリスク属性（None なら出力しない）
+    bld_risk_gpkg: Path | None = None
+
+
+SLOPE_DTYPES = ("float64", "float32")
+DISTANCE_ENGINES = ("bounded", "edt")
+
+
+def radius_label(r: float) -> str:
+    """ファイル名・バンド名・属性名に使う半径の表記（10.0 → "10", 12.5 → "12.5"）"""
+
+    return f"{r:g}"
 
 
 @dataclass
@@ -46,6 +93,81 @@ class Params:
 
     slope_threshold: float  # 斜面の危険閾値（度）
     risk_radius_m: float    # 危険斜面からの距離閾値（m）
+    # 複数の距離閾値を一度に評価する場合のリスト（未指定なら [risk_radius_m]）
+    risk_radii_m: list[float] = field(default_factory=list)
+    # Step4・5 の距離計算: "bounded"（半径内だけ探索）or "edt"（全画像の距離変換）
+    # bounded では Step5 の min_distance_to_steep_slope_m が最大半径より遠いと NaN になる
+    distance_engine: str = "bounded"
+    block_size: int | None = None  # Step1・2 をブロック単位で処理する場合のサイズ（px, 16の倍数）
+    # Step2 の計算精度: "float64"（従来どおり）or "float32"（バッファを使い回してメモリと時間を節約）
+    slope_dtype: str = "float64"
+
+    def __post_init__(self) -> None:
+        if not self.risk_radii_m:
+            self.risk_radii_m = [self.risk_radius_m]
+        labels = [radius_label(r) for r in self.risk_radii_m]
+        if len(set(labels)) != len(labels):
+            # 出力ファイル名・バンド名・属性名が重なる
+            raise ValueError(f"risk_radii_m must be distinct: {self.risk_radii_m}")
+        if self.slope_dtype not in SLOPE_DTYPES:
+            raise ValueError(f"slope_dtype must be one of {SLOPE_DTYPES}: {self.slope_dtype}")
+        if self.distance_engine not in DISTANCE_ENGINES:
+            raise ValueError(f"distance_engine must be one of {DISTANCE_ENGINES}: {self.distance_engine}")
+
+
+@dataclass
+class RunOptions:
+    """実行時オプション"""
+
+    # 中間ラスタ（建物・傾斜角・2値化）を GeoTIFF に書き出すか
+    # False の場合、Step1〜4 は配列をメモリ上で受け渡す
+    persist_intermediates: bool = False
+
+    # 建物レイヤの変更分だけ再計算し、既存の出力を書き換える（前回の状態がなければ全体を計算）
+    incremental: bool = False
+    # 前回実行時の建物の状態（None なら最初のリスク出力の隣に *.buildings.json）
+    incremental_state: Path | None = None
+
+
+@dataclass
+class CacheConfig:
+    """ステップ単位キャッシュの設定"""
+
+    enabled: bool = False
+    cache_dir: Path = Path(".cache/slope_risk")
+    max_gb: float = 2.0        # キャッシュ合計サイズの上限（超えたら LRU で削除）
+    key_mode: str = "mtime"    # "mtime"（サイズ+更新時刻） or "hash"（内容ハッシュ）
+
+
+@dataclass
+class LandCoverConfig:
+    """土地被覆（ALOS）による重み付けの設定"""
+
+    enabled: bool = False
+    landcover_tif: Path | None = None  # DEM グリッドに揃えた土地被覆（alos_on_dem.py の出力）
+    # {risk_radius_m} を含むリスクスコア（float32）の出力テンプレート
+    score_tif_template: str = ""
+    weights: dict[int, float] = field(default_factory=dict)  # クラスコード → 崩壊しやすさの係数
+    default_weight: float = 1.0  # weights にないクラスの係数（NoData は常に 0）
+
+
+TERRAIN_DERIVATIVES = ("slope", "aspect", "curvature", "plan_curvature", "profile_curvature", "tpi", "elevation")
+
+
+@dataclass
+class TerrainConfig:
+    """地形量（傾斜角・斜面方位・曲率・TPI など）の出力設定"""
+
+    derivatives: list[str] = field(default_factory=list)  # TERRAIN_DERIVATIVES から選ぶ（空なら出力しない）
+    # {derivative} を含めば地形量ごとに1ファイル、含まなければ1ファイルの複数バンド（float32）
+    out_tif: str = ""
+
+    def __post_init__(self) -> None:
+        unknown = [d for d in self.derivatives if d not in TERRAIN_DERIVATIVES]
+        if unknown:
+            raise ValueError(f"unknown terrain derivatives {unknown} (choose from {TERRAIN_DERIVATIVES})")
+        if self.derivatives and not self.out_tif:
+            raise ValueError("terrain.out_tif is required when terrain.derivatives is set")
 
 
 @dataclass
@@ -54,21 +176,39 @@ class Config:
 
     io: IOConfig
     params: Params
+    options: RunOptions = field(default_factory=RunOptions)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    output: RasterWriteOptions = field(default_factory=RasterWriteOptions)
+    landcover: LandCoverConfig = field(default_factory=LandCoverConfig)
+    instrumentation: InstrumentationConfig = field(default_factory=InstrumentationConfig)
+    terrain: TerrainConfig = field(default_factory=TerrainConfig)
 
 
 # ============================
 # デフォルト設定（直接実行用）
 # ============================
 
+def params_from_dict(d: dict) -> Params:
+    """YAML の params セクションから Params を作る"""
+
+    radii = [float(r) for r in d.get("risk_radii_m") or []]
+    risk_radius_m = float(d.get("risk_radius_m", radii[0] if radii else 0.0))
+    return Params(
+        slope_threshold=float(d["slope_threshold"]),
+        risk_radius_m=risk_radius_m,
+        risk_radii_m=radii,
+        distance_engine=str(d.get("distance_engine", "bounded")),
+        block_size=d.get("block_size"),
+        slope_dtype=str(d.get("slope_dtype", "float64")),
+    )
+
+
 def load_config_from_yaml(yaml_path: Path) -> Config:
     with open(yaml_path, "r", encoding="utf-8") as f:
         data = yaml.safe_load(f)
 
     # --- Params の構築 ---
-    params = Params(
-        slope_threshold=float(data["params"]["slope_threshold"]),
-        risk_radius_m=float(data["params"]["risk_radius_m"]),
-    )
+    params = params_from_dict(data["params"])
 
     # --- bld_risk_tif のテンプレート展開 ---
     radius_int = int(params.risk_radius_m)
@@ -86,19 +226,81 @@ def load_config_from_yaml(yaml_path: Path) -> Config:
         slope_deg_tif=Path(data["io"]["slope_deg_tif"]),
         slope_bin_tif=Path(data["io"]["slope_bin_tif"]),
         bld_risk_tif=Path(bld_risk_tif_str),
+        bld_risk_tif_template=data["io"]["bld_risk_tif"],
+        bld_risk_multiband=bool(data["io"].get("bld_risk_multiband", False)),
+        bld_risk_gpkg=(
+            Path(data["io"]["bld_risk_gpkg"].format(risk_radius_m=radius_int))
+            if data["io"].get("bld_risk_gpkg") else None
+        ),
+    )
+
+    # --- RunOptions の構築 ---
+    opt = data.get("options") or {}
+    options = RunOptions(
+        persist_intermediates=bool(opt.get("persist_intermediates", False)),
+        incremental=bool(opt.get("incremental", False)),
+        incremental_state=Path(opt["incremental_state"]) if opt.get("incremental_state") else None,
+    )
+
+    # --- CacheConfig の構築 ---
+    c = data.get("cache") or {}
+    cache_cfg = CacheConfig(
+        enabled=bool(c.get("enabled", False)),
+        cache_dir=Path(c.get("dir", CacheConfig.cache_dir)),
+        max_gb=float(c.get("max_gb", CacheConfig.max_gb)),
+        key_mode=str(c.get("key_mode", CacheConfig.key_mode)),
+    )
+
+    # --- RasterWriteOptions の構築 ---
+    output = write_options_from_dict(data.get("output"))
+
+    # --- LandCoverConfig の構築 ---
+    lc = data.get("landcover") or {}
+    landcover = LandCoverConfig(
+        enabled=bool(lc.get("enabled", False)),
+        landcover_tif=Path(lc["tif"]) if lc.get("tif") else None,
+        score_tif_template=str(lc.get("score_tif", "")),
+        weights={int(k): float(v) for k, v in (lc.get("weights") or {}).items()},
+        default_weight=float(lc.get("default_weight", LandCoverConfig.default_weight)),
+    )
+
+    # --- TerrainConfig の構築 ---
+    t = data.get("terrain") or {}
+    terrain = TerrainConfig(
+        derivatives=[str(d) for d in t.get("derivatives") or []],
+        out_tif=str(t.get("out_tif") or ""),
+    )
+
+    return Config(
+        io=io, params=params, options=options, cache=cache_cfg, output=output, landcover=landcover,
+        instrumentation=instrumentation_from_dict(data.get("instrumentation")),
+        terrain=terrain,
     )
 
-    return Config(io=io, params=params)
 
 # ============================
 # Step1: 建物ポリゴン → バイナリラスタ
 # ============================
 
-def rasterize_buildings(poly_file: Path, ref_raster: Path, out_tif: Path) -> Path:
-    """建物ポリゴンを参照ラスタに合わせてラスタ化する"""
+def load_buildings(
+    poly_file: Path,
+    crs,
+    keep_fid: bool = False,
+    bounds: tuple[float, float, float, float] | None = None,
+) -> gpd.GeoDataFrame:
+    """建物ポリゴンを読み込み、空ジオメトリを除いて crs に揃える
+
+    keep_fid=True なら GeoPackage の fid を index にする（差分更新で建物を識別するため）。
+    bounds（crs の座標）を指定すると、その範囲にかかる建物だけを読み込み・再投影する。
+    """
 
     # ポリゴン読み込み
-    gdf = gpd.read_file(poly_file)
+    bbox = None
+    if bounds is not None:
+        poly_crs = gpd.read_file(poly_file, rows=0).crs
+        bbox = transform_bounds(crs, poly_crs, *bounds, densify_pts=21) if poly_crs != crs else bounds
+    gdf = gpd.read_file(poly_file, fid_as_index=keep_fid, bbox=bbox)
+    record_read(poly_file)
 
     # 空ジオメトリ除外
     gdf = gdf[~gdf.geometry.is_empty]
@@ -106,6 +308,17 @@ def rasterize_buildings(poly_file: Path, ref_raster: Path, out_tif: Path) -> Pat
 
     print("[Step1] polygon feature count:", len(gdf))
 
+    # CRS チェック
+    if gdf.crs != crs:
+        print("[Step1] ⚠ CRS mismatch: reprojecting polygons")
+        gdf = gdf.to_crs(crs)
+
+    return gdf
+
+
+def rasterize_buildings_array(poly_file: Path, ref_raster: Path) -> tuple[np.ndarray, dict]:
+    """建物ポリゴンを参照ラスタに合わせてラスタ化し、配列と出力用 profile を返す"""
+
     # 参照ラスタ情報取得
     with rasterio.open(ref_raster) as src:
         transform = src.transform
@@ -114,10 +327,7 @@ def rasterize_buildings(poly_file: Path, ref_raster: Path, out_tif: Path) -> Pat
         height = src.height
         dtype = rasterio.uint8
 
-    # CRS チェック
-    if gdf.crs != crs:
-        print("[Step1] ⚠ CRS mismatch: reprojecting polygons")
-        gdf = gdf.to_crs(crs)
+    gdf = load_buildings(poly_file, crs)
 
     # ラスタ化
     shapes = ((geom, 1) for geom in gdf.geometry)
@@ -132,14 +342,10 @@ def rasterize_buildings(poly_file: Path, ref_raster: Path, out_tif: Path) -> Pat
     )
 
     # QC
-    vals, counts = np.unique(binary, return_counts=True)
-    print("[Step1] unique values:", list(zip(vals.tolist(), counts.tolist())))
+    if qc_enabled():
+        print("[Step1] unique values:", value_counts_u8(binary, "building_pixels"))
 
-    # GeoTIFF 書き出し
-    out_tif.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(
-        out_tif,
-        "w",
+    profile = dict(
         driver="GTiff",
         height=height,
         width=width,
@@ -148,43 +354,130 @@ def rasterize_buildings(poly_file: Path, ref_raster: Path, out_tif: Path) -> Pat
         crs=crs,
         transform=transform,
         nodata=0,
-        compress="lzw",
-    ) as dst:
-        dst.write(binary, 1)
+    )
+    return binary, profile
+
+
+def rasterize_buildings(
+    poly_file: Path,
+    ref_raster: Path,
+    out_tif: Path,
+    write_opts: RasterWriteOptions | None = None,
+    block_size: int | None = None,
+) -> Path:
+    """建物ポリゴンを参照ラスタに合わせてラスタ化する
+
+    block_size を指定すると、建物のあるブロックだけをラスタ化して書き出す。
+    """
+
+    if block_size:
+        return _rasterize_buildings_blocked(poly_file, ref_raster, out_tif, block_size, write_opts)
+
+    binary, profile = rasterize_buildings_array(poly_file, ref_raster)
+
+    # GeoTIFF 書き出し
+    write_raster(out_tif, binary, profile, options=write_opts, mask=True)
 
     print("[Step1] ✅ exported:", out_tif)
     return out_tif
 
 
-# ============================
-# Step2: DEM → 傾斜角ラスタ
-# ============================
+def _rasterize_buildings_blocked(
+    poly_file: Path,
+    ref_raster: Path,
+    out_tif: Path,
+    block_size: int,
+    write_opts: RasterWriteOptions | None = None,
+) -> Path:
+    """参照ラスタをブロックに分け、建物がかかるブロックだけをラスタ化して書き出す
 
-def compute_slope(dem_tif: Path, out_slope_tif: Path) -> Path:
-    """DEM から Horn 法で傾斜角（degree）を計算する"""
+    ブロックの矩形をまとめて gdf.sindex（STRtree）に問い合わせて (ブロック, 建物) の組を作る。
+    建物のないブロックは書き込まず、疎な GeoTIFF として 0 のまま残す。
+    メモリは建物数とブロックサイズで決まり、参照ラスタの面積には依存しない。
+    結果は一括処理（rasterize_buildings_array）と同一になる。
+    """
 
-    with rasterio.open(dem_tif) as src:
-        dem = src.read(1).astype(np.float64)
+    if block_size % 16 != 0:
+        raise ValueError(f"block_size must be a multiple of 16: {block_size}")
+
+    with rasterio.open(ref_raster) as src:
         transform = src.transform
         crs = src.crs
-        nodata = src.nodata
-        profile = src.profile
+        width = src.width
+        height = src.height
+        bounds = src.bounds
 
-    # NoData マスク
-    if nodata is not None:
-        dem = np.where(dem == nodata, np.nan, dem)
+    # 参照ラスタの範囲にかかる建物だけ読み込み・再投影する
+    gdf = load_buildings(poly_file, crs, bounds=tuple(bounds))
+    geoms = gdf.geometry.values
+
+    # ブロックの左上（行・列）と、その矩形
+    block_rows, block_cols = np.meshgrid(
+        np.arange(0, height, block_size), np.arange(0, width, block_size), indexing="ij"
+    )
+    block_rows = block_rows.ravel()
+    block_cols = block_cols.ravel()
+    xs0, ys0 = transform * (block_cols, block_rows)
+    xs1, ys1 = transform * (
+        np.minimum(block_cols + block_size, width), np.minimum(block_rows + block_size, height)
+    )
+    boxes = shapely.box(np.minimum(xs0, xs1), np.minimum(ys0, ys1), np.maximum(xs0, xs1), np.maximum(ys0, ys1))
+
+    # (ブロック, 建物) の組をブロック順に並べ、ブロックごとの区間に分ける
+    blk, geom_idx = gdf.sindex.query(boxes, predicate="intersects")
+    order = np.argsort(blk, kind="stable")
+    blk = blk[order]
+    geom_idx = geom_idx[order]
+    starts = np.flatnonzero(np.r_[True, blk[1:] != blk[:-1]]) if blk.size else np.array([], dtype=np.int64)
+    ends = np.r_[starts[1:], blk.size]
+
+    profile = dict(
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        dtype=rasterio.uint8,
+        crs=crs,
+        transform=transform,
+        nodata=0,
+    )
+
+    n_pixels = 0
+    with open_raster(out_tif, profile, write_opts, mask=True, sparse=True) as dst:
+        for s, e in zip(starts, ends):
+            b = blk[s]
+            win = Window(
+                int(block_cols[b]), int(block_rows[b]),
+                int(min(block_size, width - block_cols[b])), int(min(block_size, height - block_rows[b])),
+            )
+            binary = features.rasterize(
+                shapes=((geom, 1) for geom in geoms[geom_idx[s:e]]),
+                out_shape=(int(win.height), int(win.width)),
+                transform=rasterio.windows.transform(win, transform),
+                fill=0,
+                dtype=rasterio.uint8,
+                all_touched=False,  # 一括処理と同じ画素判定
+            )
+            dst.write(binary, 1, window=win)
+            n_pixels += int(np.count_nonzero(binary))
+
+    # QC
+    print(f"[Step1] blocks with buildings: {len(starts)} / {block_rows.size}, building pixels: {n_pixels}")
+    print("[Step1] ✅ exported (blocked):", out_tif)
+    return out_tif
 
-    # ピクセルサイズ（m）
-    dx = transform.a           # pixel width
-    dy = -transform.e          # pixel height（負なので反転）
-    print(f"[Step2] pixel size: dx={dx}, dy={dy}")
 
-    # Horn 法（8近傍）
+# ============================
+# Step2: DEM → 傾斜角ラスタ
+# ============================
+
+def _horn_slope_deg(dem: np.ndarray, dx: float, dy: float) -> np.ndarray:
+    """Horn 法（8近傍）で傾斜角（degree）を計算する。外周1セル分小さい配列を返す"""
+
     z1 = dem[:-2, :-2]
     z2 = dem[:-2, 1:-1]
     z3 = dem[:-2, 2:]
     z4 = dem[1:-1, :-2]
-    z5 = dem[1:-1, 1:-1]
     z6 = dem[1:-1, 2:]
     z7 = dem[2:, :-2]
     z8 = dem[2:, 1:-1]
@@ -195,44 +488,413 @@ def compute_slope(dem_tif: Path, out_slope_tif: Path) -> Path:
 
     # 傾斜角（degree）
     slope_rad = np.arctan(np.sqrt(dzdx ** 2 + dzdy ** 2))
-    slope_deg = np.degrees(slope_rad)
+    return np.degrees(slope_rad)
 
-    slope = np.full(dem.shape, np.nan)
-    slope[1:-1, 1:-1] = slope_deg
 
-    # NoData を戻す
-    if nodata is not None:
-        slope = np.where(np.isnan(slope), nodata, slope)
+def _horn_slope_deg_f32(
+    dem: np.ndarray,
+    dx: float,
+    dy: float,
+    out: np.ndarray | None = None,
+    fill: float | None = None,
+) -> np.ndarray:
+    """_horn_slope_deg の float32 版。一時配列は勾配1枚分だけで、結果は out に直接書き込む
+
+    dem は float32（NoData は NaN）。out は外周1セル分小さい float32 配列（None なら確保する）。
+    fill を指定すると、NaN になった画素（近傍に NoData を含む）をその値で埋める。
+    """
+
+    z1 = dem[:-2, :-2]
+    z2 = dem[:-2, 1:-1]
+    z3 = dem[:-2, 2:]
+    z4 = dem[1:-1, :-2]
+    z6 = dem[1:-1, 2:]
+    z7 = dem[2:, :-2]
+    z8 = dem[2:, 1:-1]
+    z9 = dem[2:, 2:]
+
+    if out is None:
+        out = np.empty(z1.shape, dtype=np.float32)
+    gy = np.empty(z1.shape, dtype=np.float32)
+
+    # dz/dx = ((z3 + 2*z6 + z9) - (z1 + 2*z4 + z7)) / 8dx（out を作業領域に使う）
+    np.add(z3, z9, out=out)
+    out += z6
+    out += z6
+    out -= z1
+    out -= z7
+    out -= z4
+    out -= z4
+    out *= np.float32(1.0 / (8 * dx))
+
+    # dz/dy = ((z7 + 2*z8 + z9) - (z1 + 2*z2 + z3)) / 8dy
+    np.add(z7, z9, out=gy)
+    gy += z8
+    gy += z8
+    gy -= z1
+    gy -= z3
+    gy -= z2
+    gy -= z2
+    gy *= np.float32(1.0 / (8 * dy))
+
+    # 傾斜角（degree）= degrees(arctan(sqrt(dzdx^2 + dzdy^2)))
+    np.square(out, out=out)
+    np.square(gy, out=gy)
+    out += gy
+    del gy
+    np.sqrt(out, out=out)
+    np.arctan(out, out=out)
+    out *= np.float32(180.0 / np.pi)
+
+    if fill is not None and not np.isnan(fill):
+        np.copyto(out, np.float32(fill), where=np.isnan(out))
+    return out
+
+
+def horn_slope_deg(dem: np.ndarray, dx: float, dy: float, slope_dtype: str = "float64") -> np.ndarray:
+    """Horn 法の傾斜角（float32, 外周1セル分小さい配列）。NoData は NaN のまま返す"""
+
+    if slope_dtype == "float32":
+        return _horn_slope_deg_f32(dem.astype(np.float32, copy=False), dx, dy)
+    return _horn_slope_deg(dem, dx, dy).astype(np.float32)
+
+
+def compute_slope(
+    dem_tif: Path,
+    out_slope_tif: Path,
+    block_size: int | None = None,
+    write_opts: RasterWriteOptions | None = None,
+    slope_dtype: str = "float64",
+) -> Path:
+    """DEM から Horn 法で傾斜角（degree）を計算する
+
+    block_size を指定すると、DEM 全体を読み込まずにブロック単位で処理する。
+    slope_dtype="float32" では DEM を float32 で読み、出力バッファに直接書き込む。
+    """
+
+    if block_size:
+        return _compute_slope_blocked(dem_tif, out_slope_tif, block_size, write_opts, slope_dtype)
+
+    slope, profile = compute_slope_array(dem_tif, slope_dtype)
 
     # GeoTIFF 出力
+    write_raster(out_slope_tif, slope, profile, options=write_opts)
+
+    print("[Step2] ✅ slope raster exported:", out_slope_tif)
+    return out_slope_tif
+
+
+def compute_slope_array(dem_tif: Path, slope_dtype: str = "float64") -> tuple[np.ndarray, dict]:
+    """DEM から Horn 法で傾斜角（degree, float32）を計算し、配列と出力用 profile を返す
+
+    slope_dtype="float32" では DEM を float32 で読み、NoData も出力配列へ直接書き込む
+    （DEM・出力・勾配1枚の float32 3枚分で済む）。
+    """
+
+    with rasterio.open(dem_tif) as src:
+        dem = src.read(1, out_dtype=np.float32 if slope_dtype == "float32" else np.float64)
+        transform = src.transform
+        crs = src.crs
+        nodata = src.nodata
+        profile = src.profile
+    record_read(dem_tif)
+
+    # ピクセルサイズ（m）
+    dx = transform.a           # pixel width
+    dy = -transform.e          # pixel height（負なので反転）
+    print(f"[Step2] pixel size: dx={dx}, dy={dy}")
+
     profile.update(
         dtype=rasterio.float32,
         count=1,
         nodata=nodata,
         crs=crs,
         transform=transform,
-        compress="lzw",
     )
 
-    out_slope_tif.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(out_slope_tif, "w", **profile) as dst:
-        dst.write(slope.astype(rasterio.float32), 1)
+    if slope_dtype == "float32":
+        # NoData マスク（その場で NaN に置き換える）
+        if nodata is not None:
+            dem[dem == np.float32(nodata)] = np.nan
 
-    print("[Step2] ✅ slope raster exported:", out_slope_tif)
+        fill = np.float32(nodata if nodata is not None else np.nan)
+        slope = np.empty(dem.shape, dtype=np.float32)
+        slope[0, :] = slope[-1, :] = slope[:, 0] = slope[:, -1] = fill
+        _horn_slope_deg_f32(dem, dx, dy, out=slope[1:-1, 1:-1], fill=fill)
+        return slope, profile
+
+    # NoData マスク
+    if nodata is not None:
+        dem = np.where(dem == nodata, np.nan, dem)
+
+    slope = np.full(dem.shape, np.nan)
+    slope[1:-1, 1:-1] = _horn_slope_deg(dem, dx, dy)
+
+    # NoData を戻す
+    if nodata is not None:
+        slope = np.where(np.isnan(slope), nodata, slope)
+
+    return slope.astype(rasterio.float32), profile
+
+
+def _compute_slope_blocked(
+    dem_tif: Path,
+    out_slope_tif: Path,
+    block_size: int,
+    write_opts: RasterWriteOptions | None = None,
+    slope_dtype: str = "float64",
+) -> Path:
+    """1ピクセルのハロー付きウィンドウで DEM を読み、ブロックごとに GeoTIFF へ書き出す
+
+    ピークメモリはブロックサイズで決まり、DEM 全体のサイズには依存しない。
+    結果は一括処理（compute_slope）と同一になる。
+    """
+
+    if block_size % 16 != 0:
+        raise ValueError(f"block_size must be a multiple of 16: {block_size}")
+
+    with rasterio.open(dem_tif) as src:
+        transform = src.transform
+        nodata = src.nodata
+        height, width = src.height, src.width
+
+        dx = transform.a
+        dy = -transform.e
+        print(f"[Step2] pixel size: dx={dx}, dy={dy}, block_size={block_size}")
+
+        profile = src.profile
+        profile.update(
+            dtype=rasterio.float32,
+            count=1,
+            nodata=nodata,
+        )
+
+        f32 = slope_dtype == "float32"
+        buf = np.empty((block_size, block_size), dtype=np.float32) if f32 else None
+
+        with open_raster(out_slope_tif, profile, write_opts) as dst:
+            for row0 in range(0, height, block_size):
+                for col0 in range(0, width, block_size):
+                    h = min(block_size, height - row0)
+                    w = min(block_size, width - col0)
+
+                    # 1ピクセルのハロー付きで読む（DEM の外は NaN で埋める）
+                    dem = read_dem_padded(src, row0 - 1, col0 - 1, h + 2, w + 2, np.float32 if f32 else np.float64)
+
+                    if f32:
+                        slope = _horn_slope_deg_f32(dem, dx, dy, out=buf[:h, :w], fill=nodata)
+                        dst.write(slope, 1, window=Window(col0, row0, w, h))
+                        continue
+
+                    slope = _horn_slope_deg(dem, dx, dy)
+                    if nodata is not None:
+                        slope = np.where(np.isnan(slope), nodata, slope)
+
+                    dst.write(slope.astype(rasterio.float32), 1, window=Window(col0, row0, w, h))
+    record_read(dem_tif)
+
+    print("[Step2] ✅ slope raster exported (blocked):", out_slope_tif)
     return out_slope_tif
 
 
+def read_dem_padded(src, row0: int, col0: int, h: int, w: int, dtype=np.float64) -> np.ndarray:
+    """(row0, col0) から (h, w) の DEM を dtype（float64 / float32）で読む。DEM の外と NoData は NaN"""
+
+    r0, r1 = max(row0, 0), min(row0 + h, src.height)
+    c0, c1 = max(col0, 0), min(col0 + w, src.width)
+    dem = src.read(1, window=Window(c0, r0, c1 - c0, r1 - r0), out_dtype=dtype)
+
+    if src.nodata is not None:
+        dem[dem == dem.dtype.type(src.nodata)] = np.nan
+
+    return np.pad(
+        dem,
+        ((r0 - row0, row0 + h - r1), (c0 - col0, col0 + w - c1)),
+        constant_values=np.nan,
+    )
+
+
+# ============================
+# Step2（任意）: DEM → 地形量（傾斜角・斜面方位・曲率・TPI）
+# ============================
+
+def terrain_derivatives(dem: np.ndarray, dx: float, dy: float, derivatives: list[str]) -> dict[str, np.ndarray]:
+    """3×3 近傍（z1〜z9）を1回だけ作り、指定された地形量をまとめて計算する
+
+    dem は NoData を NaN にした配列（float64 / float32。計算はその精度で行う）。
+    返す配列は外周1セル分小さい float32 で、近傍に NoData を含む画素は NaN。
+    - slope: 傾斜角（degree, Horn 法。_horn_slope_deg と同じ式）
+    - aspect: 斜面方位（degree, 斜面が向く方向を北から時計回り。平坦は -1）
+    - curvature: 曲率 -(∂²z/∂x² + ∂²z/∂y²)（1/m, 凸が正）
+    - plan_curvature / profile_curvature: 平面曲率・縦断曲率（1/m, 凸が正。平坦は 0）
+    - tpi: 地形的位置指数（中心の標高 - 周囲8セルの平均, m）
+    - elevation: 標高（m）
+    """
+
+    z1 = dem[:-2, :-2]
+    z2 = dem[:-2, 1:-1]
+    z3 = dem[:-2, 2:]
+    z4 = dem[1:-1, :-2]
+    z5 = dem[1:-1, 1:-1]
+    z6 = dem[1:-1, 2:]
+    z7 = dem[2:, :-2]
+    z8 = dem[2:, 1:-1]
+    z9 = dem[2:, 2:]
+
+    names = set(derivatives)
+    out = {}
+
+    if names & {"slope", "aspect", "plan_curvature", "profile_curvature"}:
+        # 1次微分（Horn 法）。y は行の増える向き（南向き）
+        dzdx = ((z3 + 2 * z6 + z9) - (z1 + 2 * z4 + z7)) / (8 * dx)
+        dzdy = ((z7 + 2 * z8 + z9) - (z1 + 2 * z2 + z3)) / (8 * dy)
+
+    if "slope" in names:
+        out["slope"] = np.degrees(np.arctan(np.sqrt(dzdx ** 2 + dzdy ** 2)))
+
+    if "aspect" in names:
+        # 下り方向 (東, 北) = (-dzdx, dzdy) の方位角
+        aspect = np.mod(np.degrees(np.arctan2(-dzdx, dzdy)), 360.0)
+        out["aspect"] = np.where((dzdx == 0) & (dzdy == 0), -1.0, aspect)
+
+    if names & {"curvature", "plan_curvature", "profile_curvature"}:
+        # 2次微分（Zevenbergen & Thorne）
+        r = (z4 - 2 * z5 + z6) / (dx * dx)
+        t = (z2 - 2 * z5 + z8) / (dy * dy)
+
+    if "curvature" in names:
+        out["curvature"] = -(r + t)
+
+    if names & {"plan_curvature", "profile_curvature"}:
+        s = ((z1 + z9) - (z3 + z7)) / (4 * dx * dy)
+        p2, q2, pq = dzdx ** 2, dzdy ** 2, dzdx * dzdy
+        g2 = p2 + q2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if "profile_curvature" in names:
+                prof = -(p2 * r + 2 * pq * s + q2 * t) / (g2 * (1 + g2) ** 1.5)
+                out["profile_curvature"] = np.where(g2 == 0, 0.0, prof)
+            if "plan_curvature" in names:
+                plan = -(q2 * r - 2 * pq * s + p2 * t) / g2 ** 1.5
+                out["plan_curvature"] = np.where(g2 == 0, 0.0, plan)
+
+    if "tpi" in names:
+        out["tpi"] = z5 - (z1 + z2 + z3 + z4 + z6 + z7 + z8 + z9) / 8
+
+    if "elevation" in names:
+        out["elevation"] = z5
+
+    return {name: out[name].astype(np.float32) for name in derivatives}
+
+
+def terrain_output_paths(terrain: TerrainConfig) -> list[Path]:
+    """地形量の出力先（out_tif に {derivative} があれば地形量ごと、なければ1ファイル）"""
+
+    if "{derivative}" in terrain.out_tif:
+        return [Path(terrain.out_tif.format(derivative=d)) for d in terrain.derivatives]
+    return [Path(terrain.out_tif)]
+
+
+def compute_terrain(
+    dem_tif: Path,
+    terrain: TerrainConfig,
+    block_size: int | None = None,
+    write_opts: RasterWriteOptions | None = None,
+    slope_dtype: str = "float64",
+) -> list[Path]:
+    """DEM をブロックごとに1回だけ読み、terrain.derivatives の地形量をまとめて書き出す
+
+    block_size を指定しなければ DEM 全体を1ブロックとして処理する。
+    slope_dtype="float32" では DEM を float32 で読み、その精度で計算する。
+    """
+
+    names = terrain.derivatives
+    out_tifs = terrain_output_paths(terrain)
+    dtype = np.float32 if slope_dtype == "float32" else np.float64
+
+    with rasterio.open(dem_tif) as src, ExitStack() as stack:
+        nodata = src.nodata
+        height, width = src.height, src.width
+        dx = src.transform.a
+        dy = -src.transform.e
+        print(f"[Terrain] derivatives: {', '.join(names)}, block_size={block_size}")
+
+        profile = src.profile
+        profile.update(dtype=rasterio.float32, count=1, nodata=nodata)
+
+        # (出力先, バンド番号) を地形量の順に並べる
+        if len(out_tifs) == len(names):
+            bands = [(stack.enter_context(open_raster(path, profile, write_opts)), 1) for path in out_tifs]
+        else:
+            dst = stack.enter_context(open_raster(out_tifs[0], dict(profile, count=len(names)), write_opts))
+            for i, name in enumerate(names, start=1):
+                dst.set_band_description(i, name)
+            bands = [(dst, i) for i in range(1, len(names) + 1)]
+
+        bh = block_size or height
+        bw = block_size or width
+        for row0 in range(0, height, bh):
+            for col0 in range(0, width, bw):
+                h = min(bh, height - row0)
+                w = min(bw, width - col0)
+
+                # 1ピクセルのハロー付きで読む（DEM の外は NaN で埋める）
+                dem = read_dem_padded(src, row0 - 1, col0 - 1, h + 2, w + 2, dtype)
+                values = terrain_derivatives(dem, dx, dy, names)
+
+                for name, (dst, band) in zip(names, bands):
+                    v = values[name]
+                    if nodata is not None:
+                        v[np.isnan(v)] = nodata
+                    dst.write(v, band, window=Window(col0, row0, w, h))
+    record_read(dem_tif)
+
+    for path in out_tifs:
+        print("[Terrain] ✅ exported:", path)
+    return out_tifs
+
+
 # ============================
 # Step3: 傾斜角 → 2値化ラスタ
 # ============================
 
-def binarize_slope(slope_tif: Path, slope_threshold: float, out_bin_tif: Path) -> Path:
+def binarize_slope(
+    slope_tif: Path,
+    slope_threshold: float,
+    out_bin_tif: Path,
+    write_opts: RasterWriteOptions | None = None,
+) -> Path:
     """傾斜角ラスタを閾値で2値化する"""
 
     with rasterio.open(slope_tif) as src:
         slope = src.read(1).astype(np.float32)
         profile = src.profile
         nodata = src.nodata
+    record_read(slope_tif)
+
+    binary = binarize_slope_array(slope, nodata, slope_threshold)
+
+    # 出力設定
+    profile = binary_slope_profile(profile)
+    write_raster(out_bin_tif, binary, profile, options=write_opts, mask=True)
+
+    print("[Step3] ✅ binary slope raster exported:", out_bin_tif)
+    return out_bin_tif
+
+
+def binary_slope_profile(slope_profile: dict) -> dict:
+    """傾斜角ラスタの profile から2値化ラスタ用の profile を作る"""
+
+    profile = dict(slope_profile)
+    profile.update(
+        dtype=rasterio.uint8,
+        count=1,
+        nodata=None,   # DEM 外も 0 として扱う
+    )
+    return profile
+
+
+def binarize_slope_array(slope: np.ndarray, nodata: float | None, slope_threshold: float) -> np.ndarray:
+    """傾斜角配列を閾値で2値化する（uint8, 1=危険斜面）"""
 
     print("[Step3] input nodata:", nodata)
 
@@ -247,23 +909,10 @@ def binarize_slope(slope_tif: Path, slope_threshold: float, out_bin_tif: Path) -
     binary[(slope >= slope_threshold) & valid_mask] = 1
 
     # QC
-    vals, counts = np.unique(binary, return_counts=True)
-    print("[Step3] binary unique values:", list(zip(vals.tolist(), counts.tolist())))
-
-    # 出力設定
-    profile.update(
-        dtype=rasterio.uint8,
-        count=1,
-        nodata=None,   # DEM 外も 0 として扱う
-        compress="lzw",
-    )
+    if qc_enabled():
+        print("[Step3] binary unique values:", value_counts_u8(binary, "slope_binary"))
 
-    out_bin_tif.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(out_bin_tif, "w", **profile) as dst:
-        dst.write(binary, 1)
-
-    print("[Step3] ✅ binary slope raster exported:", out_bin_tif)
-    return out_bin_tif
+    return binary
 
 
 # ============================
@@ -275,9 +924,30 @@ def compute_highrisk(
     slope_bin_tif: Path,
     risk_radius_m: float,
     out_tif: Path,
+    write_opts: RasterWriteOptions | None = None,
 ) -> Path:
     """建物と危険斜面の距離からハイリスク領域を計算する"""
 
+    compute_highrisk_sweep(bld_bin_tif, slope_bin_tif, [risk_radius_m], [out_tif], write_opts=write_opts)
+    return out_tif
+
+
+def compute_highrisk_sweep(
+    bld_bin_tif: Path,
+    slope_bin_tif: Path,
+    risk_radii_m: list[float],
+    out_tifs: list[Path],
+    distance_engine: str = "bounded",
+    write_opts: RasterWriteOptions | None = None,
+    landcover: LandCoverConfig | None = None,
+    score_tifs: list[Path] | None = None,
+) -> list[Path]:
+    """複数の距離閾値についてハイリスク領域を計算する
+
+    out_tifs が半径と同数なら半径ごとに1ファイル、1つだけなら複数バンドの1ファイルに書き出す。
+    landcover が有効なら、土地被覆で重み付けしたリスクスコアも score_tifs に書き出す。
+    """
+
     # ラスタ読み込み
     with rasterio.open(bld_bin_tif) as src:
         house = src.read(1).astype(np.uint8)
@@ -286,60 +956,1089 @@ def compute_highrisk(
 
     with rasterio.open(slope_bin_tif) as src:
         slope = src.read(1).astype(np.uint8)
+    record_read(bld_bin_tif)
+    record_read(slope_bin_tif)
+
+    if landcover is not None and landcover.enabled:
+        lc, lut = read_landcover_lut(landcover)
+        risk_stack, score_stack = compute_highrisk_score_stack(
+            house, slope, lc, lut, transform, risk_radii_m, distance_engine
+        )
+        write_highrisk_score(score_tifs, score_stack, highrisk_score_profile(profile), risk_radii_m, write_opts)
+    else:
+        risk_stack = compute_highrisk_stack(house, slope, transform, risk_radii_m, distance_engine)
+
+    # 出力
+    write_highrisk(out_tifs, risk_stack, highrisk_profile(profile), risk_radii_m, write_opts)
+    return out_tifs
+
+
+def highrisk_profile(house_profile: dict) -> dict:
+    """建物ラスタの profile からリスクラスタ用の profile を作る"""
+
+    profile = dict(house_profile)
+    profile.update(
+        dtype=rasterio.uint8,
+        count=1,
+        nodata=0,
+    )
+    return profile
+
+
+def highrisk_score_profile(house_profile: dict) -> dict:
+    """建物ラスタの profile からリスクスコア（float32, 0 = リスクなし）用の profile を作る"""
+
+    profile = dict(house_profile)
+    profile.update(
+        dtype=rasterio.float32,
+        count=1,
+        nodata=None,
+    )
+    return profile
+
+
+def highrisk_output_paths(io: IOConfig, risk_radii_m: list[float]) -> list[Path]:
+    """Step4 の出力先。multiband なら1ファイル、そうでなければ半径ごとにテンプレートを展開する"""
+
+    template = io.bld_risk_tif_template or str(io.bld_risk_tif)
+    return radius_output_paths(template, risk_radii_m, io.bld_risk_multiband)
+
+
+def highrisk_score_paths(io: IOConfig, landcover: LandCoverConfig, risk_radii_m: list[float]) -> list[Path]:
+    """土地被覆で重み付けしたリスクスコアの出力先（バンド構成は bld_risk_multiband に従う）"""
+
+    return radius_output_paths(landcover.score_tif_template, risk_radii_m, io.bld_risk_multiband)
+
+
+def radius_output_paths(template: str, risk_radii_m: list[float], multiband: bool) -> list[Path]:
+    """{risk_radius_m} を含むテンプレートを、半径ごと（または複数バンドの1ファイル）に展開する"""
+
+    if multiband:
+        label = "-".join(radius_label(r) for r in risk_radii_m)
+        return [Path(template.format(risk_radius_m=label))]
+    return [Path(template.format(risk_radius_m=radius_label(r))) for r in risk_radii_m]
+
+
+def write_highrisk(
+    out_tifs: list[Path],
+    risk_stack: np.ndarray,
+    profile: dict,
+    risk_radii_m: list[float],
+    write_opts: RasterWriteOptions | None = None,
+) -> None:
+    """(半径数, rows, cols) のリスク配列を、半径ごとのファイルまたは複数バンドで書き出す"""
+
+    if len(out_tifs) == len(risk_radii_m):
+        for out_tif, risk_zone in zip(out_tifs, risk_stack):
+            write_raster(out_tif, risk_zone, profile, options=write_opts, mask=True)
+            print("[Step4] ✅ exported:", out_tif)
+        return
+
+    descriptions = [f"highrisk_{radius_label(r)}m" for r in risk_radii_m]
+    write_raster(out_tifs[0], risk_stack, profile, descriptions, write_opts, mask=True)
+    print("[Step4] ✅ exported (multiband):", out_tifs[0])
+
+
+def write_highrisk_score(
+    out_tifs: list[Path],
+    score_stack: np.ndarray,
+    profile: dict,
+    risk_radii_m: list[float],
+    write_opts: RasterWriteOptions | None = None,
+) -> None:
+    """(半径数, rows, cols) のリスクスコアを、半径ごとのファイルまたは複数バンドで書き出す"""
+
+    if len(out_tifs) == len(risk_radii_m):
+        for out_tif, score in zip(out_tifs, score_stack):
+            write_raster(out_tif, score, profile, options=write_opts)
+            print("[Step4] ✅ score exported:", out_tif)
+        return
+
+    descriptions = [f"risk_score_{radius_label(r)}m" for r in risk_radii_m]
+    write_raster(out_tifs[0], score_stack, profile, descriptions, write_opts)
+    print("[Step4] ✅ score exported (multiband):", out_tifs[0])
+
+
+def read_landcover_lut(landcover: LandCoverConfig) -> tuple[np.ndarray, np.ndarray]:
+    """土地被覆ラスタと、その NoData を考慮したルックアップテーブルを読み込む"""
+
+    with rasterio.open(landcover.landcover_tif) as src:
+        lc = src.read(1)
+        nodata = src.nodata
+    record_read(landcover.landcover_tif)
+
+    lut = landcover_lut(landcover.weights, landcover.default_weight, nodata, lc.dtype)
+    return lc, lut
+
+
+def compute_highrisk_array(
+    house: np.ndarray,
+    slope: np.ndarray,
+    transform,
+    risk_radius_m: float,
+) -> np.ndarray:
+    """建物配列と2値化斜面配列からハイリスク領域（uint8）を計算する"""
+
+    return compute_highrisk_stack(house, slope, transform, [risk_radius_m])[0]
+
+
+def compute_highrisk_stack(
+    house: np.ndarray,
+    slope: np.ndarray,
+    transform,
+    risk_radii_m: list[float],
+    distance_engine: str = "bounded",
+) -> np.ndarray:
+    """複数の距離閾値のハイリスク領域を (半径数, rows, cols) の uint8 で返す
+
+    distance_engine:
+        "bounded": 建物セルから最大半径内だけ危険斜面を探索する（既定）
+        "edt"    : 全画像の距離変換を各1回行い、距離を float32 で保持する
+    どちらも同じ結果になる。
+    """
 
     # ピクセルサイズ（m）
     dx = transform.a
     dy = -transform.e
     pixel_size = (dx + dy) / 2.0
-    print(f"[Step4] pixel size = {pixel_size} m")
+    print(f"[Step4] pixel size = {pixel_size} m, engine = {distance_engine}")
+
+    if distance_engine == "bounded":
+        return _highrisk_stack_bounded(house, slope, pixel_size, risk_radii_m)
+    if distance_engine != "edt":
+        raise ValueError(f"unknown distance_engine: {distance_engine}")
 
     # slope=1 からの距離（distance_transform_edt は 0 からの距離を返す）
     slope_mask = slope == 1
-    dist_pix = distance_transform_edt(~slope_mask)
-    dist_m = dist_pix * pixel_size
-
-    # ハイリスク判定
-    highrisk = np.zeros(house.shape, dtype=np.uint8)
-    highrisk[(house == 1) & (dist_m <= risk_radius_m)] = 1
+    dist_m = _distance_m_float32(~slope_mask, pixel_size)
 
     # 可視化用：家の周囲 risk_radius_m m で、かつ highrisk=1 の領域
     house_mask = house == 1
-    house_dist_pix = distance_transform_edt(~house_mask)
-    house_dist_m = house_dist_pix * pixel_size
+    house_dist_m = _distance_m_float32(~house_mask, pixel_size)
+
+    risk_stack = np.zeros((len(risk_radii_m),) + house.shape, dtype=np.uint8)
+    for risk_zone, risk_radius_m in zip(risk_stack, risk_radii_m):
+        # ハイリスク判定
+        highrisk = house_mask & (dist_m <= risk_radius_m)
+        risk_zone[(house_dist_m <= risk_radius_m) & highrisk] = 1
+
+    return risk_stack
+
+
+def _highrisk_stack_bounded(
+    house: np.ndarray,
+    slope: np.ndarray,
+    pixel_size: float,
+    risk_radii_m: list[float],
+) -> np.ndarray:
+    """建物セルについてだけ、最大半径内の危険斜面までの距離を求めてハイリスク判定する
+
+    建物セル自身の「建物からの距離」は0なので、EDT 版の house_dist_m <= r は
+    建物セル上では常に成り立つ。したがって判定に必要なのは建物セルでの
+    斜面距離だけで、全画像の距離場（float64）を作る必要はない。
+    """
+
+    house_idx = np.flatnonzero(house == 1)
+    dist_m = bounded_distance_m(slope == 1, house_idx, pixel_size, max(risk_radii_m))
+
+    risk_stack = np.zeros((len(risk_radii_m),) + house.shape, dtype=np.uint8)
+    flat = risk_stack.reshape(len(risk_radii_m), -1)
+    for i, risk_radius_m in enumerate(risk_radii_m):
+        flat[i, house_idx[dist_m <= risk_radius_m]] = 1
+
+    return risk_stack
+
+
+def landcover_lut(
+    weights: dict[int, float],
+    default_weight: float,
+    nodata: float | None,
+    dtype,
+) -> np.ndarray:
+    """土地被覆クラスコード → 係数 の float32 ルックアップテーブル
+
+    インデックスがクラスコード。末尾は default_weight で、np.take(mode="clip") により
+    テーブルより大きいコードも default_weight になる。NoData の係数は 0。
+
+    クラスコードを添字に使うので、土地被覆ラスタ（dtype）は整数型で、NoData・クラスコードは
+    0 以上の整数でなければならない（NaN の NoData や浮動小数のラスタは ValueError）。
+    """
+
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer):
+        raise ValueError(
+            f"landcover raster must have an integer dtype to be used as class codes (got {dtype}); "
+            "reclassify it to integer codes first"
+        )
+    if nodata is not None:
+        if not np.isfinite(nodata) or float(nodata) != int(nodata) or nodata < 0:
+            raise ValueError(
+                f"landcover NoData must be a non-negative integer class code (got {nodata}); "
+                "set an integer NoData on the raster or unset it"
+            )
+        nodata = int(nodata)
+    negative = [code for code in weights if code < 0]
+    if negative:
+        raise ValueError(f"landcover class codes must be non-negative (got {negative})")
+
+    codes = list(weights)
+    if nodata is not None:
+        codes.append(nodata)
+    size = max(codes, default=0) + 2
 
-    risk_zone = np.zeros(house.shape, dtype=np.uint8)
-    risk_zone[(house_dist_m <= risk_radius_m) & (highrisk == 1)] = 1
+    lut = np.full(size, default_weight, dtype=np.float32)
+    for code, w in weights.items():
+        lut[code] = w
+    if nodata is not None:
+        lut[nodata] = 0.0
+    return lut
+
+
+def compute_highrisk_score_stack(
+    house: np.ndarray,
+    slope: np.ndarray,
+    landcover: np.ndarray,
+    lut: np.ndarray,
+    transform,
+    risk_radii_m: list[float],
+    distance_engine: str = "bounded",
+) -> tuple[np.ndarray, np.ndarray]:
+    """ハイリスク領域（uint8）と、土地被覆で重み付けしたリスクスコア（float32）を返す
+
+    スコアは「半径内で最寄りの危険斜面セルの土地被覆係数」。最寄りセルは距離と同時に求めるので、
+    距離計算は1回で済む（bounded: 半径内の探索 / edt: 全画像の特徴変換）。
+    ハイリスク領域は compute_highrisk_stack と同じ。最寄りが同じ距離に複数ある場合、
+    どのセルの係数になるかはエンジンによって異なることがある。
+    LUT の適用は建物セル分だけで、全画像サイズの一時配列は作らない。
+    """
+
+    if landcover.shape != house.shape:
+        raise ValueError(f"landcover grid {landcover.shape} does not match buildings {house.shape}")
+
+    pixel_size = (transform.a - transform.e) / 2.0
+    print(f"[Step4] pixel size = {pixel_size} m, engine = {distance_engine} (landcover weighted)")
+
+    house_idx = np.flatnonzero(house == 1)
+    if distance_engine == "bounded":
+        dist_m, nearest = bounded_distance_m(
+            slope == 1, house_idx, pixel_size, max(risk_radii_m), return_nearest=True
+        )
+    elif distance_engine == "edt":
+        dist_m, nearest = _nearest_distance_m_edt(slope == 1, house_idx, pixel_size)
+    else:
+        raise ValueError(f"unknown distance_engine: {distance_engine}")
+
+    found = nearest >= 0
+    weight = np.zeros(house_idx.size, dtype=np.float32)
+    weight[found] = np.take(lut, landcover.ravel()[nearest[found]], mode="clip")
+
+    n = len(risk_radii_m)
+    risk_stack = np.zeros((n,) + house.shape, dtype=np.uint8)
+    score_stack = np.zeros((n,) + house.shape, dtype=np.float32)
+    risk_flat = risk_stack.reshape(n, -1)
+    score_flat = score_stack.reshape(n, -1)
+    for i, risk_radius_m in enumerate(risk_radii_m):
+        within = dist_m <= risk_radius_m
+        risk_flat[i, house_idx[within]] = 1
+        score_flat[i, house_idx[within]] = weight[within]
+
+    return risk_stack, score_stack
+
+
+def disk_offsets(pixel_size: float, max_radius_m: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """距離 max_radius_m 以内の近傍オフセット (dr, dc) と二乗距離（px^2）を距離の昇順で返す"""
+
+    k = max(int(np.floor(max_radius_m / pixel_size)), 0)
+    dr, dc = np.mgrid[-k:k + 1, -k:k + 1]
+    dr = dr.ravel()
+    dc = dc.ravel()
+    d2 = dr * dr + dc * dc
+    inside = np.sqrt(d2) * pixel_size <= max_radius_m
+
+    order = np.argsort(d2[inside], kind="stable")
+    return dr[inside][order], dc[inside][order], d2[inside][order]
+
+
+def bounded_distance_m(
+    source_mask: np.ndarray,
+    target_idx: np.ndarray,
+    pixel_size: float,
+    max_radius_m: float,
+    return_nearest: bool = False,
+) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+    """target_idx（フラットインデックス）の各セルから最も近い source_mask セルまでの距離（m）
+
+    max_radius_m より遠い場合は inf。距離は distance_transform_edt と同じく
+    sqrt(二乗ピクセル距離) * pixel_size で計算する。
+    計算量は 対象セル数 × 半径内オフセット数 で、画像全体の大きさには比例しない。
+    return_nearest=True なら、最寄りの source セルのフラットインデックス（なければ -1）も返す。
+    """
+
+    dr, dc, d2 = disk_offsets(pixel_size, max_radius_m)
+    k = int(np.abs(dr).max()) if dr.size else 0
+
+    # 範囲チェックを省くため、半径分だけ False で広げる
+    src, pcols = _pad_flat(source_mask, k, False)
+    tpad = _padded_index(target_idx, source_mask.shape[1], k, pcols)
+
+    best_d2 = np.full(target_idx.size, -1, dtype=np.int64)
+    nearest = np.full(target_idx.size, -1, dtype=np.int64) if return_nearest else None
+    active = np.arange(target_idx.size)
+
+    # 近いオフセットから順に調べ、見つかった対象は以降の探索から外す
+    for off, dist2 in zip(dr * pcols + dc, d2):
+        if active.size == 0:
+            break
+        hit = src[tpad[active] + off]
+        if hit.any():
+            best_d2[active[hit]] = dist2
+            if return_nearest:
+                nearest[active[hit]] = tpad[active[hit]] + off
+            active = active[~hit]
+
+    dist_m = np.full(target_idx.size, np.inf)
+    found = best_d2 >= 0
+    dist_m[found] = np.sqrt(best_d2[found].astype(np.float64)) * pixel_size
+    if not return_nearest:
+        return dist_m
+
+    # 広げた配列のインデックスを元配列のインデックスに戻す
+    rows, cols = np.divmod(nearest[found], pcols)
+    nearest[found] = (rows - k) * source_mask.shape[1] + (cols - k)
+    return dist_m, nearest
+
+
+def _pad_flat(array: np.ndarray, k: int, fill) -> tuple[np.ndarray, int]:
+    """周囲を k セル fill で広げた配列をフラットにして、広げた後の列数と一緒に返す"""
+
+    nrows, ncols = array.shape
+    pcols = ncols + 2 * k
+    padded = np.full((nrows + 2 * k, pcols), fill, dtype=array.dtype)
+    padded[k:k + nrows, k:k + ncols] = array
+    return padded.ravel(), pcols
+
+
+def _padded_index(target_idx: np.ndarray, ncols: int, k: int, pcols: int) -> np.ndarray:
+    """元配列のフラットインデックスを、_pad_flat で広げた配列のインデックスに変換する"""
+
+    rows, cols = np.divmod(target_idx, ncols)
+    return (rows + k) * pcols + (cols + k)
+
+
+def _nearest_distance_m_edt(
+    source_mask: np.ndarray,
+    target_idx: np.ndarray,
+    pixel_size: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """edt エンジン版の bounded_distance_m(..., return_nearest=True)（半径の打ち切りなし）
+
+    全画像の特徴変換から target_idx の各セルの最寄り source セル（フラットインデックス, なければ -1）と
+    距離（m, float32）を返す。距離は _distance_m_float32 と同じ値になる。
+    """
+
+    nrows, ncols = source_mask.shape
+    if not source_mask.any():
+        return np.full(target_idx.size, np.inf, dtype=np.float32), np.full(target_idx.size, -1, dtype=np.int64)
+
+    ft = np.empty((2, nrows, ncols), dtype=np.int32)
+    distance_transform_edt(~source_mask, return_distances=False, return_indices=True, indices=ft)
+    near_r = ft[0].ravel()[target_idx].astype(np.int64)
+    near_c = ft[1].ravel()[target_idx].astype(np.int64)
+
+    rows, cols = np.divmod(target_idx, ncols)
+    d2 = ((near_r - rows) ** 2 + (near_c - cols) ** 2).astype(np.float64)
+    dist = (np.sqrt(d2) * pixel_size).astype(np.float32)
+    return dist, near_r * ncols + near_c
+
+
+def _distance_m_float32(mask: np.ndarray, pixel_size: float, block_rows: int = 512) -> np.ndarray:
+    """mask=False のセルからの距離（m）を float32 で返す
+
+    scipy には特徴変換（最寄りの False セルの添字、int32）だけを求めさせ、距離は行ブロックごとに
+    float64 で計算して float32 の出力に書き込む（全画像の float64 距離場は作らない）。
+    値は distance_transform_edt(mask) * pixel_size を float32 にしたものと一致する。
+    """
+
+    nrows, ncols = mask.shape
+    ft = np.empty((2, nrows, ncols), dtype=np.int32)
+    distance_transform_edt(mask, return_distances=False, return_indices=True, indices=ft)
+
+    dist = np.empty((nrows, ncols), dtype=np.float32)
+    cols = np.arange(ncols, dtype=np.int32)
+    for r0 in range(0, nrows, block_rows):
+        r1 = min(r0 + block_rows, nrows)
+        rows = np.arange(r0, r1, dtype=np.int32)[:, None]
+        d2 = (ft[0, r0:r1] - rows).astype(np.float64)
+        d2 *= d2
+        dc = (ft[1, r0:r1] - cols).astype(np.float64)
+        dc *= dc
+        d2 += dc
+        np.sqrt(d2, out=d2)
+        d2 *= pixel_size
+        dist[r0:r1] = d2
+    return dist
 
-    # 出力
-    profile.update(
-        dtype=rasterio.uint8,
-        count=1,
-        nodata=0,
-        compress="lzw",
+
+# ============================
+# Step5: 建物ごとのリスク属性 → GeoPackage
+# ============================
+
+def rasterize_building_labels(gdf: gpd.GeoDataFrame, transform, shape: tuple[int, int]) -> np.ndarray:
+    """建物ポリゴンを行番号+1 の uint32 ラベルでラスタ化する（建物外 = 0）"""
+
+    shapes = zip(gdf.geometry, range(1, len(gdf) + 1))
+    return features.rasterize(
+        shapes=shapes,
+        out_shape=shape,
+        transform=transform,
+        fill=0,
+        dtype=np.uint32,
+        all_touched=False,  # Step1 と同じ画素判定
     )
 
-    out_tif.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(out_tif, "w", **profile) as dst:
-        dst.write(risk_zone, 1)
 
-    print("[Step4] ✅ exported:", out_tif)
-    return out_tif
+def building_risk_attributes(
+    labels: np.ndarray,
+    n_buildings: int,
+    slope_deg: np.ndarray,
+    slope_nodata: float | None,
+    slope_bin: np.ndarray,
+    pixel_size: float,
+    risk_radius_m: float,
+    risk_radii_m: list[float],
+    distance_engine: str = "bounded",
+) -> dict[str, np.ndarray]:
+    """建物ラベルごとの集計値を返す（各配列の長さは n_buildings）
+
+    - min_distance_to_steep_slope_m: 建物画素から最寄りの危険斜面までの距離の最小値。
+      bounded エンジンは最大半径（risk_radius_m と risk_radii_m の最大値）までしか探索しないので、
+      NaN は「最大半径より遠い」（または建物に画素がない）ことを表し、実際の距離ではない。
+      最大半径より遠い距離も必要なら edt エンジンを使う
+    - max_slope_within_radius: 建物画素から risk_radius_m 以内の最大傾斜角（度）
+    - risk_flag: min_distance_to_steep_slope_m <= risk_radius_m
+    - risk_radii_m が複数ある場合は risk_flag_{r}m も追加する
+
+    ラベル画素をまとめて集計するので、建物ごとの Python ループはない。
+    画素を持たない（画素より小さい）建物は NaN / False になる。
+    """
+
+    bld_idx = np.flatnonzero(labels)
+    lab = labels.ravel()[bld_idx].astype(np.int64)
+
+    # 画素ごとの最寄り危険斜面距離
+    if distance_engine == "edt":
+        dist = _distance_m_float32(slope_bin != 1, pixel_size).ravel()[bld_idx]
+    else:
+        dist = bounded_distance_m(slope_bin == 1, bld_idx, pixel_size, max(risk_radius_m, *risk_radii_m))
+
+    min_dist = np.full(n_buildings + 1, np.inf)
+    np.minimum.at(min_dist, lab, dist)
+
+    # 画素ごとの半径内最大傾斜（NoData は NaN として無視）
+    slope_valid = slope_deg.astype(np.float32)
+    if slope_nodata is not None:
+        slope_valid[slope_deg == slope_nodata] = np.nan
+    pix_max = max_within_radius(slope_valid, bld_idx, pixel_size, risk_radius_m)
+
+    max_slope = np.full(n_buildings + 1, -np.inf, dtype=np.float32)
+    np.fmax.at(max_slope, lab, pix_max)
+
+    pixel_count = np.bincount(lab, minlength=n_buildings + 1)
+
+    attrs = {
+        "pixel_count": pixel_count[1:],
+        "min_distance_to_steep_slope_m": np.where(np.isinf(min_dist), np.nan, min_dist)[1:],
+        "max_slope_within_radius": np.where(np.isinf(max_slope), np.nan, max_slope)[1:],
+        "risk_flag": (min_dist <= risk_radius_m)[1:],
+    }
+    if len(risk_radii_m) > 1:
+        for r in risk_radii_m:
+            attrs[f"risk_flag_{radius_label(r)}m"] = (min_dist <= r)[1:]
+    return attrs
+
+
+def max_within_radius(
+    values: np.ndarray,
+    target_idx: np.ndarray,
+    pixel_size: float,
+    radius_m: float,
+) -> np.ndarray:
+    """target_idx の各セルから radius_m 以内にある values の最大値（NaN は無視、全て NaN なら NaN）"""
+
+    dr, dc, _ = disk_offsets(pixel_size, radius_m)
+    k = int(np.abs(dr).max()) if dr.size else 0
+    vals, pcols = _pad_flat(values, k, np.nan)
+    tpad = _padded_index(target_idx, values.shape[1], k, pcols)
+
+    best = np.full(target_idx.size, np.nan, dtype=values.dtype)
+    for off in dr * pcols + dc:
+        np.fmax(best, vals[tpad + off], out=best)
+    return best
+
+
+def building_risk_gdf(
+    gdf: gpd.GeoDataFrame,
+    transform,
+    slope_deg: np.ndarray,
+    slope_nodata: float | None,
+    slope_bin: np.ndarray,
+    risk_radius_m: float,
+    risk_radii_m: list[float],
+    distance_engine: str = "bounded",
+) -> gpd.GeoDataFrame:
+    """建物ポリゴンに Step5 のリスク属性を付けた GeoDataFrame を返す
+
+    属性は building_risk_attributes を参照（bounded エンジンの min_distance_to_steep_slope_m は
+    最大半径より遠いと NaN）。
+    """
+
+    pixel_size = (transform.a - transform.e) / 2.0
+    labels = rasterize_building_labels(gdf, transform, slope_bin.shape)
+    attrs = building_risk_attributes(
+        labels, len(gdf), slope_deg, slope_nodata, slope_bin,
+        pixel_size, risk_radius_m, risk_radii_m, distance_engine,
+    )
+
+    out = gdf.reset_index(drop=True).copy()
+    for name, values in attrs.items():
+        out[name] = values
+    print("[Step5] buildings at risk:", int(attrs["risk_flag"].sum()), "/", len(out))
+    return out
+
+
+def write_building_risk(out_gpkg: Path, gdf: gpd.GeoDataFrame) -> Path:
+    """建物ごとのリスク属性を GeoPackage に書き出す"""
+
+    out_gpkg.parent.mkdir(parents=True, exist_ok=True)
+    gdf.to_file(out_gpkg, driver="GPKG", layer="building_risk")
+    record_write(out_gpkg)
+    print("[Step5] ✅ exported:", out_gpkg)
+    return out_gpkg
+
+
+def export_building_risk(
+    poly_file: Path,
+    ref_raster: Path,
+    slope_deg_tif: Path,
+    slope_bin_tif: Path,
+    risk_radius_m: float,
+    risk_radii_m: list[float],
+    out_gpkg: Path,
+    distance_engine: str = "bounded",
+) -> Path:
+    """ファイル版 Step5。傾斜角・2値化ラスタを読み、建物ごとのリスク属性を書き出す"""
+
+    # 建物は Step1 と同じ参照ラスタのグリッドでラベル化する
+    with rasterio.open(ref_raster) as src:
+        transform = src.transform
+        crs = src.crs
+
+    with rasterio.open(slope_deg_tif) as src:
+        slope_deg = src.read(1)
+        slope_nodata = src.nodata
+
+    with rasterio.open(slope_bin_tif) as src:
+        slope_bin = src.read(1)
+    record_read(slope_deg_tif)
+    record_read(slope_bin_tif)
+
+    gdf = load_buildings(poly_file, crs)
+    out = building_risk_gdf(
+        gdf, transform, slope_deg, slope_nodata, slope_bin,
+        risk_radius_m, risk_radii_m, distance_engine,
+    )
+    return write_building_risk(out_gpkg, out)
+
+
+# ============================
+# 差分更新: 建物レイヤの変更分だけ再計算
+# ============================
+
+def incremental_state_path(config: Config) -> Path:
+    """前回実行時の建物の状態ファイル"""
+
+    if config.options.incremental_state:
+        return config.options.incremental_state
+    first = highrisk_output_paths(config.io, config.params.risk_radii_m)[0]
+    return first.with_name(first.stem + ".buildings.json")
+
+
+def incremental_outputs(config: Config) -> list[Path]:
+    """差分更新で書き換える GeoTIFF（すべて存在しないと差分更新できない）"""
+
+    io = config.io
+    p = config.params
+    paths = highrisk_output_paths(io, p.risk_radii_m)
+    if config.landcover.enabled:
+        paths += highrisk_score_paths(io, config.landcover, p.risk_radii_m)
+    if config.options.persist_intermediates:
+        paths.append(io.bld_bin_tif)
+    return paths
+
+
+def incremental_signature(config: Config, step_cache: StepCache) -> str:
+    """建物以外の入力・パラメータ・出力先のキー。前回と違えば全体を再計算する"""
+
+    io = config.io
+    p = config.params
+    lc = config.landcover
+    return step_cache.key(
+        "incremental",
+        step_cache.fingerprint(io.dem_tif),
+        step_cache.fingerprint(io.ref_raster),
+        p.slope_threshold,
+        p.slope_dtype,
+        p.risk_radii_m,
+        [str(path) for path in incremental_outputs(config)],
+        asdict(config.output),
+        [step_cache.fingerprint(lc.landcover_tif), lc.weights, lc.default_weight] if lc.enabled else None,
+        [config.terrain.derivatives, config.terrain.out_tif],
+    )
+
+
+def dirty_windows(bounds: list[tuple[float, float, float, float]], transform, shape: tuple[int, int]) -> list[Window]:
+    """変更された建物の外接矩形を、ラスタ内の整数画素ウィンドウに変換する"""
+
+    height, width = shape
+    windows = []
+    for b in bounds:
+        win = from_bounds(*b, transform=transform)
+        # 画素中心の判定に余裕を持たせ、外側に1画素広げる
+        col0 = max(math.floor(win.col_off) - 1, 0)
+        row0 = max(math.floor(win.row_off) - 1, 0)
+        col1 = min(math.ceil(win.col_off + win.width) + 1, width)
+        row1 = min(math.ceil(win.row_off + win.height) + 1, height)
+        if col1 > col0 and row1 > row0:
+            windows.append(Window(col0, row0, col1 - col0, row1 - row0))
+    return windows
+
+
+def highrisk_window(
+    win: Window,
+    halo: int,
+    dem_src,
+    gdf: gpd.GeoDataFrame,
+    transform,
+    params: Params,
+    landcover_src=None,
+    lut: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray | None]:
+    """ウィンドウ内の傾斜角・建物ラスタ・ハイリスク領域（・スコア）を計算する
+
+    建物と危険斜面は探索半径分（halo）広げた範囲で用意するので、
+    ウィンドウ内の結果は全体を一括計算した場合と一致する。
+    傾斜角は NoData・DEM 外が NaN のまま返す。
+    """
+
+    col0, row0 = int(win.col_off), int(win.row_off)
+    h, w = int(win.height), int(win.width)
+    hh, ww = h + 2 * halo, w + 2 * halo
+
+    # Step2・3: 傾斜角 → 2値化（傾斜は外周1画素を使うので halo + 1 画素を読む）
+    f32 = params.slope_dtype == "float32"
+    dem = read_dem_padded(
+        dem_src, row0 - halo - 1, col0 - halo - 1, hh + 2, ww + 2, np.float32 if f32 else np.float64
+    )
+    slope = horn_slope_deg(dem, dem_src.transform.a, -dem_src.transform.e, params.slope_dtype)
+    slope_bin = (slope >= params.slope_threshold).astype(np.uint8)  # NaN（NoData・DEM 外）は 0
+
+    # Step1: ハロー込みの範囲にかかる建物だけラスタ化
+    win_transform = transform * transform.translation(col0 - halo, row0 - halo)
+    bounds = rasterio.transform.array_bounds(hh, ww, win_transform)
+    near = gdf.geometry.iloc[gdf.sindex.query(shapely.box(*bounds))]
+    if len(near):
+        house = features.rasterize(
+            ((geom, 1) for geom in near),
+            out_shape=(hh, ww),
+            transform=win_transform,
+            fill=0,
+            dtype=np.uint8,
+            all_touched=False,
+        )
+    else:
+        house = np.zeros((hh, ww), dtype=np.uint8)
+
+    # Step4
+    pixel_size = (transform.a - transform.e) / 2.0
+    score_stack = None
+    if landcover_src is not None:
+        lc_win = Window(col0 - halo, row0 - halo, ww, hh)
+        landcover = landcover_src.read(1, window=lc_win, boundless=True, fill_value=landcover_src.nodata or 0)
+        risk_stack, score_stack = compute_highrisk_score_stack(
+            house, slope_bin, landcover, lut, transform, params.risk_radii_m
+        )
+    else:
+        risk_stack = _highrisk_stack_bounded(house, slope_bin, pixel_size, params.risk_radii_m)
+
+    inner = (slice(halo, halo + h), slice(halo, halo + w))
+    return (
+        slope[inner],
+        house[inner],
+        risk_stack[(slice(None),) + inner],
+        score_stack[(slice(None),) + inner] if score_stack is not None else None,
+    )
+
+
+def patch_highrisk_windows(config: Config, gdf: gpd.GeoDataFrame, windows: list[Window]) -> None:
+    """ウィンドウごとに Step1・Step4 を再計算し、既存の出力 GeoTIFF を書き換える"""
+
+    io = config.io
+    p = config.params
+    lc = config.landcover
+    out = config.output
+
+    with rasterio.open(io.ref_raster) as src:
+        transform = src.transform
+        shape = (src.height, src.width)
+
+    pixel_size = (transform.a - transform.e) / 2.0
+    halo = int(math.ceil(max(p.risk_radii_m) / pixel_size))
+
+    risk_tifs = highrisk_output_paths(io, p.risk_radii_m)
+    multiband = len(risk_tifs) != len(p.risk_radii_m)
+
+    with ExitStack() as stack:
+        dem_src = stack.enter_context(rasterio.open(io.dem_tif))
+        if (dem_src.height, dem_src.width) != shape:
+            raise ValueError(f"DEM grid {dem_src.shape} does not match buildings {shape}")
+
+        risk_dsts = [stack.enter_context(update_raster(path, out)) for path in risk_tifs]
+
+        landcover_src, lut, score_dsts = None, None, []
+        if lc.enabled:
+            landcover_src = stack.enter_context(rasterio.open(lc.landcover_tif))
+            lut = landcover_lut(lc.weights, lc.default_weight, landcover_src.nodata, landcover_src.dtypes[0])
+            score_dsts = [
+                stack.enter_context(update_raster(path, out))
+                for path in highrisk_score_paths(io, lc, p.risk_radii_m)
+            ]
+
+        bld_dst = None
+        if config.options.persist_intermediates:
+            bld_dst = stack.enter_context(update_raster(io.bld_bin_tif, out))
+
+        for i, win in enumerate(windows, start=1):
+            _, house, risk_stack, score_stack = highrisk_window(
+                win, halo, dem_src, gdf, transform, p, landcover_src, lut
+            )
+            for dsts, arr in ((risk_dsts, risk_stack), (score_dsts, score_stack)):
+                if not dsts:
+                    continue
+                if multiband:
+                    dsts[0].write(arr, window=win)
+                else:
+                    for dst, band in zip(dsts, arr):
+                        dst.write(band, 1, window=win)
+            if bld_dst is not None:
+                bld_dst.write(house, 1, window=win)
+
+        print(f"[Incremental] patched {len(windows)} windows (halo={halo}px)")
+
+    for path in risk_tifs:
+        print("[Step4] ✅ patched:", path)
+
+
+def run_pipeline_incremental(config: Config) -> None:
+    """前回実行時から変わった建物の周辺だけ Step1・Step4 を再計算する
+
+    DEM・パラメータ・出力先が前回と同じで、出力がそろっている場合にだけ差分更新する。
+    それ以外は全体を計算し直して、今回の建物の状態を保存する。
+    Step5（建物ごとの表）は全件を作り直す（傾斜はキャッシュから読む）。
+    """
+
+    io = config.io
+    p = config.params
+
+    with rasterio.open(io.ref_raster) as src:
+        transform = src.transform
+        crs = src.crs
+        shape = (src.height, src.width)
+
+    step_cache = open_step_cache(config.cache)
+    gdf = load_buildings(io.poly_file, crs, keep_fid=True)
+    new_state = building_state(gdf, incremental_signature(config, step_cache))
+    old_state = load_state(incremental_state_path(config))
+
+    full = replace(config, options=replace(config.options, incremental=False))
+    if (
+        old_state is None
+        or old_state["signature"] != new_state["signature"]
+        or not all(path.exists() for path in incremental_outputs(config))
+    ):
+        print("[Incremental] no matching previous run: computing everything")
+        run_pipeline(full)
+        save_state(incremental_state_path(config), new_state)
+        return
+
+    diff = diff_buildings(old_state, new_state)
+    print(
+        f"[Incremental] buildings added={len(diff.added)}, "
+        f"removed={len(diff.removed)}, changed={len(diff.changed)}"
+    )
+    if diff.empty:
+        print("[Incremental] no building changes: outputs are up to date")
+        return
+
+    patch_highrisk_windows(config, gdf, dirty_windows(diff.dirty_bounds, transform, shape))
+
+    if io.bld_risk_gpkg:
+        keys = step_cache_keys(full, step_cache)
+        slope, slope_profile = step_cache.get_or_compute(
+            keys["step2"], lambda: compute_slope_array(io.dem_tif, p.slope_dtype)
+        )
+        slope_bin = binarize_slope_array(slope, slope_profile["nodata"], p.slope_threshold)
+        out = building_risk_gdf(
+            gdf, transform, slope, slope_profile["nodata"], slope_bin,
+            p.risk_radius_m, p.risk_radii_m, p.distance_engine,
+        )
+        write_building_risk(io.bld_risk_gpkg, out)
+
+    save_state(incremental_state_path(config), new_state)
 
 
 # ============================
 # パイプライン本体
 # ============================
 
+def open_step_cache(cfg: CacheConfig) -> StepCache:
+    """CacheConfig から StepCache を作る（enabled=False なら素通し）"""
+
+    return StepCache(
+        cfg.cache_dir,
+        max_bytes=int(cfg.max_gb * 1024 ** 3),
+        key_mode=cfg.key_mode,
+        enabled=cfg.enabled,
+    )
+
+
+def step_cache_keys(config: Config, step_cache: StepCache) -> dict[str, str]:
+    """各ステップのキャッシュキー。下流のキーには上流のキーを含める"""
+
+    io = config.io
+    p = config.params
+
+    if not step_cache.enabled:
+        return {"step1": "", "step2": "", "step3": "", "step4": "", "step5": "", "terrain": ""}
+
+    # 出力形式（圧縮・COG）が変わるとキャッシュ済みファイルも変わるので、上流のキーに含める
+    out = asdict(config.output)
+
+    k1 = step_cache.key(
+        "rasterize_buildings",
+        step_cache.fingerprint(io.poly_file),
+        step_cache.fingerprint(io.ref_raster),
+        out,
+    )
+    k2 = step_cache.key("compute_slope", step_cache.fingerprint(io.dem_tif), p.slope_dtype, out)
+    k3 = step_cache.key("binarize_slope", k2, p.slope_threshold)
+    lc = config.landcover
+    lc_key = (
+        [step_cache.fingerprint(lc.landcover_tif), lc.weights, lc.default_weight]
+        if lc.enabled else None
+    )
+    k4 = step_cache.key("compute_highrisk", k1, k3, p.risk_radii_m, p.distance_engine, lc_key)
+    k5 = step_cache.key("building_risk", k1, k2, k3, p.risk_radius_m, p.risk_radii_m, p.distance_engine)
+    t = config.terrain
+    kt = step_cache.key(
+        "compute_terrain", step_cache.fingerprint(io.dem_tif), t.derivatives, len(terrain_output_paths(t)),
+        p.slope_dtype, out,
+    )
+    return {"step1": k1, "step2": k2, "step3": k3, "step4": k4, "step5": k5, "terrain": kt}
+
+
 def run_pipeline(config: Config) -> None:
-    """4 ステップを順に実行するパイプライン"""
+    """Step1〜4（と任意の Step5）を順に実行するパイプライン
+
+    cache.enabled の場合、入力とパラメータが前回と同じステップは実行せず結果を再利用する。
+    options.incremental の場合は、建物レイヤの変更分だけを再計算する。
+    instrumentation.enabled の場合は、ステップごとの時間・メモリ・I/O を記録する。
+    """
+
+    with instrumented_run(config.instrumentation, "slope_risk"):
+        if config.options.incremental:
+            with step("incremental", grid_pixels(config.io.ref_raster)):
+                run_pipeline_incremental(config)
+        elif config.params.block_size:
+            run_pipeline_blocked(config)
+        else:
+            run_pipeline_in_memory(config)
+
+
+def grid_pixels(ref_raster: Path) -> int:
+    """参照ラスタの画素数（スループットの計算用）"""
+
+    with rasterio.open(ref_raster) as src:
+        return src.width * src.height
+
+
+def run_terrain(config: Config, step_cache: StepCache, keys: dict[str, str], n_px: int) -> None:
+    """terrain.derivatives が指定されていれば、地形量をまとめて書き出す（DEM だけに依存する）"""
+
+    t = config.terrain
+    if not t.derivatives:
+        return
+    p = config.params
+    with step("terrain", n_px):
+        step_cache.get_or_produce_files(
+            keys["terrain"], terrain_output_paths(t),
+            lambda: compute_terrain(config.io.dem_tif, t, p.block_size, config.output, p.slope_dtype),
+        )
+
+
+def run_pipeline_blocked(config: Config) -> None:
+    """Step1・2 をブロック単位で処理するパイプライン
+
+    ブロック処理は DEM 全体をメモリに載せない前提なので、ステップ間はファイル経由で受け渡す。
+    """
 
     io = config.io
     p = config.params
+    out = config.output
+    lc = config.landcover
+    n_px = grid_pixels(io.ref_raster)
+
+    step_cache = open_step_cache(config.cache)
+    keys = step_cache_keys(config, step_cache)
+
+    with step("step1", n_px):
+        step_cache.get_or_produce_file(
+            keys["step1"], io.bld_bin_tif,
+            lambda: rasterize_buildings(io.poly_file, io.ref_raster, io.bld_bin_tif, out, p.block_size),
+        )
+    with step("step2", n_px):
+        step_cache.get_or_produce_file(
+            keys["step2"], io.slope_deg_tif,
+            lambda: compute_slope(io.dem_tif, io.slope_deg_tif, p.block_size, out, p.slope_dtype),
+        )
+    run_terrain(config, step_cache, keys, n_px)
+    with step("step3", n_px):
+        step_cache.get_or_produce_file(
+            keys["step3"], io.slope_bin_tif,
+            lambda: binarize_slope(io.slope_deg_tif, p.slope_threshold, io.slope_bin_tif, out),
+        )
+    risk_tifs = highrisk_output_paths(io, p.risk_radii_m)
+    score_tifs = highrisk_score_paths(io, lc, p.risk_radii_m) if lc.enabled else []
+    with step("step4", n_px):
+        step_cache.get_or_produce_files(
+            keys["step4"], risk_tifs + score_tifs,
+            lambda: compute_highrisk_sweep(
+                io.bld_bin_tif, io.slope_bin_tif, p.risk_radii_m, risk_tifs, p.distance_engine, out,
+                lc, score_tifs,
+            ),
+        )
+    if io.bld_risk_gpkg:
+        with step("step5", n_px):
+            step_cache.get_or_produce_file(
+                keys["step5"], io.bld_risk_gpkg,
+                lambda: export_building_risk(
+                    io.poly_file, io.ref_raster, io.slope_deg_tif, io.slope_bin_tif,
+                    p.risk_radius_m, p.risk_radii_m, io.bld_risk_gpkg, p.distance_engine,
+                ),
+            )
+
+
+def run_pipeline_in_memory(config: Config) -> None:
+    """Step1〜5 の間を配列で受け渡すパイプライン
+
+    中間ラスタは options.persist_intermediates が True の場合のみ書き出す。
+    各ステップは必要になったときにだけ計算（またはキャッシュから読み込み）する。
+    """
 
-    rasterize_buildings(io.poly_file, io.ref_raster, io.bld_bin_tif)
-    compute_slope(io.dem_tif, io.slope_deg_tif)
-    binarize_slope(io.slope_deg_tif, p.slope_threshold, io.slope_bin_tif)
-    compute_highrisk(io.bld_bin_tif, io.slope_bin_tif, p.risk_radius_m, io.bld_risk_tif)
+    io = config.io
+    p = config.params
+    persist = config.options.persist_intermediates
+    out = config.output
+    lc = config.landcover
+    n_px = grid_pixels(io.ref_raster)
+
+    step_cache = open_step_cache(config.cache)
+    keys = step_cache_keys(config, step_cache)
+
+    @cache
+    def step1() -> tuple[np.ndarray, dict]:
+        with step("step1", n_px):
+            return step_cache.get_or_compute(
+                keys["step1"], lambda: rasterize_buildings_array(io.poly_file, io.ref_raster)
+            )
+
+    @cache
+    def step2() -> tuple[np.ndarray, dict]:
+        with step("step2", n_px):
+            return step_cache.get_or_compute(
+                keys["step2"], lambda: compute_slope_array(io.dem_tif, p.slope_dtype)
+            )
+
+    @cache
+    def step3() -> tuple[np.ndarray, dict]:
+        def compute():
+            slope, slope_profile = step2()
+            binary = binarize_slope_array(slope, slope_profile["nodata"], p.slope_threshold)
+            return binary, binary_slope_profile(slope_profile)
+
+        with step("step3", n_px):
+            return step_cache.get_or_compute(keys["step3"], compute)
+
+    def step4() -> tuple[np.ndarray, np.ndarray | None, dict]:
+        house, house_profile = step1()
+        slope_bin, _ = step3()
+        if lc.enabled:
+            # 土地被覆の重み付けは、距離探索と同じパスで行う
+            landcover, lut = read_landcover_lut(lc)
+            risk_stack, score_stack = compute_highrisk_score_stack(
+                house, slope_bin, landcover, lut, house_profile["transform"], p.risk_radii_m, p.distance_engine
+            )
+            return risk_stack, score_stack, house_profile
+
+        risk_stack = compute_highrisk_stack(
+            house, slope_bin, house_profile["transform"], p.risk_radii_m, p.distance_engine
+        )
+        return risk_stack, None, house_profile
+
+    def step5() -> gpd.GeoDataFrame:
+        _, house_profile = step1()
+        slope, slope_profile = step2()
+        slope_bin, _ = step3()
+        gdf = load_buildings(io.poly_file, house_profile["crs"])
+        return building_risk_gdf(
+            gdf, house_profile["transform"], slope, slope_profile["nodata"], slope_bin,
+            p.risk_radius_m, p.risk_radii_m, p.distance_engine,
+        )
+
+    if persist:
+        bld = step1()
+        slope = step2()
+        slope_bin = step3()
+        # 書き出しの時間は計算と分けて記録する
+        with step("write_intermediates", n_px):
+            write_raster(io.bld_bin_tif, *bld, options=out, mask=True)
+            print("[Step1] ✅ exported:", io.bld_bin_tif)
+            write_raster(io.slope_deg_tif, *slope, options=out)
+            print("[Step2] ✅ slope raster exported:", io.slope_deg_tif)
+            write_raster(io.slope_bin_tif, *slope_bin, options=out, mask=True)
+            print("[Step3] ✅ binary slope raster exported:", io.slope_bin_tif)
+        del bld, slope, slope_bin
+
+    run_terrain(config, step_cache, keys, n_px)
+
+    # Step5（任意）: 建物ごとのリスク属性
+    if io.bld_risk_gpkg:
+        with step("step5", n_px):
+            write_building_risk(io.bld_risk_gpkg, step_cache.get_or_compute(keys["step5"], step5))
+
+    # 傾斜角配列は Step4 では不要なので手放す
+    step2.cache_clear()
+
+    with step("step4", n_px):
+        risk_stack, score_stack, house_profile = step_cache.get_or_compute(keys["step4"], step4)
+        write_highrisk(
+            highrisk_output_paths(io, p.risk_radii_m), risk_stack, highrisk_profile(house_profile),
+            p.risk_radii_m, out,
+        )
+        if score_stack is not None:
+            write_highrisk_score(
+                highrisk_score_paths(io, lc, p.risk_radii_m), score_stack, highrisk_score_profile(house_profile),
+                p.risk_radii_m, out,
+            )
 
 
 if __name__ == "__main__":
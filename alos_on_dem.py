@@ -1,76 +1,132 @@
-import rioxarray as rxr
-import xarray as xr
-from rasterio.enums import Resampling
-from pathlib import Path
-from rasterio.warp import reproject
-import numpy as np
-
-
-dem = rxr.open_rasterio(
-    "地理院DEM\DEM_Nobeoka25_493105.tif",
-    masked=True
-).squeeze()
-
-alos = rxr.open_rasterio(
-    "Jaxa_alos\\2024JPN_v25.04\\LC_N32E131.tif",
-    masked=True
-).squeeze()
-
-out_tif = Path(".") / "slope_analysis" / "ALOS_on_DEM_Nobeoka25.tif"
-
-
-# ALOSをまずDEMと同じCRSへ（ここは通常通り）
-alos_6670 = alos.rio.reproject("EPSG:6670", resampling=Resampling.nearest)
-
-# DEMのグリッド定義（ここが核）
-dst_transform = dem.rio.transform()
-dst_crs = dem.rio.crs
-dst_height, dst_width = dem.shape
-
-# 出力配列をDEMと同じ形で用意
-dst = np.full((dst_height, dst_width), np.nan, dtype=alos_6670.dtype)
-
-# rasterioで transform を強制して再投影（カテゴリなので nearest）
-reproject(
-    source=alos_6670.values,
-    destination=dst,
-    src_transform=alos_6670.rio.transform(),
-    src_crs=alos_6670.rio.crs,
-    dst_transform=dst_transform,
-    dst_crs=dst_crs,
-    resampling=Resampling.nearest,
-    src_nodata=alos_6670.rio.nodata,
-    dst_nodata=np.nan
-)
+"""
+ALOS 土地被覆（JAXA, 1°×1° タイル）を DEM のグリッドへ載せる
+- DEM の範囲を覆うソースのウィンドウだけを読む（タイル全体は読まない）
+- DEM の transform / shape へ1回の再投影で直接合わせる（カテゴリなので nearest）
+- 結果は (ソースタイル, 出力グリッド) をキーにディスクへキャッシュし、同じメッシュの再実行では再投影しない
+"""
 
-# xarrayに戻して、DEMと同じ座標を付与
-alos_on_dem = xr.DataArray(
-    dst,
-    dims=("y", "x"),
-    coords={"y": dem["y"], "x": dem["x"]},
-    name="ALOS_LULC_on_DEM"
-).rio.write_crs(dst_crs).rio.write_transform(dst_transform)
-
-# 最終確認（ここがTrueになれば勝ち）
-print("transform equal?:", alos_on_dem.rio.transform() == dem.rio.transform())
-print("bounds equal?:", np.allclose(alos_on_dem.rio.bounds(), dem.rio.bounds()))
-print("shape equal?:", alos_on_dem.shape == dem.shape)
-
-alos_on_dem.rio.to_raster(out_tif)
-
-
-# import matplotlib.pyplot as plt
-
-# fig, ax = plt.subplots(figsize=(7, 7))
-
-# # 下地：DEM（グレー）
-# dem.plot(ax=ax, cmap="gray", add_colorbar=False)
-
-# # 上：ALOS（カテゴリなので colormap は後で変える。まずは半透明で確認）
-# alos_on_dem.plot(ax=ax, alpha=0.6, add_colorbar=False)
-
-# ax.set_aspect("equal")
-# ax.set_title("DEM + ALOS LULC (overlay)")
-# plt.show()
+from pathlib import Path
 
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window, from_bounds
+
+from raster_io import write_raster
+from step_cache import StepCache
+
+
+# ウィンドウの外周に足す余白（px）。再投影で端のセルが欠けないようにする
+WINDOW_MARGIN = 2
+
+
+def dem_grid(dem_tif: Path) -> dict:
+    """DEM の出力グリッド（crs / transform / shape）を返す"""
+
+    with rasterio.open(dem_tif) as src:
+        return dict(crs=src.crs, transform=src.transform, width=src.width, height=src.height)
+
+
+def source_window(src, grid: dict, margin: int = WINDOW_MARGIN) -> Window:
+    """出力グリッドの範囲を覆うソースのウィンドウ（整数画素に丸め、データセット内に収める）"""
+
+    bounds = rasterio.transform.array_bounds(grid["height"], grid["width"], grid["transform"])
+    left, bottom, right, top = transform_bounds(grid["crs"], src.crs, *bounds, densify_pts=21)
+
+    win = from_bounds(left, bottom, right, top, transform=src.transform)
+    col0 = max(int(np.floor(win.col_off)) - margin, 0)
+    row0 = max(int(np.floor(win.row_off)) - margin, 0)
+    col1 = min(int(np.ceil(win.col_off + win.width)) + margin, src.width)
+    row1 = min(int(np.ceil(win.row_off + win.height)) + margin, src.height)
+
+    if col1 <= col0 or row1 <= row0:
+        raise ValueError("source tile does not overlap the target grid")
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def reproject_to_grid(src_tif: Path, grid: dict) -> tuple[np.ndarray, dict]:
+    """ソースの必要なウィンドウだけを読み、出力グリッドへ nearest で直接再投影する"""
+
+    with rasterio.open(src_tif) as src:
+        win = source_window(src, grid)
+        data = src.read(1, window=win)
+        src_transform = src.window_transform(win)
+        src_crs = src.crs
+        nodata = src.nodata if src.nodata is not None else 0
+        dtype = src.dtypes[0]
+
+    print(f"[ALOS] source window: {win.width} x {win.height} px (col={win.col_off}, row={win.row_off})")
+
+    dst = np.full((grid["height"], grid["width"]), nodata, dtype=dtype)
+    reproject(
+        source=data,
+        destination=dst,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        dst_transform=grid["transform"],
+        dst_crs=grid["crs"],
+        resampling=Resampling.nearest,
+        src_nodata=nodata,
+        dst_nodata=nodata,
+    )
+
+    profile = dict(
+        driver="GTiff",
+        height=grid["height"],
+        width=grid["width"],
+        count=1,
+        dtype=dtype,
+        crs=grid["crs"],
+        transform=grid["transform"],
+        nodata=nodata,
+    )
+    return dst, profile
+
+
+def alos_on_dem_array(
+    alos_tif: Path,
+    dem_tif: Path,
+    step_cache: StepCache | None = None,
+) -> tuple[np.ndarray, dict]:
+    """ALOS 土地被覆を DEM のグリッドに載せた配列と profile を返す（キャッシュ付き）"""
+
+    grid = dem_grid(dem_tif)
+    if step_cache is None:
+        return reproject_to_grid(alos_tif, grid)
+
+    # 出力は DEM の値ではなくグリッドだけで決まるので、DEM ファイルではなくグリッドをキーにする
+    key = step_cache.key(
+        "alos_on_dem",
+        step_cache.fingerprint(alos_tif),
+        grid["crs"].to_wkt(),
+        tuple(grid["transform"]),
+        grid["height"],
+        grid["width"],
+    )
+    return step_cache.get_or_compute(key, lambda: reproject_to_grid(alos_tif, grid))
+
+
+def alos_on_dem(
+    alos_tif: Path,
+    dem_tif: Path,
+    out_tif: Path,
+    step_cache: StepCache | None = None,
+) -> Path:
+    """ALOS 土地被覆を DEM のグリッドに載せて GeoTIFF に書き出す"""
+
+    lc, profile = alos_on_dem_array(alos_tif, dem_tif, step_cache)
+
+    write_raster(out_tif, lc, profile)
+    print("[ALOS] ✅ exported:", out_tif)
+    return out_tif
+
+
+if __name__ == "__main__":
+    alos_on_dem(
+        alos_tif=Path("Jaxa_alos") / "2024JPN_v25.04" / "LC_N32E131.tif",
+        dem_tif=Path("地理院DEM") / "DEM_Nobeoka25_493105.tif",
+        out_tif=Path(".") / "slope_analysis" / "ALOS_on_DEM_Nobeoka25.tif",
+        step_cache=StepCache(Path(".cache") / "alos_on_dem", max_bytes=1024 ** 3),
+    )
 
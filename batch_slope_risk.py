@@ -0,0 +1,319 @@
+"""
+複数 DEM タイル（地理院メッシュ）をまとめて処理するバッチランナー
+- DEM タイル群 → VRT モザイク
+- タイルごとに、隣接タイルからハロー分の画素を読み足して Step1〜4 を実行（DEM_to_slope_risk_PL.highrisk_window）
+- ProcessPoolExecutor で並列処理し、結果を1枚の GeoTIFF に継ぎ目なく書き込む
+
+ハローは「傾斜計算の1画素 + 危険斜面の探索半径」なので、
+タイル境界の結果はモザイク全体を一括処理した場合と一致する。
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from glob import glob
+from pathlib import Path
+from xml.sax.saxutils import escape
+import math
+import time
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+import yaml
+
+from DEM_to_slope_risk_PL import (
+    Params,
+    highrisk_window,
+    params_from_dict,
+    radius_label,
+    radius_output_paths,
+)
+from raster_io import RasterWriteOptions, open_raster, write_options_from_dict
+
+
+# ============================
+# dataclass による設定管理
+# ============================
+
+@dataclass
+class BatchConfig:
+    """バッチ処理の設定"""
+
+    dem_tiles: str              # DEM タイルのディレクトリ or glob（例: "QGIS/地理院DEM/*.tif"）
+    mosaic_vrt: Path            # 作成する VRT モザイク
+    poly_file: Path             # 建物ポリゴン
+    bld_risk_tif: str           # {risk_radius_m} を含む出力テンプレート
+    params: Params
+    bld_risk_multiband: bool = False
+    slope_deg_tif: Path | None = None  # 傾斜角モザイクも出力する場合
+    workers: int = 4
+    output: RasterWriteOptions = field(default_factory=RasterWriteOptions)
+
+
+def load_batch_config_from_yaml(yaml_path: Path) -> BatchConfig:
+    with open(yaml_path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+
+    b = data["batch"]
+    return BatchConfig(
+        dem_tiles=str(b["dem_tiles"]),
+        mosaic_vrt=Path(b["mosaic_vrt"]),
+        poly_file=Path(b["poly_file"]),
+        bld_risk_tif=str(b["bld_risk_tif"]),
+        params=params_from_dict(data["params"]),
+        bld_risk_multiband=bool(b.get("bld_risk_multiband", False)),
+        slope_deg_tif=Path(b["slope_deg_tif"]) if b.get("slope_deg_tif") else None,
+        workers=int(b.get("workers", 4)),
+        output=write_options_from_dict(data.get("output")),
+    )
+
+
+# ============================
+# DEM タイル → VRT モザイク
+# ============================
+
+_GDAL_TYPES = {
+    "uint8": "Byte",
+    "int16": "Int16",
+    "uint16": "UInt16",
+    "int32": "Int32",
+    "uint32": "UInt32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def find_dem_tiles(dem_tiles: str) -> list[Path]:
+    """ディレクトリなら *.tif、それ以外は glob として DEM タイルを列挙する"""
+
+    p = Path(dem_tiles)
+    if p.is_dir():
+        tiles = sorted(p.glob("*.tif"))
+    else:
+        tiles = sorted(Path(t) for t in glob(dem_tiles))
+
+    if not tiles:
+        raise FileNotFoundError(f"no DEM tiles found: {dem_tiles}")
+    return tiles
+
+
+def build_vrt(tiles: list[Path], out_vrt: Path) -> list[tuple[Path, Window]]:
+    """同一 CRS・同一解像度の DEM タイルから VRT モザイクを作る
+
+    Returns:
+        各タイルと、モザイク上でのウィンドウの組
+    """
+
+    metas = []
+    for tile in tiles:
+        with rasterio.open(tile) as src:
+            metas.append((tile, src.transform, src.width, src.height, src.crs, src.dtypes[0], src.nodata))
+
+    _, t0, _, _, crs, dtype, nodata = metas[0]
+    res_x, res_y = t0.a, -t0.e
+
+    for tile, t, _, _, c, d, _ in metas:
+        if c != crs:
+            raise ValueError(f"CRS mismatch: {tile} ({c} != {crs})")
+        if not (math.isclose(t.a, res_x, rel_tol=1e-6) and math.isclose(-t.e, res_y, rel_tol=1e-6)):
+            raise ValueError(f"resolution mismatch: {tile} ({t.a}, {-t.e}) != ({res_x}, {res_y})")
+        if d != dtype:
+            raise ValueError(f"dtype mismatch: {tile} ({d} != {dtype})")
+
+    minx = min(t.c for _, t, *_ in metas)
+    maxy = max(t.f for _, t, *_ in metas)
+    maxx = max(t.c + w * t.a for _, t, w, *_ in metas)
+    miny = min(t.f + h * t.e for _, t, _, h, *_ in metas)
+
+    width = int(round((maxx - minx) / res_x))
+    height = int(round((maxy - miny) / res_y))
+
+    sources = []
+    windows = []
+    for tile, t, w, h, *_ in metas:
+        xoff = (t.c - minx) / res_x
+        yoff = (maxy - t.f) / res_y
+        if abs(xoff - round(xoff)) > 0.01 or abs(yoff - round(yoff)) > 0.01:
+            raise ValueError(f"tile is not aligned to the mosaic grid (warp it first): {tile}")
+        xoff, yoff = int(round(xoff)), int(round(yoff))
+        windows.append((tile, Window(xoff, yoff, w, h)))
+
+        nodata_xml = f"<NODATA>{nodata}</NODATA>" if nodata is not None else ""
+        sources.append(f"""    <ComplexSource>
+      <SourceFilename relativeToVRT="0">{escape(str(tile.resolve()))}</SourceFilename>
+      <SourceBand>1</SourceBand>
+      <SrcRect xOff="0" yOff="0" xSize="{w}" ySize="{h}"/>
+      <DstRect xOff="{xoff}" yOff="{yoff}" xSize="{w}" ySize="{h}"/>
+      {nodata_xml}
+    </ComplexSource>""")
+
+    nodata_band = f"    <NoDataValue>{nodata}</NoDataValue>\n" if nodata is not None else ""
+    vrt = f"""<VRTDataset rasterXSize="{width}" rasterYSize="{height}">
+  <SRS>{escape(crs.to_wkt())}</SRS>
+  <GeoTransform>{minx!r}, {res_x!r}, 0.0, {maxy!r}, 0.0, {-res_y!r}</GeoTransform>
+  <VRTRasterBand dataType="{_GDAL_TYPES[dtype]}" band="1">
+{nodata_band}{chr(10).join(sources)}
+  </VRTRasterBand>
+</VRTDataset>
+"""
+
+    out_vrt.parent.mkdir(parents=True, exist_ok=True)
+    out_vrt.write_text(vrt, encoding="utf-8")
+    print(f"[Batch] VRT mosaic: {out_vrt} ({width} x {height}, {len(tiles)} tiles)")
+    return windows
+
+
+# ============================
+# タイル単位の処理（ワーカープロセス）
+# ============================
+
+@dataclass
+class TileTask:
+    """ワーカーに渡す1タイル分の仕事（pickle できる値だけを持つ）"""
+
+    name: str
+    vrt: str
+    window: tuple[int, int, int, int]   # (col_off, row_off, width, height)
+    halo: int                           # 危険斜面の探索半径（px）
+    poly_file: str
+    poly_crs: str
+    params: Params
+
+
+def process_tile(task: TileTask) -> tuple[TileTask, np.ndarray, np.ndarray]:
+    """1タイル分の Step1〜4 をハロー付きで実行し、タイル内部の傾斜角とリスクを返す
+
+    計算は DEM_to_slope_risk_PL.highrisk_window（差分更新と同じ処理）に任せ、
+    ここではハロー込みの範囲にかかる建物だけをファイルから読む。
+    """
+
+    col0, row0, w, h = task.window
+    halo = task.halo
+
+    with rasterio.open(task.vrt) as src:
+        transform = src.transform
+        crs = src.crs
+        nodata = src.nodata
+
+        win_transform = transform * transform.translation(col0 - halo, row0 - halo)
+        bounds = rasterio.transform.array_bounds(h + 2 * halo, w + 2 * halo, win_transform)
+        bbox = transform_bounds(crs, task.poly_crs, *bounds, densify_pts=21)
+
+        gdf = gpd.read_file(task.poly_file, bbox=bbox)
+        gdf = gdf[~gdf.geometry.is_empty & gdf.geometry.notnull()]
+        if len(gdf) and gdf.crs != crs:
+            gdf = gdf.to_crs(crs)
+
+        slope, _, risk, _ = highrisk_window(Window(col0, row0, w, h), halo, src, gdf, transform, task.params)
+
+    if nodata is not None:
+        slope = np.where(np.isnan(slope), np.float32(nodata), slope)
+    return task, slope, risk
+
+
+# ============================
+# バッチ本体
+# ============================
+
+def risk_output_paths(cfg: BatchConfig) -> list[Path]:
+    return radius_output_paths(cfg.bld_risk_tif, cfg.params.risk_radii_m, cfg.bld_risk_multiband)
+
+
+def run_batch(cfg: BatchConfig) -> list[Path]:
+    """DEM タイル群をモザイク化し、タイル並列で傾斜・リスクを計算する"""
+
+    tiles = find_dem_tiles(cfg.dem_tiles)
+    tile_windows = build_vrt(tiles, cfg.mosaic_vrt)
+
+    poly_crs = gpd.read_file(cfg.poly_file, rows=0).crs.to_wkt()
+    radii = cfg.params.risk_radii_m
+
+    with rasterio.open(cfg.mosaic_vrt) as src:
+        profile = src.profile
+        pixel_size = (src.transform.a - src.transform.e) / 2.0
+        nodata = src.nodata
+
+    halo = int(math.ceil(max(radii) / pixel_size))
+    print(f"[Batch] workers={cfg.workers}, halo={halo}px, radii={radii}")
+
+    tasks = [
+        TileTask(
+            name=tile.name,
+            vrt=str(cfg.mosaic_vrt),
+            window=(int(win.col_off), int(win.row_off), int(win.width), int(win.height)),
+            halo=halo,
+            poly_file=str(cfg.poly_file),
+            poly_crs=poly_crs,
+            params=cfg.params,
+        )
+        for tile, win in tile_windows
+    ]
+
+    # 出力（COG）を先に開いておき、結果をウィンドウ単位で書き込む
+    base = dict(
+        width=profile["width"],
+        height=profile["height"],
+        crs=profile["crs"],
+        transform=profile["transform"],
+    )
+    out_paths = risk_output_paths(cfg)
+    multiband = len(out_paths) == 1 and len(radii) > 1
+
+    t0 = time.perf_counter()
+    with ExitStack() as stack:
+        risk_dsts = [
+            stack.enter_context(open_raster(
+                p,
+                dict(base, dtype=rasterio.uint8, nodata=0, count=len(radii) if multiband else 1),
+                cfg.output,
+                mask=True,
+            ))
+            for p in out_paths
+        ]
+        if multiband:
+            for i, r in enumerate(radii, start=1):
+                risk_dsts[0].set_band_description(i, f"highrisk_{radius_label(r)}m")
+
+        slope_dst = None
+        if cfg.slope_deg_tif:
+            slope_dst = stack.enter_context(open_raster(
+                cfg.slope_deg_tif,
+                dict(base, dtype=rasterio.float32, nodata=nodata, count=1),
+                cfg.output,
+            ))
+
+        def write(task: TileTask, slope: np.ndarray, risk: np.ndarray) -> None:
+            win = Window(*task.window)
+            if multiband:
+                risk_dsts[0].write(risk, window=win)
+            else:
+                for dst, band in zip(risk_dsts, risk):
+                    dst.write(band, 1, window=win)
+            if slope_dst is not None:
+                slope_dst.write(slope, 1, window=win)
+
+        if cfg.workers <= 1:
+            results = map(process_tile, tasks)
+            for done, (task, slope, risk) in enumerate(results, start=1):
+                write(task, slope, risk)
+                print(f"[Batch] {done}/{len(tasks)} {task.name} ({time.perf_counter() - t0:.1f}s)")
+        else:
+            with ProcessPoolExecutor(max_workers=cfg.workers) as pool:
+                futures = [pool.submit(process_tile, t) for t in tasks]
+                for done, fut in enumerate(as_completed(futures), start=1):
+                    task, slope, risk = fut.result()
+                    write(task, slope, risk)
+                    print(f"[Batch] {done}/{len(tasks)} {task.name} ({time.perf_counter() - t0:.1f}s)")
+
+    for p in out_paths:
+        print("[Batch] ✅ exported:", p)
+    if cfg.slope_deg_tif:
+        print("[Batch] ✅ exported:", cfg.slope_deg_tif)
+    return out_paths
+
+
+if __name__ == "__main__":
+    run_batch(load_batch_config_from_yaml(Path("config/batch_slope_risk.yaml")))
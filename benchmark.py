@@ -0,0 +1,403 @@
+"""
+パイプラインのベンチマーク（合成データ）
+- 窪地・平坦部を含むフラクタル地形の DEM と、建物ポリゴンを指定サイズ（1k² 〜 16k² セル）で生成する
+- DEM_to_slope_risk_PL の各ステップ（rasterize_buildings / compute_slope / binarize_slope / compute_highrisk）と
+  flow の各ステージ（d8_flow_direction / flow_accumulation）を個別に計測する
+- 1回の計測ごとに新しいプロセスで実行し、処理時間とピークメモリ（tracemalloc / 最大 RSS）を測る
+  前段の出力の作成（前準備）はさらに別のプロセスで行うので、最大 RSS には含まれない
+- 結果は JSON に書き出し、--compare で前回の結果と比べて遅くなったステップを検出する
+
+使い方:
+    python benchmark.py --sizes 1024 2048 4096 --out benchmark_results/current.json
+    python benchmark.py --sizes 1024 2048 --compare benchmark_results/baseline.json
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from dataclasses import asdict, dataclass
+import io
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import shapely
+
+from instrumentation import _max_rss_mb
+
+# 結果ファイルの形式を変えた場合に上げる
+RESULT_VERSION = 1
+
+STEPS = (
+    "rasterize_buildings",
+    "compute_slope",
+    "compute_slope_f32",
+    "binarize_slope",
+    "compute_highrisk",
+    "d8_flow_direction",
+    "flow_accumulation",
+)
+
+# 合成データの設定
+PIXEL_SIZE = 10.0             # m
+TERRAIN_MAX_SPACING = 2048    # 最も粗い起伏の格子間隔（セル）
+TERRAIN_AMPLITUDE_M = 800.0   # 最も粗い起伏の振幅（m）
+HURST = 0.6                   # 細かい起伏ほど小さくする指数（0.6 で 30°以上の斜面が約14%）
+CRS = "EPSG:6670"
+BUILDINGS_PER_MCELL = 500  # 100万セルあたりの建物数
+
+# 計測時のパラメータ
+SLOPE_THRESHOLD = 30.0
+RISK_RADIUS_M = 20.0
+
+
+# ============================
+# 合成データ
+# ============================
+
+def _upsample2(z: np.ndarray) -> np.ndarray:
+    """格子間隔を半分にする（双線形補間, (k, l) → (2k-1, 2l-1)）"""
+
+    k, l = z.shape
+    out = np.empty((2 * k - 1, 2 * l - 1), dtype=np.float32)
+    out[::2, ::2] = z
+    out[1::2, ::2] = (z[:-1] + z[1:]) * np.float32(0.5)
+    out[:, 1::2] = (out[:, :-1:2] + out[:, 2::2]) * np.float32(0.5)
+    return out
+
+
+def fractal_dem(n: int, seed: int = 0) -> np.ndarray:
+    """中点変位法のフラクタル地形（n×n, float32）に窪地と平坦部を加える
+
+    格子間隔 TERRAIN_MAX_SPACING セルから半分ずつ細かくしながら、間隔^HURST に比例する
+    乱数を足していく。起伏の統計はセル単位で決まるので、n を変えても傾斜の分布は変わらない。
+    """
+
+    rng = np.random.default_rng(seed)
+    k = -(-(n - 1) // TERRAIN_MAX_SPACING) + 1  # 細分後に n 以上になる最小の粗い格子
+    dem = rng.random((k, k), dtype=np.float32) * np.float32(TERRAIN_AMPLITUDE_M)
+
+    spacing = TERRAIN_MAX_SPACING
+    while spacing > 1:
+        dem = _upsample2(dem)
+        spacing //= 2
+        if spacing >= 2:
+            amp = TERRAIN_AMPLITUDE_M * (spacing / TERRAIN_MAX_SPACING) ** HURST
+            dem += (rng.random(dem.shape, dtype=np.float32) - np.float32(0.5)) * np.float32(amp)
+    dem = np.ascontiguousarray(dem[:n, :n])
+    dem -= dem.min()
+
+    # 窪地: 周囲より数 m 低い小さな穴（3×3）
+    n_pits = max(n * n // 20000, 1)
+    r = rng.integers(1, n - 2, n_pits)
+    c = rng.integers(1, n - 2, n_pits)
+    depth = rng.uniform(1.0, 5.0, n_pits).astype(np.float32)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            dem[r + dr, c + dc] -= depth
+
+    # 平坦部: 矩形の範囲をその最低標高で平らにする（湛水面・造成地）
+    n_flats = max(n * n // 2_000_000, 1)
+    for _ in range(n_flats):
+        h, w = rng.integers(8, 64, 2)
+        r0, c0 = rng.integers(0, n - h), rng.integers(0, n - w)
+        block = dem[r0:r0 + h, c0:c0 + w]
+        block[:] = block.min()
+
+    return dem
+
+
+def synthetic_buildings(n: int, transform, seed: int = 0) -> gpd.GeoDataFrame:
+    """DEM の範囲に 8〜20 m 角の建物をランダムに置く"""
+
+    rng = np.random.default_rng(seed + 1)
+    count = max(int(n * n / 1e6 * BUILDINGS_PER_MCELL), 1)
+    x0, y1 = transform.c, transform.f
+    extent = n * PIXEL_SIZE
+
+    size = rng.uniform(8.0, 20.0, count)
+    x = x0 + rng.uniform(0, extent - 20.0, count)
+    y = y1 - rng.uniform(20.0, extent, count)
+    return gpd.GeoDataFrame(geometry=shapely.box(x, y, x + size, y + size), crs=CRS)
+
+
+def make_inputs(n: int, work_dir: Path, seed: int = 0) -> dict[str, str]:
+    """サイズ n の DEM（GeoTIFF）と建物（GeoPackage）を作る。既にあれば再利用する"""
+
+    d = Path(work_dir) / f"n{n}_s{seed}"
+    dem_tif, poly_file = d / "dem.tif", d / "buildings.gpkg"
+    if dem_tif.exists() and poly_file.exists():
+        return dict(dem_tif=str(dem_tif), poly_file=str(poly_file), dir=str(d))
+
+    d.mkdir(parents=True, exist_ok=True)
+    transform = from_origin(0.0, n * PIXEL_SIZE, PIXEL_SIZE, PIXEL_SIZE)
+    dem = fractal_dem(n, seed)
+    profile = dict(
+        driver="GTiff", width=n, height=n, count=1, dtype="float32", crs=CRS,
+        transform=transform, nodata=-9999.0, tiled=True, blockxsize=512, blockysize=512,
+        compress="lzw", BIGTIFF="IF_SAFER",
+    )
+    with rasterio.open(dem_tif, "w", **profile) as dst:
+        dst.write(dem, 1)
+    synthetic_buildings(n, transform, seed).to_file(poly_file, driver="GPKG")
+
+    print(f"[Bench] generated inputs: {n} x {n} ({d})")
+    return dict(dem_tif=str(dem_tif), poly_file=str(poly_file), dir=str(d))
+
+
+# ============================
+# 計測
+# ============================
+
+@dataclass
+class BenchResult:
+    step: str
+    size: int
+    cells: int
+    seconds: float
+    py_peak_mb: float         # tracemalloc のピーク（NumPy 配列を含む Python 側の確保）
+    max_rss_mb: float | None  # プロセスの最大 RSS（GDAL 内部のバッファも含む）
+
+
+def _run_step(step: str, inputs: dict[str, str]) -> None:
+    """step を1回実行する。前段の出力が必要なステップは、計測の外で用意しておく"""
+
+    import DEM_to_slope_risk_PL as pl
+    import flow
+
+    d = Path(inputs["dir"])
+    dem_tif = Path(inputs["dem_tif"])
+
+    if step == "rasterize_buildings":
+        pl.rasterize_buildings(Path(inputs["poly_file"]), dem_tif, d / "bld_bin.tif")
+    elif step == "compute_slope":
+        pl.compute_slope(dem_tif, d / "slope_deg.tif")
+    elif step == "compute_slope_f32":
+        pl.compute_slope(dem_tif, d / "slope_deg_f32.tif", slope_dtype="float32")
+    elif step == "binarize_slope":
+        pl.binarize_slope(d / "slope_deg.tif", SLOPE_THRESHOLD, d / "slope_bin.tif")
+    elif step == "compute_highrisk":
+        pl.compute_highrisk(d / "bld_bin.tif", d / "slope_bin.tif", RISK_RADIUS_M, d / "highrisk.tif")
+    elif step in ("d8_flow_direction", "flow_accumulation"):
+        dem, nodata_mask = inputs["_dem"], inputs["_nodata_mask"]
+        if step == "d8_flow_direction":
+            flow.d8_flow_direction(dem, nodata_mask)
+        else:
+            flow.flow_accumulation(inputs["_fdir"], nodata_mask)
+    else:
+        raise ValueError(f"unknown step: {step} (choose from {STEPS})")
+
+
+def _prepare_step(step: str, inputs: dict[str, str]) -> dict[str, str]:
+    """計測の前準備（前段の出力をファイルに作る）
+
+    run_benchmarks が measure とは別のプロセスで実行するので、前準備の時間・メモリは計測に含まれない。
+    """
+
+    import DEM_to_slope_risk_PL as pl
+    import flow
+
+    d = Path(inputs["dir"])
+    dem_tif = Path(inputs["dem_tif"])
+    inputs = dict(inputs)
+
+    if step == "binarize_slope" and not (d / "slope_deg.tif").exists():
+        pl.compute_slope(dem_tif, d / "slope_deg.tif")
+    if step == "compute_highrisk":
+        if not (d / "bld_bin.tif").exists():
+            pl.rasterize_buildings(Path(inputs["poly_file"]), dem_tif, d / "bld_bin.tif")
+        if not (d / "slope_bin.tif").exists():
+            _prepare_step("binarize_slope", inputs)
+            pl.binarize_slope(d / "slope_deg.tif", SLOPE_THRESHOLD, d / "slope_bin.tif")
+
+    if step == "flow_accumulation":
+        fdir_npy = d / "fdir_d8.npy"
+        if not fdir_npy.exists():
+            dem, nodata_mask = _read_dem(dem_tif)
+            np.save(fdir_npy, flow.d8_flow_direction(dem, nodata_mask))
+        inputs["fdir_npy"] = str(fdir_npy)
+
+    return inputs
+
+
+def _read_dem(dem_tif: Path) -> tuple[np.ndarray, np.ndarray]:
+    with rasterio.open(dem_tif) as src:
+        dem = src.read(1)
+        nodata_mask = dem == src.nodata
+    return dem, nodata_mask
+
+
+def _load_step_arrays(step: str, inputs: dict[str, str]) -> dict:
+    """配列を直接受け取るステップ（flow）の入力を読み込む。読み込み分は最大 RSS に含まれる"""
+
+    inputs = dict(inputs)
+    if step in ("d8_flow_direction", "flow_accumulation"):
+        # 窪地埋めは計測対象外（合成 DEM の窪地・平坦部はそのまま D8 に渡す）
+        inputs["_dem"], inputs["_nodata_mask"] = _read_dem(Path(inputs["dem_tif"]))
+        if step == "flow_accumulation":
+            inputs["_fdir"] = np.load(inputs["fdir_npy"])
+    return inputs
+
+
+def prepare(step: str, inputs: dict[str, str]) -> dict[str, str]:
+    """子プロセス内で step の前準備を行い、measure に渡す inputs を返す"""
+
+    with redirect_stdout(io.StringIO()):
+        return _prepare_step(step, inputs)
+
+
+def measure(step: str, n: int, inputs: dict[str, str], repeat: int = 1) -> BenchResult:
+    """子プロセス内で step を実行し、最短時間とピークメモリを返す
+
+    inputs は _prepare_step で前準備済みのもの（別プロセスで作る）。最大 RSS に含まれるのは
+    インタプリタ・import・ステップの入力配列の読み込みと、ステップ本体だけになる。
+    時間は repeat 回の最短（tracemalloc なし）、メモリは別の1回を tracemalloc 付きで測る
+    （tracemalloc は Python 側の処理を遅くするため）。
+    """
+
+    with redirect_stdout(io.StringIO()):
+        inputs = _load_step_arrays(step, inputs)
+
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            _run_step(step, inputs)
+            best = min(best, time.perf_counter() - t0)
+
+        tracemalloc.start()
+        _run_step(step, inputs)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    rss = _max_rss_mb()
+    return BenchResult(
+        step=step,
+        size=n,
+        cells=n * n,
+        seconds=round(best, 4),
+        py_peak_mb=round(peak / 2 ** 20, 1),
+        max_rss_mb=round(rss, 1) if rss is not None else None,
+    )
+
+
+def run_benchmarks(
+    sizes: list[int],
+    steps: list[str],
+    work_dir: Path,
+    repeat: int = 1,
+    seed: int = 0,
+) -> list[BenchResult]:
+    """サイズ × ステップごとに新しいプロセスで計測する（前の計測のメモリを引き継がない）"""
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for n in sizes:
+        inputs = make_inputs(n, work_dir, seed)
+        for step in steps:
+            # 前準備と計測はそれぞれ新しいプロセスで（前準備のメモリを計測のプロセスに残さない）
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                step_inputs = pool.submit(prepare, step, inputs).result()
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                res = pool.submit(measure, step, n, step_inputs, repeat).result()
+            results.append(res)
+            rss = f"{res.max_rss_mb:.0f} MB" if res.max_rss_mb is not None else "-"
+            print(f"[Bench] {n:>6} {step:<22} {res.seconds:9.3f} s  py_peak {res.py_peak_mb:8.1f} MB  rss {rss}")
+    return results
+
+
+# ============================
+# 結果の保存・比較
+# ============================
+
+def environment() -> dict:
+    """計測環境（比較時に条件の違いを確認するため）"""
+
+    import flow
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(
+        commit=commit,
+        python=platform.python_version(),
+        numpy=np.__version__,
+        rasterio=rasterio.__version__,
+        gdal=rasterio.__gdal_version__,
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        flow_kernels=flow.KERNEL_BACKEND,
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+
+
+def save_results(out_json: Path, results: list[BenchResult]) -> Path:
+    out_json = Path(out_json)
+    out_json.parent.mkdir(parents=True, exist_ok=True)
+    data = dict(version=RESULT_VERSION, environment=environment(), results=[asdict(r) for r in results])
+    with open(out_json, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    print("[Bench] ✅ exported:", out_json)
+    return out_json
+
+
+def compare_results(baseline_json: Path, results: list[BenchResult], tolerance: float = 0.2) -> list[str]:
+    """前回の結果と比べ、時間かピークメモリが (1 + tolerance) 倍を超えたステップを返す"""
+
+    with open(baseline_json, "r", encoding="utf-8") as f:
+        base = {(r["step"], r["size"]): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for r in results:
+        b = base.get((r.step, r.size))
+        if b is None:
+            continue
+        for key in ("seconds", "py_peak_mb", "max_rss_mb"):
+            old, new = b.get(key), getattr(r, key)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{r.step} n={r.size}: {key} {old} -> {new} ({new / old:.2f}x)")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="slope-risk / flow pipeline benchmarks on synthetic DEMs")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096],
+                    help="DEM の一辺（セル数）。例: 1024 2048 4096 8192 16384")
+    ap.add_argument("--steps", nargs="+", default=list(STEPS), choices=STEPS)
+    ap.add_argument("--repeat", type=int, default=1, help="各ステップの実行回数（最短時間を採用）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--work-dir", type=Path, default=Path(".cache") / "benchmark")
+    ap.add_argument("--out", type=Path, default=Path("benchmark_results") / "latest.json")
+    ap.add_argument("--compare", type=Path, default=None, help="比較する前回の結果（JSON）")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="遅くなったとみなす比率（0.2 = 20%%）")
+    args = ap.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.steps, args.work_dir, args.repeat, args.seed)
+    save_results(args.out, results)
+
+    if args.compare is None:
+        return 0
+    regressions = compare_results(args.compare, results, args.tolerance)
+    for line in regressions:
+        print("[Bench] ⚠ regression:", line)
+    if not regressions:
+        print("[Bench] no regressions against", args.compare)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""
+flow_kernels.pyx（flow.py の逐次処理ループのコンパイル版）をビルドする
+
+使い方（リポジトリ直下で1回実行。Cython・NumPy・C コンパイラが必要）:
+    python build_kernels.py
+
+flow_kernels.*.so（Windows は .pyd）がこのディレクトリにできれば、flow.py が import 時に使う。
+ビルドしない場合は Python 実装のまま動く（結果は同じ）。
+"""
+
+from Cython.Build import cythonize
+import numpy as np
+from setuptools import Extension, setup
+
+
+if __name__ == "__main__":
+    setup(
+        name="flow_kernels",
+        ext_modules=cythonize(
+            [Extension("flow_kernels", ["flow_kernels.pyx"], include_dirs=[np.get_include()])],
+            language_level=3,
+        ),
+        script_args=["build_ext", "--inplace"],
+    )
@@ -0,0 +1,103 @@
+"""
+建物レイヤの差分検出（差分更新用）
+- 建物を GeoPackage の fid とジオメトリ（WKB）のハッシュで識別する
+- 前回実行時の状態（fid → ハッシュ・外接矩形）を JSON に保存し、今回の建物と比較する
+- 追加・削除・変更された建物の外接矩形（変更前と変更後の両方）を返す
+"""
+
+from dataclasses import dataclass, field
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+# 状態ファイルの形式を変えた場合に上げる
+STATE_VERSION = 1
+
+
+@dataclass
+class BuildingDiff:
+    """前回実行時からの建物の差分"""
+
+    added: list[int] = field(default_factory=list)
+    removed: list[int] = field(default_factory=list)
+    changed: list[int] = field(default_factory=list)
+    # 再計算が必要な範囲（変更前・変更後の外接矩形, minx, miny, maxx, maxy）
+    dirty_bounds: list[tuple[float, float, float, float]] = field(default_factory=list)
+
+    @property
+    def empty(self) -> bool:
+        return not (self.added or self.removed or self.changed)
+
+
+def geometry_hashes(geoms: gpd.GeoSeries) -> list[str]:
+    """ジオメトリごとの WKB の SHA-1"""
+
+    wkbs = shapely.to_wkb(np.asarray(geoms.values), hex=False)
+    return [hashlib.sha1(w).hexdigest() for w in wkbs]
+
+
+def building_state(gdf: gpd.GeoDataFrame, signature: str) -> dict:
+    """fid を index に持つ建物から、差分比較用の状態を作る
+
+    signature には建物以外の入力（DEM・パラメータ・出力先など）のキーを入れる。
+    これが前回と違う場合、差分更新はできない。
+    """
+
+    bounds = gdf.geometry.bounds.to_numpy()
+    features = {
+        str(int(fid)): [h, *map(float, b)]
+        for fid, h, b in zip(gdf.index, geometry_hashes(gdf.geometry), bounds)
+    }
+    return {"version": STATE_VERSION, "signature": signature, "features": features}
+
+
+def load_state(path: Path) -> dict | None:
+    """前回の状態を読み込む。ファイルがない・形式が古い場合は None"""
+
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("version") != STATE_VERSION:
+        return None
+    return state
+
+
+def save_state(path: Path, state: dict) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+    return path
+
+
+def diff_buildings(old_state: dict, new_state: dict) -> BuildingDiff:
+    """前回と今回の状態を fid とジオメトリハッシュで比較する"""
+
+    old = old_state["features"]
+    new = new_state["features"]
+
+    diff = BuildingDiff()
+    for fid, (h, *b) in new.items():
+        if fid not in old:
+            diff.added.append(int(fid))
+            diff.dirty_bounds.append(tuple(b))
+        elif old[fid][0] != h:
+            diff.changed.append(int(fid))
+            diff.dirty_bounds.append(tuple(old[fid][1:]))
+            diff.dirty_bounds.append(tuple(b))
+
+    for fid, (_, *b) in old.items():
+        if fid not in new:
+            diff.removed.append(int(fid))
+            diff.dirty_bounds.append(tuple(b))
+
+    return diff
@@ -1,19 +1,25 @@
+from collections import deque
+import heapq
+
 import numpy as np
-import rasterio
 
 # ==========================
 #  DRR Simple Flow (D8)
 # ==========================
 
-# ---- 設定（ここだけ変えればOK） ----
-DEM_TIF = "QGIS/地理院DEM/DEM_Nobeoka25_493105.tif"
-OUT_FLOWDIR = "flow_analysis/flow_dir_d8.tif"
-OUT_ACC = "flow_analysis/flow_acc.tif"
-OUT_STREAMS = "flow_analysis/streams_bin.tif"
+# このモジュールは NumPy の配列演算だけ。GeoTIFF・GeoPackage の入出力と config/flow.yaml（FlowConfig）による
+# 実行は flow_pipeline.py にある（python flow_pipeline.py。従来どおり python flow.py でも同じ処理を実行する）
+
+# 流向モデル: "d8"（単一方向, セル数）/ "dinf"（D-infinity）/ "mfd"（Freeman の多方向流）
+# dinf / mfd は流量を複数の下流セルへ按分し、集水面積を float32（セル数相当）で出力する
+FLOW_METHODS = ("d8", "dinf", "mfd")
 
-# 「流路」とみなす集水面積（セル数）閾値
-# 例：10m DEMなら 1000セル=約0.1km^2
-STREAM_ACC_THRESHOLD = 500
+# mfd の勾配の指数の既定値（Freeman 1991 の推奨値 1.1。大きいほど最急方向へ集中する）
+MFD_EXPONENT = 1.1
+
+# 窪地埋め・上流探索にコンパイル済みカーネル（flow_kernels.pyx）を使うか。
+# 使えない環境（Cython・コンパイラなし）では自動的に Python 実装になる
+USE_COMPILED_KERNELS = True
 
 # -----------------------------------
 # D8方向定義（ESRI/一般のD8とは符号が違うので、ここは自前定義）
@@ -30,8 +36,139 @@ DIRS = [
     (1,  1)    # 8 SE
 ]
 
+# 対角は距離sqrt(2)、直交は1
+DIR_DIST = [1.41421356 if (dr != 0 and dc != 0) else 1.0 for dr, dc in DIRS]
+
+# D-infinity の三角形ファセット（直交方向, 対角方向）の DIRS 上の位置（Tarboton 1997）
+DINF_FACETS = [(0, 1), (2, 1), (2, 3), (4, 3), (4, 5), (6, 5), (6, 7), (0, 7)]
+
+# -----------------------------------
+# コンパイル済みカーネル（import 時に選択）
+# python build_kernels.py でビルドした拡張があればそれを、なければ Python 実装を使う
+# -----------------------------------
+def _load_kernels():
+    if not USE_COMPILED_KERNELS:
+        return None
+    try:
+        import flow_kernels
+    except ImportError as e:
+        print(f"[Flow] compiled kernels not available ({e}); using Python implementations "
+              "(build with: python build_kernels.py)")
+        return None
+    return flow_kernels
+
+_kernels = _load_kernels()
+KERNEL_BACKEND = "cython" if _kernels is not None else "python"
+
+def fill_depressions(dem: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+    """Priority-Flood + ε による窪地埋めと平坦部の解消（Barnes et al., 2014）。
+
+    外周セルと NoData に接するセルを出口として、低い順にヒープから広げていく。
+    窪地・平坦部のセルは親より nextafter 分だけ高くするので、埋めた後の DEM では
+    出口以外の全セルに下り方向の近傍が存在する（D8 のコード0が出口だけになる）。
+
+    メモリ節約のため、ヒープにはフラットインデックスだけを積み、
+    処理済みフラグは1セル1バイトの uint8 ビットマップで持つ。
+    """
+    nrows, ncols = dem.shape
+    pcols = ncols + 2
+
+    # 外周を1セル広げて、近傍の範囲チェックを不要にする
+    z_pad = np.zeros((nrows + 2, pcols), dtype=np.float32)
+    z_pad[1:-1, 1:-1] = dem
+    closed_pad = np.ones((nrows + 2, pcols), dtype=np.uint8)
+    closed_pad[1:-1, 1:-1] = nodata_mask
+    z = z_pad.ravel()
+    closed = closed_pad.ravel()
+
+    # 出口: 有効セルのうち、近傍に範囲外または NoData を持つもの
+    seed = np.zeros((nrows + 2, pcols), dtype=bool)
+    for dr, dc in DIRS:
+        seed[1:-1, 1:-1] |= closed_pad[1 + dr:nrows + 1 + dr, 1 + dc:ncols + 1 + dc] == 1
+    seed &= closed_pad == 0
+    seeds = np.flatnonzero(seed)
+    del seed
+    closed[seeds] = 1
+
+    offsets = np.array([dr * pcols + dc for dr, dc in DIRS], dtype=np.int64)
+    priority_flood = _kernels.priority_flood if _kernels is not None else priority_flood_python
+    priority_flood(z, closed, seeds.astype(np.int64), offsets)
+
+    filled = z_pad[1:-1, 1:-1].copy()
+    filled[nodata_mask] = dem[nodata_mask]
+    return filled
+
+def priority_flood_python(z: np.ndarray, closed: np.ndarray, seeds: np.ndarray, offsets: np.ndarray) -> None:
+    """fill_depressions の本体（Python の参照実装）。z・closed を直接書き換える。
+
+    flow_kernels.priority_flood と同じ引数・同じ結果で、カーネルの検証用。
+    ヒープに (float, int) のタプルを積むのでメモリ効率は悪く、大きな DEM には向かない
+    （カーネルをビルドしていない場合のフォールバックにだけ使う）。
+    ヒープは (z, index) の辞書順なので、取り出し順はヒープの実装によらず一意に決まる。
+    """
+    offsets = offsets.tolist()
+    up = np.float32(np.inf)
+
+    heap = list(zip(z[seeds].tolist(), seeds.tolist()))
+    heapq.heapify(heap)
+    pit = deque()
+
+    while heap or pit:
+        if pit:
+            c = pit.popleft()
+        else:
+            c = heapq.heappop(heap)[1]
+        z_eps = np.nextafter(z[c], up)
+
+        for off in offsets:
+            nb = c + off
+            if closed[nb]:
+                continue
+            closed[nb] = 1
+            zn = z[nb]
+            if zn <= z_eps:
+                # 窪地・平坦部: 親よりわずかに高くして、親へ流れる勾配を作る
+                z[nb] = z_eps
+                pit.append(nb)
+            else:
+                heapq.heappush(heap, (float(zn), nb))
+
 def d8_flow_direction(dem: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
-    """最急降下方向に1..8のコードを付与。流れ先なしは0。"""
+    """最急降下方向に1..8のコードを付与。流れ先なしは0。
+
+    8方向の落差をシフトしたスライスで配列全体に対して計算する。
+    同じ勾配の方向が複数ある場合はコードの小さい方を採用するので、
+    d8_flow_direction_reference と完全に同じ結果になる。
+    """
+    nrows, ncols = dem.shape
+    fdir = np.zeros((nrows, ncols), dtype=np.uint8)
+    if nrows < 3 or ncols < 3:
+        return fdir
+
+    # 外周1セルは対象外（参照実装と同じ）
+    z0 = dem[1:-1, 1:-1]
+    center_nodata = nodata_mask[1:-1, 1:-1]
+
+    best_drop = np.zeros(z0.shape, dtype=np.result_type(dem.dtype, np.float32))
+    best_code = fdir[1:-1, 1:-1]  # view に直接書き込む
+    slope = np.empty_like(best_drop)
+
+    for code, ((dr, dc), dist) in enumerate(zip(DIRS, DIR_DIST), start=1):
+        zn = dem[1 + dr:nrows - 1 + dr, 1 + dc:ncols - 1 + dc]
+        nb_nodata = nodata_mask[1 + dr:nrows - 1 + dr, 1 + dc:ncols - 1 + dc]
+
+        np.subtract(z0, zn, out=slope)  # drop (>0 なら下り)
+        slope /= dist
+        # 下り以外・NoData 近傍は候補外（slope > best_drop >= 0 で判定）
+        better = (slope > best_drop) & ~nb_nodata
+        best_drop[better] = slope[better]
+        best_code[better] = code
+
+    best_code[center_nodata] = 0
+    return fdir
+
+def d8_flow_direction_reference(dem: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+    """セル単位ループによる D8（参照実装）。d8_flow_direction との一致確認用。"""
     nrows, ncols = dem.shape
     fdir = np.zeros((nrows, ncols), dtype=np.uint8)
 
@@ -65,8 +202,420 @@ def d8_flow_direction(dem: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
             fdir[r, c] = best_code  # 0なら流れ先なし
     return fdir
 
+def _index_dtype(n: int):
+    """フラットインデックス用の整数型（通常は int32）"""
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+def _scatter_add(target: np.ndarray, idx: np.ndarray, values) -> None:
+    """target[idx] += values（idx の重複可）。
+
+    大きな前線は bincount（O(n)）、小さな前線は np.add.at（O(len(idx))）で処理する。
+    """
+    if np.isscalar(values):
+        values = target.dtype.type(values)  # 型を揃えないと ufunc.at が低速経路になる
+    if idx.size * 8 > target.size:
+        if np.isscalar(values):
+            add = np.bincount(idx, minlength=target.size) * values
+        else:
+            add = np.bincount(idx, weights=values, minlength=target.size)
+        target += add.astype(target.dtype)
+    else:
+        np.add.at(target, idx, values)
+
+def flow_receivers(fdir: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+    """D8 コードから各セルの流れ先フラットインデックスを作る。流れ先なしは -1。
+
+    範囲外・NoData への流れ先は flow_accumulation_reference と同様に無視する。
+    """
+    nrows, ncols = fdir.shape
+    idx_dtype = _index_dtype(fdir.size)
+    recv = np.full(fdir.size, -1, dtype=idx_dtype)
+    recv2d = recv.reshape(nrows, ncols)
+    index2d = np.arange(fdir.size, dtype=idx_dtype).reshape(nrows, ncols)
+
+    for code, (dr, dc) in enumerate(DIRS, start=1):
+        # 流れ先が範囲内に収まる流出元の範囲
+        r0, r1 = max(0, -dr), nrows - max(0, dr)
+        c0, c1 = max(0, -dc), ncols - max(0, dc)
+        if r0 >= r1 or c0 >= c1:
+            continue
+        src = (slice(r0, r1), slice(c0, c1))
+        dst = (slice(r0 + dr, r1 + dr), slice(c0 + dc, c1 + dc))
+
+        sel = (fdir[src] == code) & ~nodata_mask[src] & ~nodata_mask[dst]
+        recv2d[src][sel] = index2d[dst][sel]
+
+    return recv
+
+def donor_index(recv: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """受け手（recv）の逆引きを CSR 形式で作る。
+
+    Returns:
+        indptr: donors[indptr[i]:indptr[i+1]] がセル i に流れ込むセル（長さ n+1, int64）
+        donors: 流入元セルのフラットインデックス（int64）
+    """
+    n = recv.size
+    src = np.flatnonzero(recv >= 0)
+    dst = recv[src]
+    order = np.argsort(dst, kind="stable")
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(dst, minlength=n), out=indptr[1:])
+    return indptr, src[order].astype(np.int64)
+
+def _csr_positions(indptr: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """CSR で rows の各区間 [indptr[i], indptr[i+1]) を連結した位置を返す"""
+    lo = indptr[rows]
+    cnt = indptr[rows + 1] - lo
+    total = int(cnt.sum())
+    return np.repeat(lo - (np.cumsum(cnt) - cnt), cnt) + np.arange(total, dtype=lo.dtype)
+
+def trace_upstream(indptr: np.ndarray, donors: np.ndarray, starts) -> np.ndarray:
+    """starts（フラットインデックス）の上流セル（starts を含む）を昇順・重複なしで返す。
+
+    一方の起点が他方の上流にあっても、各セルは1回しかたどらない。
+    """
+    starts = np.unique(np.asarray(starts, dtype=np.int64))
+    if _kernels is not None:
+        return _kernels.trace_upstream(indptr, donors, starts)
+    return trace_upstream_python(indptr, donors, starts)
+
+def trace_upstream_python(indptr: np.ndarray, donors: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """trace_upstream の NumPy 実装（flow_kernels.trace_upstream と同じ結果）
+
+    上流側の前線（frontier）を1段ずつまとめて広げる。反復回数は最長の流路長。
+    受け手は各セル1つなので donor の逆引きは森で、重複が出るのは下流の起点から上流の起点に
+    たどり着いたときだけ。その起点を除けばよいので、セル数ぶんの訪問済み配列は作らない
+    （流向が循環していても、循環に届くのは循環上の起点からだけなので、その起点で止まる）。
+    starts は昇順・重複なし（trace_upstream が np.unique する）。
+    """
+    parts = [starts]
+    frontier = starts
+    while frontier.size:
+        pos = _csr_positions(indptr, frontier)
+        if pos.size == 0:
+            break
+        frontier = donors[pos]
+        i = np.searchsorted(starts, frontier)
+        frontier = frontier[starts[np.minimum(i, starts.size - 1)] != frontier]
+        parts.append(frontier)
+    return np.sort(np.concatenate(parts))
+
+def topological_levels(recv: np.ndarray, valid: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """流入数0のセルを前線として剥がしていき、上流→下流のトポロジカル順を作る。
+
+    Returns:
+        order: 有効セルのフラットインデックス（上流から下流の順）
+        level_ptr: order[level_ptr[k]:level_ptr[k+1]] が k 段目の前線
+    """
+    n = recv.size
+    has_recv = recv >= 0
+    indeg = np.bincount(recv[has_recv], minlength=n).astype(np.int32)
+
+    frontier = np.flatnonzero(valid & (indeg == 0)).astype(recv.dtype)
+    levels = []
+    while frontier.size:
+        levels.append(frontier)
+        r = recv[frontier]
+        r = r[r >= 0]
+        _scatter_add(indeg, r, -1)
+        r = r[indeg[r] == 0]
+        # 重複除去（ソートせず、indeg に位置を書き込んで最後の書き込みだけ残す）
+        pos = np.arange(1, r.size + 1, dtype=np.int32)
+        indeg[r] = -pos
+        frontier = r[indeg[r] == -pos]
+
+    sizes = np.fromiter((lv.size for lv in levels), dtype=np.int64, count=len(levels))
+    level_ptr = np.zeros(len(levels) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=level_ptr[1:])
+    order = np.concatenate(levels) if levels else np.empty(0, dtype=recv.dtype)
+    return order, level_ptr
+
 def flow_accumulation(fdir: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
-    """各セルに流入する上流セル数（簡易集水面積）を計算。"""
+    """各セルに流入する上流セル数（簡易集水面積）を計算。
+
+    フラットな流れ先インデックスとトポロジカル段ごとの np.add.at で集計する。
+    結果は flow_accumulation_reference と一致する。
+    """
+    nrows, ncols = fdir.shape
+    acc = np.ones(fdir.size, dtype=np.int32)  # 自分自身を1
+    acc[nodata_mask.ravel()] = 0
+
+    recv = flow_receivers(fdir, nodata_mask)
+    order, level_ptr = topological_levels(recv, ~nodata_mask.ravel())
+
+    # 上流の段から順に、流れ先へ自分の集水面積を足し込む
+    for k in range(level_ptr.size - 1):
+        f = order[level_ptr[k]:level_ptr[k + 1]]
+        r = recv[f]
+        has = r >= 0
+        _scatter_add(acc, r[has], acc[f[has]])
+
+    return acc.reshape(nrows, ncols)
+
+# -----------------------------------
+# 多方向流（D-infinity / MFD）
+# 各セルから8近傍への流量の割合 props[k]（k は DIRS の位置）を配列全体で求め、
+# 割合が正の辺だけで作った DAG のトポロジカル段ごとに按分して足し込む
+# -----------------------------------
+def _neighbor_drops(dem: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+    """中心セルから8近傍への勾配（落差 / 距離, セル単位）。下りでない・NoData・外周は 0。
+
+    Returns:
+        drops: (8, nrows, ncols) float32
+    """
+    nrows, ncols = dem.shape
+    drops = np.zeros((len(DIRS), nrows, ncols), dtype=np.float32)
+    if nrows < 3 or ncols < 3:
+        return drops
+
+    z0 = dem[1:-1, 1:-1]
+    center_nodata = nodata_mask[1:-1, 1:-1]
+    for k, ((dr, dc), dist) in enumerate(zip(DIRS, DIR_DIST)):
+        zn = dem[1 + dr:nrows - 1 + dr, 1 + dc:ncols - 1 + dc]
+        nb_nodata = nodata_mask[1 + dr:nrows - 1 + dr, 1 + dc:ncols - 1 + dc]
+        d = drops[k, 1:-1, 1:-1]
+        np.subtract(z0, zn, out=d, casting="unsafe")
+        d /= np.float32(dist)
+        d[(d <= 0) | nb_nodata | center_nodata] = 0
+    return drops
+
+def mfd_proportions(dem: np.ndarray, nodata_mask: np.ndarray, exponent: float = MFD_EXPONENT) -> np.ndarray:
+    """Freeman (1991) の多方向流: 下りの近傍へ tanβ^p に比例して流量を按分する。
+
+    Returns:
+        props: (8, nrows, ncols) float32。各セルで合計 1（流れ先なしは全て 0）
+    """
+    props = _neighbor_drops(dem, nodata_mask)
+    # tanβ^p = exp(p·log tanβ)（powf より速い。0 は exp(-inf) = 0 のまま）
+    with np.errstate(divide="ignore"):
+        np.log(props, out=props)
+    props *= np.float32(exponent)
+    np.exp(props, out=props)
+    total = props.sum(axis=0)
+    has = total > 0
+    props[:, has] /= total[has]
+    return props
+
+def dinf_proportions(dem: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+    """Tarboton (1997) の D-infinity: 8つの三角形ファセットで最急の流向角を求め、
+    その角を挟む直交・対角の2セルへ角度に応じて按分する。
+
+    ファセットの近傍に NoData がある場合はそのファセットを使わず、
+    使えるファセットがない場合は D8 の最急方向へ全量を流す。
+
+    Returns:
+        props: (8, nrows, ncols) float32。各セルで合計 1（流れ先なしは全て 0）
+    """
+    nrows, ncols = dem.shape
+    props = np.zeros((len(DIRS), nrows, ncols), dtype=np.float32)
+    if nrows < 3 or ncols < 3:
+        return props
+
+    # NoData を NaN にしておけば、NoData を含むファセットの勾配は NaN になり選ばれない
+    work = np.result_type(np.float32, dem.dtype)
+    z = dem.astype(work)
+    z[nodata_mask] = np.nan
+    z0 = z[1:-1, 1:-1].astype(np.float32)
+    nb_z = [z[1 + dr:nrows - 1 + dr, 1 + dc:ncols - 1 + dc] for dr, dc in DIRS]
+
+    # 作業配列はファセットのループの外で一度だけ確保し、シフトしたスライスに out= / where= で書き込む
+    # （ブール添字による取り出し・書き込みはしない）
+    s1 = np.empty(z0.shape, dtype=work)
+    s2 = np.empty_like(s1)
+    s = np.empty_like(s1)
+    diag = np.empty_like(s1)
+    m = np.empty(z0.shape, dtype=bool)
+    better = np.empty(z0.shape, dtype=bool)
+
+    quarter = np.float32(np.pi / 4)
+    best_s = np.zeros(z0.shape, dtype=np.float32)
+    best_f = np.full(z0.shape, -1, dtype=np.int8)
+    best_s1 = np.zeros(z0.shape, dtype=np.float32)
+    best_s2 = np.zeros(z0.shape, dtype=np.float32)
+
+    for f, (k1, k2) in enumerate(DINF_FACETS):
+        # 直交方向の勾配 s1 と、それに直交する（直交→対角の）勾配 s2
+        np.subtract(z0, nb_z[k1], out=s1)
+        np.subtract(nb_z[k1], nb_z[k2], out=s2)
+        # 流向角 r = atan2(s2, s1) がファセットの外なら辺上に寄せる:
+        #   r < 0（s2 < 0）→ 直交方向の勾配, r > π/4（s2 > s1）→ 対角方向の勾配
+        # ファセット内の勾配は sqrt(s1² + s2²)（np.hypot より数倍速い）
+        np.multiply(s1, s1, out=s)
+        np.multiply(s2, s2, out=diag)
+        s += diag
+        np.sqrt(s, out=s)
+        np.less(s2, 0, out=m)
+        np.copyto(s, s1, where=m)
+        np.add(s1, s2, out=diag)
+        diag /= np.float32(DIR_DIST[k2])
+        np.greater(s2, s1, out=m)
+        np.copyto(s, diag, where=m)
+
+        # NaN（NoData を含むファセット）は比較が偽になるので選ばれない
+        np.greater(s, best_s, out=better)
+        np.copyto(best_s, s, where=better, casting="same_kind")
+        np.copyto(best_f, np.int8(f), where=better)
+        np.copyto(best_s1, s1, where=better, casting="same_kind")
+        np.copyto(best_s2, s2, where=better, casting="same_kind")
+    del z, s1, s2, s, diag
+
+    # 流向角は採用したファセットの勾配から全セルまとめて求める（best_s2 を a2 = r / (π/4) に使い回す）
+    np.maximum(best_s2, 0, out=best_s2)
+    a2 = np.arctan2(best_s2, best_s1, out=best_s2)
+    np.clip(a2, 0, quarter, out=a2)
+    a2 /= quarter
+    a1 = np.subtract(np.float32(1), a2, out=best_s1)
+
+    # 各セルが採用するファセットは1つなので、割合は足し込まずに書き込めばよい
+    inner = props[:, 1:-1, 1:-1]
+    for f, (k1, k2) in enumerate(DINF_FACETS):
+        np.equal(best_f, f, out=m)
+        np.copyto(inner[k1], a1, where=m)
+        np.copyto(inner[k2], a2, where=m)
+
+    # ファセットが使えないセル（NoData は除く）は D8 の最急方向へ。対象は少ないのでそのセルだけ求める
+    rows, cols = np.nonzero((best_f < 0) & ~nodata_mask[1:-1, 1:-1])
+    if rows.size:
+        codes = _d8_codes_at(dem, nodata_mask, rows + 1, cols + 1)
+        has = codes > 0
+        props[codes[has] - 1, rows[has] + 1, cols[has] + 1] = 1
+    return props
+
+def _d8_codes_at(dem: np.ndarray, nodata_mask: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """内側のセル (rows, cols) だけについて d8_flow_direction と同じコード（1..8, なしは 0）を求める"""
+    z0 = dem[rows, cols]
+    best_drop = np.zeros(rows.size, dtype=np.result_type(dem.dtype, np.float32))
+    best_code = np.zeros(rows.size, dtype=np.uint8)
+    slope = np.empty_like(best_drop)
+    for code, ((dr, dc), dist) in enumerate(zip(DIRS, DIR_DIST), start=1):
+        np.subtract(z0, dem[rows + dr, cols + dc], out=slope)
+        slope /= dist
+        better = (slope > best_drop) & ~nodata_mask[rows + dr, cols + dc]
+        best_drop[better] = slope[better]
+        best_code[better] = code
+    best_code[nodata_mask[rows, cols]] = 0
+    return best_code
+
+def flow_proportions(dem: np.ndarray, nodata_mask: np.ndarray, method: str,
+                     exponent: float = MFD_EXPONENT) -> np.ndarray:
+    """method（"dinf" / "mfd"）に応じた8近傍への流量の割合"""
+    if method == "dinf":
+        return dinf_proportions(dem, nodata_mask)
+    if method == "mfd":
+        return mfd_proportions(dem, nodata_mask, exponent)
+    raise ValueError(f"unknown multiple-flow method: {method} (choose from 'dinf', 'mfd')")
+
+def flow_accumulation_proportional(props: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+    """流量の割合 props に従って按分した集水面積（自分自身を1とするセル数相当, float32）。
+
+    割合が正の辺は必ず下り（窪地埋め後の DEM なら閉路はない）なので、
+    流入数0のセルを前線として剥がす1回のトポロジカル走査で全セルを処理する。
+    前線ごとに前線セルの割合をまとめて取り出すので、辺のリストは作らない。
+    D8 の割合（one-hot）を渡すと flow_accumulation と同じ値になる。
+    """
+    nrows, ncols = nodata_mask.shape
+    n = nrows * ncols
+    valid = ~nodata_mask.ravel()
+    acc = valid.astype(np.float32)  # 自分自身を1
+    # セルごとに8方向の割合が連続するよう (n, 8) に並べ替える（前線ごとの取り出しが速い）
+    flat = np.ascontiguousarray(props.reshape(len(DIRS), n).T)
+    offsets = np.array([dr * ncols + dc for dr, dc in DIRS], dtype=np.int64)
+
+    # 流入数（割合が正の辺の数）。外周からの流出はないので範囲外にはならない
+    indeg = np.zeros((nrows, ncols), dtype=np.int32)
+    for k, (dr, dc) in enumerate(DIRS):
+        r0, r1 = max(0, -dr), nrows - max(0, dr)
+        c0, c1 = max(0, -dc), ncols - max(0, dc)
+        indeg[r0 + dr:r1 + dr, c0 + dc:c1 + dc] += props[k, r0:r1, c0:c1] > 0
+    indeg = indeg.ravel()
+
+    frontier = np.flatnonzero(valid & (indeg == 0))
+    while frontier.size:
+        w = flat[frontier]
+        jj, kk = np.nonzero(w > 0)
+        if jj.size == 0:
+            break
+        r = frontier[jj] + offsets[kk]
+        _scatter_add(acc, r, acc[frontier][jj] * w[jj, kk])
+
+        _scatter_add(indeg, r, -1)
+        r = r[indeg[r] == 0]
+        # 重複除去（topological_levels と同じく最後の書き込みだけ残す）
+        mark = np.arange(1, r.size + 1, dtype=np.int32)
+        indeg[r] = -mark
+        frontier = r[indeg[r] == -mark]
+
+    return acc.reshape(nrows, ncols)
+
+# -----------------------------------
+# 流路網
+# 流路セルだけの D8 グラフをトポロジカル段ごとに処理し、
+# 合流点で区切った区間（segment）と Strahler / Shreve 次数を配列演算で求める
+# （区間ごとのライン（ベクタ）にするのは flow_pipeline.stream_segments）
+# -----------------------------------
+def stream_network(recv: np.ndarray, streams: np.ndarray) -> dict[str, np.ndarray]:
+    """流路セル（streams が真のセル）を合流点間の区間に分け、次数を付ける。
+
+    区間の始まりは流入する流路セルが1つでないセル（源流・合流点）で、
+    流れ先が次の区間の始まりか流路外・流出口になるところまでが1区間。
+
+    Returns（いずれもフラットインデックスの配列, 流路外は -1 / 0）:
+        segment: 区間番号
+        strahler: Strahler 次数
+        shreve: Shreve 次数（上流の源流数）
+        rank: 上流からの段番号（区間内のセルの並び順に使う）
+    """
+    n = recv.size
+    valid = streams.ravel().astype(bool)
+    srecv = np.where(valid, recv, -1)
+    has = srecv >= 0
+    srecv[has & ~valid[np.where(has, srecv, 0)]] = -1
+
+    indptr, donors = donor_index(srecv)
+    n_donors = np.diff(indptr)
+    order, level_ptr = topological_levels(srecv, valid)
+
+    segment = np.full(n, -1, dtype=np.int64)
+    strahler = np.zeros(n, dtype=np.int32)
+    shreve = np.zeros(n, dtype=np.int64)
+    rank = np.zeros(n, dtype=np.int64)
+
+    # 区間の始まりに番号を振る（フラットインデックス順）
+    heads = np.flatnonzero(valid & (n_donors != 1))
+    segment[heads] = np.arange(heads.size)
+
+    for k in range(level_ptr.size - 1):
+        f = order[level_ptr[k]:level_ptr[k + 1]].astype(np.int64)
+        rank[f] = k
+        cnt = n_donors[f]
+
+        src = f[cnt == 0]
+        strahler[src] = 1
+        shreve[src] = 1
+
+        one = f[cnt == 1]
+        up = donors[indptr[one]]
+        segment[one] = segment[up]
+        strahler[one] = strahler[up]
+        shreve[one] = shreve[up]
+
+        join = f[cnt >= 2]
+        if join.size:
+            c = n_donors[join]
+            starts = np.cumsum(c) - c
+            up = donors[_csr_positions(indptr, join)]
+            o = strahler[up]
+            top = np.maximum.reduceat(o, starts)
+            n_top = np.add.reduceat((o == np.repeat(top, c)).astype(np.int32), starts)
+            # 最大次数の流れが2本以上合流したら次数を1つ上げる
+            strahler[join] = top + (n_top >= 2)
+            shreve[join] = np.add.reduceat(shreve[up], starts)
+
+    return dict(segment=segment, strahler=strahler, shreve=shreve, rank=rank, receiver=srecv)
+
+def flow_accumulation_reference(fdir: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+    """deque によるセル単位の集水面積計算（参照実装）。flow_accumulation との一致確認用。"""
     nrows, ncols = fdir.shape
     acc = np.ones((nrows, ncols), dtype=np.int32)  # 自分自身を1
     acc[nodata_mask] = 0
@@ -94,7 +643,6 @@ def flow_accumulation(fdir: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
             indeg[rr, cc] += 1
 
     # トポロジカル順（上流から下流へ）
-    from collections import deque
     q = deque()
     for r in range(nrows):
         for c in range(ncols):
@@ -116,46 +664,14 @@ def flow_accumulation(fdir: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
     return acc
 
 def main():
-    with rasterio.open(DEM_TIF) as src:
-        dem = src.read(1).astype(np.float32)
-        profile = src.profile
-        nodata = src.nodata
-
-    if nodata is None:
-        nodata_mask = ~np.isfinite(dem)
-    else:
-        nodata_mask = (dem == nodata) | (~np.isfinite(dem))
-
-    # 1) D8流向
-    fdir = d8_flow_direction(dem, nodata_mask)
-
-    # 2) 集水面積（セル数）
-    acc = flow_accumulation(fdir, nodata_mask)
-
-    # 3) 流路（閾値）
-    streams = (acc >= STREAM_ACC_THRESHOLD).astype(np.uint8)
-    streams[nodata_mask] = 0
-
-    # 出力
-    prof_u8 = profile.copy()
-    prof_u8.update(dtype=rasterio.uint8, count=1, nodata=0, compress="lzw")
-
-    with rasterio.open(OUT_FLOWDIR, "w", **prof_u8) as dst:
-        dst.write(fdir.astype(np.uint8), 1)
-
-    prof_i32 = profile.copy()
-    prof_i32.update(dtype=rasterio.int32, count=1, nodata=0, compress="lzw")
-
-    with rasterio.open(OUT_ACC, "w", **prof_i32) as dst:
-        dst.write(acc.astype(np.int32), 1)
+    """config/flow.yaml で flow_pipeline.run_flow_pipeline を実行する（python flow.py 用）。
+    import flow を軽く保つため、入出力まわりはここで初めて import する。
+    """
+    from pathlib import Path
 
-    with rasterio.open(OUT_STREAMS, "w", **prof_u8) as dst:
-        dst.write(streams, 1)
+    from flow_pipeline import load_flow_config_from_yaml, run_flow_pipeline
 
-    print("✅ Exported:")
-    print(" -", OUT_FLOWDIR)
-    print(" -", OUT_ACC)
-    print(" -", OUT_STREAMS)
+    return run_flow_pipeline(load_flow_config_from_yaml(Path("config/flow.yaml")))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,252 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+flow.py の逐次処理ループのコンパイル版（任意）
+- priority_flood: Priority-Flood + ε による窪地埋め・平坦部の解消
+- trace_upstream: 受け手（receiver）の逆引き（CSR）をたどる上流セルの列挙
+
+flow.py の Python 実装と同じ引数・同じ結果になるように書いている。
+python build_kernels.py でビルドしておくと flow.py が import 時に使う。
+ビルドしていなければ flow.py は Python 実装を使う（結果は同じ）。
+"""
+
+import numpy as np
+
+from libc.math cimport INFINITY, nextafterf
+from libc.stdlib cimport free, malloc, realloc
+from libc.stdint cimport int64_t, uint8_t
+
+
+cdef struct Node:
+    float z
+    int64_t idx
+
+
+# ============================
+# 二分ヒープ（(z, idx) の辞書順。heapq のタプル比較と同じ順序）
+# ============================
+
+cdef inline bint _less(Node a, Node b) nogil:
+    return a.z < b.z or (a.z == b.z and a.idx < b.idx)
+
+
+cdef struct Heap:
+    Node* data
+    int64_t size
+    int64_t cap
+
+
+cdef int _heap_push(Heap* h, float z, int64_t idx) except -1 nogil:
+    cdef Node* grown
+    cdef int64_t i, parent
+    cdef Node node
+
+    if h.size == h.cap:
+        h.cap = h.cap * 2 if h.cap else 1024
+        grown = <Node*> realloc(h.data, h.cap * sizeof(Node))
+        if grown == NULL:
+            with gil:
+                raise MemoryError()
+        h.data = grown
+
+    node.z = z
+    node.idx = idx
+    i = h.size
+    h.size += 1
+    while i > 0:
+        parent = (i - 1) >> 1
+        if not _less(node, h.data[parent]):
+            break
+        h.data[i] = h.data[parent]
+        i = parent
+    h.data[i] = node
+    return 0
+
+
+cdef Node _heap_pop(Heap* h) noexcept nogil:
+    cdef Node top = h.data[0]
+    cdef Node last
+    cdef int64_t i = 0, child
+
+    h.size -= 1
+    if h.size == 0:
+        return top
+
+    last = h.data[h.size]
+    while True:
+        child = 2 * i + 1
+        if child >= h.size:
+            break
+        if child + 1 < h.size and _less(h.data[child + 1], h.data[child]):
+            child += 1
+        if not _less(h.data[child], last):
+            break
+        h.data[i] = h.data[child]
+        i = child
+    h.data[i] = last
+    return top
+
+
+# ============================
+# FIFO キュー（リングバッファ）
+# ============================
+
+cdef struct Queue:
+    int64_t* data
+    int64_t head
+    int64_t size
+    int64_t cap
+
+
+cdef int _queue_push(Queue* q, int64_t v) except -1 nogil:
+    cdef int64_t* grown
+    cdef int64_t i, n
+
+    if q.size == q.cap:
+        n = q.cap * 2 if q.cap else 1024
+        grown = <int64_t*> malloc(n * sizeof(int64_t))
+        if grown == NULL:
+            with gil:
+                raise MemoryError()
+        for i in range(q.size):
+            grown[i] = q.data[(q.head + i) % q.cap]
+        free(q.data)
+        q.data = grown
+        q.head = 0
+        q.cap = n
+
+    q.data[(q.head + q.size) % q.cap] = v
+    q.size += 1
+    return 0
+
+
+cdef inline int64_t _queue_pop(Queue* q) noexcept nogil:
+    cdef int64_t v = q.data[q.head]
+    q.head = (q.head + 1) % q.cap
+    q.size -= 1
+    return v
+
+
+# ============================
+# カーネル
+# ============================
+
+def priority_flood(
+    float[::1] z,
+    uint8_t[::1] closed,
+    const int64_t[::1] seeds,
+    const int64_t[::1] offsets,
+):
+    """外周を1セル広げたフラット配列 z を、seeds（処理済みにした出口）から埋める（z を直接書き換える）
+
+    closed は処理済みフラグ（外周・NoData は 1）。offsets は8近傍のフラットオフセット。
+    """
+
+    cdef Heap heap
+    cdef Queue pit
+    cdef Node node
+    cdef int64_t i, c, nb
+    cdef int k, n_off = offsets.shape[0]
+    cdef float z_eps, zn
+
+    heap.data = NULL
+    heap.size = 0
+    heap.cap = 0
+    pit.data = NULL
+    pit.head = 0
+    pit.size = 0
+    pit.cap = 0
+
+    try:
+        with nogil:
+            for i in range(seeds.shape[0]):
+                _heap_push(&heap, z[seeds[i]], seeds[i])
+
+            while heap.size or pit.size:
+                if pit.size:
+                    c = _queue_pop(&pit)
+                else:
+                    node = _heap_pop(&heap)
+                    c = node.idx
+                z_eps = nextafterf(z[c], INFINITY)
+
+                for k in range(n_off):
+                    nb = c + offsets[k]
+                    if closed[nb]:
+                        continue
+                    closed[nb] = 1
+                    zn = z[nb]
+                    if zn <= z_eps:
+                        # 窪地・平坦部: 親よりわずかに高くして、親へ流れる勾配を作る
+                        z[nb] = z_eps
+                        _queue_push(&pit, nb)
+                    else:
+                        _heap_push(&heap, zn, nb)
+    finally:
+        free(heap.data)
+        free(pit.data)
+
+
+cdef inline bint _contains(const int64_t[::1] sorted_values, int64_t v) noexcept nogil:
+    """昇順の sorted_values に v が含まれるか（二分探索）"""
+    cdef int64_t lo = 0, hi = sorted_values.shape[0], mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if sorted_values[mid] < v:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo < sorted_values.shape[0] and sorted_values[lo] == v
+
+
+def trace_upstream(
+    const int64_t[::1] indptr,
+    const int64_t[::1] donors,
+    const int64_t[::1] starts,
+):
+    """starts から donor（CSR: indptr / donors）をたどり、上流セル（starts を含む）を昇順・重複なしで返す
+
+    starts は昇順・重複なしであること。各セルの受け手は1つなので donor の逆引きは森（木の集まり）で、
+    起点以外のセルには1つの経路でしか到達しない。起点どうしが上下流の関係にある場合だけ、
+    下流の起点からたどり着いた上流の起点を飛ばせば、訪問済みの配列（セル数ぶん）なしで各セルを1回だけたどる。
+    """
+
+    cdef int64_t cap = max(starts.shape[0], 1024)
+    cdef int64_t n = 0, head = 0, c, d, j
+    cdef int64_t* out = <int64_t*> malloc(cap * sizeof(int64_t))
+    cdef int64_t* grown
+
+    if out == NULL:
+        raise MemoryError()
+
+    try:
+        with nogil:
+            for j in range(starts.shape[0]):
+                out[n] = starts[j]
+                n += 1
+
+            # out 自体を幅優先のキューとして使う
+            while head < n:
+                c = out[head]
+                head += 1
+                for j in range(indptr[c], indptr[c + 1]):
+                    d = donors[j]
+                    if _contains(starts, d):
+                        continue
+                    if n == cap:
+                        cap *= 2
+                        grown = <int64_t*> realloc(out, cap * sizeof(int64_t))
+                        if grown == NULL:
+                            with gil:
+                                raise MemoryError()
+                        out = grown
+                    out[n] = d
+                    n += 1
+
+        result = np.empty(n, dtype=np.int64)
+        if n:
+            result[:] = <int64_t[:n]> out
+    finally:
+        free(out)
+
+    result.sort()
+    return result
@@ -0,0 +1,267 @@
+"""
+水文解析（流向・集水面積・流路）の実行: config/flow.yaml → GeoTIFF / GeoPackage
+- 配列の計算（窪地埋め・D8・集水面積・流路網）は flow.py。ここでは設定の読み込みと入出力だけを行う
+- 流向・集水面積は1回だけ計算し、流路（ラスタ）と流路網（ベクタ）は閾値ごとに書き出す
+
+使い方:
+    python flow_pipeline.py
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+import yaml
+
+from flow import (
+    FLOW_METHODS,
+    MFD_EXPONENT,
+    d8_flow_direction,
+    fill_depressions,
+    flow_accumulation,
+    flow_accumulation_proportional,
+    flow_proportions,
+    flow_receivers,
+    stream_network,
+)
+from raster_io import RasterWriteOptions, write_options_from_dict, write_raster
+
+
+# ============================
+# 設定（YAML）
+# ============================
+
+@dataclass
+class FlowIOConfig:
+    """ファイル入出力のパス設定"""
+
+    dem_tif: Path
+    flow_dir_tif: Path
+    acc_tif: Path
+    # {threshold} を含むテンプレート（閾値が1つなら含まなくてよい）
+    streams_tif: str
+    # 流路網のベクタ（合流点間のライン, Strahler / Shreve 次数・集水面積付き）。空なら出力しない
+    streams_gpkg: str = ""
+
+
+@dataclass
+class FlowParams:
+    """解析パラメータ"""
+
+    # 「流路」とみなす集水面積（セル数）閾値。複数指定すると集水面積1回分から全て出力する
+    # 例：10m DEMなら 1000セル=約0.1km^2
+    stream_thresholds: list[float] = field(default_factory=lambda: [500])
+    # D8 の前に窪地埋め（Priority-Flood + ε）を行うか。False（既定）で生 DEM のまま
+    fill_depressions: bool = False
+    method: str = "d8"              # 集水面積の流向モデル（FLOW_METHODS）
+    mfd_exponent: float = MFD_EXPONENT
+
+    def __post_init__(self) -> None:
+        if self.method not in FLOW_METHODS:
+            raise ValueError(f"unknown flow method: {self.method} (choose from {FLOW_METHODS})")
+        if not self.stream_thresholds:
+            raise ValueError("stream_thresholds is empty")
+
+
+@dataclass
+class FlowConfig:
+    """水文解析（流向・集水面積・流路）全体の設定"""
+
+    io: FlowIOConfig
+    params: FlowParams = field(default_factory=FlowParams)
+    output: RasterWriteOptions = field(default_factory=RasterWriteOptions)
+
+
+def load_flow_config_from_yaml(yaml_path: Path) -> FlowConfig:
+    with open(yaml_path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+
+    d = data["io"]
+    io = FlowIOConfig(
+        dem_tif=Path(d["dem_tif"]),
+        flow_dir_tif=Path(d["flow_dir_tif"]),
+        acc_tif=Path(d["acc_tif"]),
+        streams_tif=str(d["streams_tif"]),
+        streams_gpkg=str(d.get("streams_gpkg") or ""),
+    )
+
+    p = data.get("params") or {}
+    thresholds = p.get("stream_thresholds") or [p.get("stream_threshold", 500)]
+    params = FlowParams(
+        stream_thresholds=[float(t) for t in thresholds],
+        fill_depressions=bool(p.get("fill_depressions", False)),
+        method=str(p.get("method", "d8")),
+        mfd_exponent=float(p.get("mfd_exponent", MFD_EXPONENT)),
+    )
+
+    return FlowConfig(io=io, params=params, output=write_options_from_dict(data.get("output")))
+
+
+def threshold_output_paths(template: str, thresholds: list[float]) -> list[Path]:
+    """閾値ごとの出力先。閾値が複数なら template に {threshold} が必要"""
+
+    if len(thresholds) > 1 and "{threshold}" not in template:
+        raise ValueError(f"output template must contain {{threshold}} for multiple thresholds: {template}")
+    return [Path(template.format(threshold=f"{t:g}")) for t in thresholds]
+
+
+# ============================
+# 流路網（ベクタ）
+# ============================
+
+def stream_segments(
+    network: dict[str, np.ndarray],
+    acc: np.ndarray,
+    transform,
+    crs,
+) -> gpd.GeoDataFrame:
+    """stream_network の結果を区間ごとのラインにする。
+
+    各ラインは区間のセル中心を上流から順に結び、流れ先があればその点（次の区間の始点）まで延ばす。
+    属性: segment_id, to_segment（流れ先の区間, なしは -1）, strahler, shreve,
+          n_cells, length_m, upstream_cells / upstream_area_m2（区間末端の集水面積）
+    """
+    nrows, ncols = acc.shape
+    segment, receiver = network["segment"], network["receiver"]
+
+    cells = np.flatnonzero(segment >= 0)
+    seg = segment[cells]
+    cells = cells[np.lexsort((network["rank"][cells], seg))]
+    seg = segment[cells]
+    n_seg = int(seg.max()) + 1 if seg.size else 0
+
+    # 区間の末端セルと、その流れ先（次の区間の始点）
+    last = np.r_[seg[1:] != seg[:-1], True] if seg.size else np.zeros(0, dtype=bool)
+    tail = cells[last]
+    down = receiver[tail]
+    has_down = down >= 0
+
+    # 流れ先の点を各区間の末尾に足して頂点列を作る
+    vert_cells = np.concatenate([cells, down[has_down]])
+    vert_seg = np.concatenate([seg, seg[last][has_down]])
+    vert_rank = np.concatenate([np.arange(cells.size), np.full(int(has_down.sum()), cells.size)])
+    o = np.lexsort((vert_rank, vert_seg))
+    vert_cells, vert_seg = vert_cells[o], vert_seg[o]
+
+    rows, cols = np.divmod(vert_cells, ncols)
+    xs, ys = rasterio.transform.xy(transform, rows, cols)
+    xs, ys = np.asarray(xs), np.asarray(ys)
+
+    n_vert = np.bincount(vert_seg, minlength=n_seg)
+    keep = n_vert[vert_seg] >= 2  # 1点だけの区間（流れ先のない孤立セル）は除く
+    lines = np.full(n_seg, None, dtype=object)
+    kept, local = np.unique(vert_seg[keep], return_inverse=True)
+    if kept.size:
+        # indices は 0 から欠番なしで並べる必要がある
+        lines[kept] = shapely.linestrings(xs[keep], ys[keep], indices=local)
+
+    # 流れ先が除いた区間（流出口の1セルだけの区間）なら流れ先なしにする
+    has_line = np.zeros(n_seg, dtype=bool)
+    has_line[kept] = True
+    to_segment = np.where(has_down, segment[np.where(has_down, down, 0)], -1)
+    to_segment[(to_segment >= 0) & ~has_line[np.maximum(to_segment, 0)]] = -1
+
+    cell_area = abs(transform.a * transform.e)
+    upstream = acc.ravel()[tail]
+    gdf = gpd.GeoDataFrame(
+        {
+            "segment_id": np.arange(n_seg),
+            "to_segment": to_segment,
+            "strahler": network["strahler"][tail],
+            "shreve": network["shreve"][tail],
+            "n_cells": np.bincount(seg, minlength=n_seg),
+            "length_m": shapely.length(lines),
+            "upstream_cells": upstream,
+            "upstream_area_m2": upstream * cell_area,
+        },
+        geometry=lines,
+        crs=crs,
+    )
+    return gdf[gdf.geometry.notnull()]
+
+
+# ============================
+# 実行
+# ============================
+
+def run_flow_pipeline(config: FlowConfig) -> dict[str, list[Path]]:
+    """DEM →（窪地埋め）→ D8 流向 → 集水面積 → 閾値ごとの流路（ラスタ・ベクタ）
+
+    D8 流向と集水面積は1回だけ計算し、流路はその集水面積から閾値ごとに切り出す。
+    Returns: 出力の種類 → 書き出したファイルのリスト
+    """
+
+    io, params, write_opts = config.io, config.params, config.output
+
+    with rasterio.open(io.dem_tif) as src:
+        dem = src.read(1).astype(np.float32)
+        profile = src.profile
+        nodata = src.nodata
+
+    if nodata is None:
+        nodata_mask = ~np.isfinite(dem)
+    else:
+        nodata_mask = (dem == nodata) | (~np.isfinite(dem))
+
+    # 0) 窪地埋め・平坦部解消（fill_depressions が有効な場合だけ）
+    if params.fill_depressions:
+        dem = fill_depressions(dem, nodata_mask)
+
+    # 1) D8流向
+    fdir = d8_flow_direction(dem, nodata_mask)
+
+    # 2) 集水面積（セル数）。dinf / mfd は按分した float32
+    if params.method == "d8":
+        acc = flow_accumulation(fdir, nodata_mask)
+    else:
+        props = flow_proportions(dem, nodata_mask, params.method, params.mfd_exponent)
+        acc = flow_accumulation_proportional(props, nodata_mask)
+
+    # 出力
+    outputs = {"flow_dir": [io.flow_dir_tif], "acc": [io.acc_tif], "streams": [], "streams_gpkg": []}
+
+    prof_u8 = profile.copy()
+    prof_u8.update(dtype=rasterio.uint8, count=1, nodata=0)
+    write_raster(io.flow_dir_tif, fdir.astype(np.uint8), prof_u8, options=write_opts)
+
+    prof_acc = profile.copy()
+    if params.method == "d8":
+        prof_acc.update(dtype=rasterio.int32, count=1, nodata=0)
+        write_raster(io.acc_tif, acc.astype(np.int32), prof_acc, options=write_opts)
+    else:
+        prof_acc.update(dtype=rasterio.float32, count=1, nodata=0)
+        write_raster(io.acc_tif, acc, prof_acc, options=write_opts)
+
+    # 3) 流路（閾値ごと）と 4) 流路網（ベクタ）。流路網は常に D8 の受け手をたどる
+    thresholds = params.stream_thresholds
+    streams_tifs = threshold_output_paths(io.streams_tif, thresholds)
+    streams_gpkgs = threshold_output_paths(io.streams_gpkg, thresholds) if io.streams_gpkg else []
+    recv = flow_receivers(fdir, nodata_mask) if streams_gpkgs else None
+
+    for i, t in enumerate(thresholds):
+        streams = (acc >= t).astype(np.uint8)
+        streams[nodata_mask] = 0
+        write_raster(streams_tifs[i], streams, prof_u8, options=write_opts, mask=True)
+        outputs["streams"].append(streams_tifs[i])
+
+        if streams_gpkgs:
+            network = stream_network(recv, streams)
+            segs = stream_segments(network, acc, profile["transform"], profile["crs"])
+            streams_gpkgs[i].parent.mkdir(parents=True, exist_ok=True)
+            segs.to_file(streams_gpkgs[i], layer="streams", driver="GPKG")
+            outputs["streams_gpkg"].append(streams_gpkgs[i])
+            max_order = segs["strahler"].max() if len(segs) else 0
+            print(f"[Streams] threshold={t:g}: segments: {len(segs)}, max Strahler order: {max_order}")
+
+    print("✅ Exported:")
+    for paths in outputs.values():
+        for path in paths:
+            print(" -", path)
+    return outputs
+
+
+if __name__ == "__main__":
+    run_flow_pipeline(load_flow_config_from_yaml(Path("config/flow.yaml")))
@@ -0,0 +1,319 @@
+"""
+流向ラスタ（flow_dir_d8.tif）に対する上流域・下流経路の問い合わせ
+- 流向ラスタは1回だけ読み、受け手（receiver）とその逆引き（donor, CSR 形式）を作っておく
+- 上流域（集水域）は donor を、下流経路は receiver をたどるので、
+  1件あたりの計算量は集水域・経路の大きさに比例し、ラスタ全体の大きさにはよらない
+- 地点（座標）や建物の重心をまとめて問い合わせ、結果を GeoPackage / GeoTIFF に書き出せる
+  まとめて問い合わせる場合は、全地点から donor を1回だけ上流へたどって集水域を塗り分け、
+  集水面積・下流経路も地点ごとの Python ループなしで求める
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+
+from DEM_to_slope_risk_PL import load_buildings
+from flow import _csr_positions, _scatter_add, donor_index, flow_receivers, topological_levels, trace_upstream
+from raster_io import write_raster
+
+
+@dataclass
+class FlowIndex:
+    """流向ラスタから作った上流・下流の探索用インデックス（フラットインデックス）"""
+
+    recv: np.ndarray      # 各セルの流れ先（なしは -1）
+    indptr: np.ndarray    # donors[indptr[i]:indptr[i+1]] がセル i に流れ込むセル
+    donors: np.ndarray
+    transform: rasterio.Affine
+    crs: rasterio.crs.CRS
+    shape: tuple[int, int]
+
+    @property
+    def cell_area(self) -> float:
+        return abs(self.transform.a * self.transform.e)
+
+
+def load_flow_index(fdir_tif: Path) -> FlowIndex:
+    """D8 流向ラスタ（1..8, 流れ先なし 0）を読み込み、インデックスを作る"""
+
+    with rasterio.open(fdir_tif) as src:
+        fdir = src.read(1)
+        transform, crs = src.transform, src.crs
+
+    # 流向 0 は流れ先なし（NoData も 0）なので、NoData マスクは不要
+    recv = flow_receivers(fdir, np.zeros(fdir.shape, dtype=bool))
+    indptr, donors = donor_index(recv)
+    print(f"[Flow] index: {fdir.shape[1]} x {fdir.shape[0]} px, {donors.size} links")
+    return FlowIndex(recv, indptr, donors, transform, crs, fdir.shape)
+
+
+# ============================
+# 座標 ↔ セル
+# ============================
+
+def xy_to_cells(index: FlowIndex, xs, ys) -> np.ndarray:
+    """座標（index.crs）をフラットインデックスにする。範囲外は -1"""
+
+    nrows, ncols = index.shape
+    rows, cols = rasterio.transform.rowcol(index.transform, np.asarray(xs), np.asarray(ys))
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+    return np.where(inside, rows * ncols + cols, -1)
+
+
+def cells_to_xy(index: FlowIndex, cells: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """フラットインデックスをセル中心の座標にする"""
+
+    rows, cols = np.divmod(np.asarray(cells, dtype=np.int64), index.shape[1])
+    xs, ys = rasterio.transform.xy(index.transform, rows, cols)
+    return np.asarray(xs), np.asarray(ys)
+
+
+# ============================
+# 問い合わせ
+# ============================
+
+def upstream_cells(index: FlowIndex, cell: int) -> np.ndarray:
+    """cell の集水域（cell 自身を含む上流セル, 昇順）"""
+
+    return trace_upstream(index.indptr, index.donors, [cell])
+
+
+def downstream_path(index: FlowIndex, cell: int, max_steps: int | None = None) -> np.ndarray:
+    """cell から流れ先をたどった経路（cell から流出口まで）"""
+
+    recv = index.recv
+    path = [int(cell)]
+    c = recv[cell]
+    while c >= 0 and (max_steps is None or len(path) <= max_steps):
+        path.append(int(c))
+        c = recv[c]
+    return np.array(path, dtype=np.int64)
+
+
+def path_length(index: FlowIndex, path: np.ndarray) -> float:
+    """経路の長さ（セル中心を結んだ折れ線, m）"""
+
+    xs, ys = cells_to_xy(index, path)
+    return float(np.hypot(np.diff(xs), np.diff(ys)).sum())
+
+
+def catchment_partition(index: FlowIndex, cells: np.ndarray) -> np.ndarray:
+    """各セルを、下流側で最も近い問い合わせ地点の番号（cells の位置 + 1）で塗る（フラット, int32）
+
+    全地点から donor を1段ずつまとめて上流へたどり、流れ先の番号を引き継ぐ。
+    問い合わせ地点のセルは自分の番号のままなので、その上流は内側の地点の番号になる。
+    各セルは1回しか訪れない。範囲外（-1）の地点は無視し、同じセルに複数の地点がある場合は
+    後の地点の番号にする。どの地点にも流れ込まないセルは 0。
+    """
+
+    cells = np.asarray(cells, dtype=np.int64)
+    labels = np.zeros(index.recv.size, dtype=np.int32)
+    inside = np.flatnonzero(cells >= 0)
+    np.maximum.at(labels, cells[inside], (inside + 1).astype(np.int32))
+
+    frontier = np.unique(cells[inside])
+    while frontier.size:
+        pos = _csr_positions(index.indptr, frontier)
+        if pos.size == 0:
+            break
+        up = index.donors[pos]
+        from_label = np.repeat(labels[frontier], index.indptr[frontier + 1] - index.indptr[frontier])
+        # 問い合わせ地点のセル（塗り済み）で止める。D8 なので各セルの流れ先は1つだけ
+        new = labels[up] == 0
+        frontier = up[new]
+        labels[frontier] = from_label[new]
+    return labels
+
+
+def upstream_counts(index: FlowIndex, cells: np.ndarray, labels: np.ndarray | None = None) -> np.ndarray:
+    """各地点の集水域のセル数（地点自身を含む）。範囲外（-1）は 0
+
+    catchment_partition の塗り分け（labels）の番号ごとのセル数を、地点どうしの上下流関係に沿って
+    下流側の地点へ足し込む。地点の数だけの小さなグラフなので、ラスタを再びたどる必要はない。
+    """
+
+    cells = np.asarray(cells, dtype=np.int64)
+    if labels is None:
+        labels = catchment_partition(index, cells)
+    n = len(cells)
+    inside = cells >= 0
+
+    # 地点のセルの番号（同じセルの地点は代表の番号）と、そのすぐ下流の地点の番号
+    own = np.zeros(n, dtype=np.int64)
+    own[inside] = labels[cells[inside]]
+    reps = np.unique(own[inside])
+    total = np.bincount(labels, minlength=n + 1).astype(np.int64)
+    parent = np.full(n + 1, -1, dtype=np.int64)
+    r = index.recv[cells[reps - 1]]
+    parent[reps] = np.where(r >= 0, labels[np.maximum(r, 0)], 0)
+    parent[parent == 0] = -1
+
+    valid = np.zeros(n + 1, dtype=bool)
+    valid[reps] = True
+    order, level_ptr = topological_levels(parent, valid)
+    for k in range(level_ptr.size - 1):
+        f = order[level_ptr[k]:level_ptr[k + 1]]
+        p = parent[f]
+        has = p >= 0
+        _scatter_add(total, p[has], total[f[has]])
+
+    counts = np.zeros(n, dtype=np.int64)
+    counts[inside] = total[own[inside]]
+    return counts
+
+
+def batch_upstream_area(index: FlowIndex, cells: np.ndarray) -> np.ndarray:
+    """各セルの集水面積（m2）。範囲外（-1）は NaN"""
+
+    cells = np.asarray(cells, dtype=np.int64)
+    return np.where(cells >= 0, upstream_counts(index, cells) * index.cell_area, np.nan)
+
+
+def catchment_labels(index: FlowIndex, cells: np.ndarray) -> np.ndarray:
+    """各問い合わせ地点の集水域を 1..len(cells) の番号で塗り分けたラスタ（0 はどこにも属さない）
+
+    集水域が入れ子になる場合（ある地点が別の地点の上流にある場合）は、
+    各セルを最も近い下流側の地点に割り当てる。範囲外（-1）の地点は塗らない。
+    """
+
+    return catchment_partition(index, cells).reshape(index.shape)
+
+
+def downstream_paths(index: FlowIndex, cells: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """全地点の下流経路を、全地点を1段ずつそろえて流れ先へ進めて求める
+
+    Returns:
+        owner: 経路上のセルが属する地点の位置（地点ごとに、経路の順に並ぶ）
+        path: 経路上のセル（各地点の経路は地点のセルから流出口まで）。範囲外（-1）の地点は含まない
+    """
+
+    cells = np.asarray(cells, dtype=np.int64)
+    active = np.flatnonzero(cells >= 0)
+    cur = cells[active]
+    owners, steps = [], []
+    while active.size:
+        owners.append(active)
+        steps.append(cur)
+        cur = index.recv[cur]
+        more = cur >= 0
+        active, cur = active[more], cur[more]
+
+    # 各地点のセルは1段に1つずつ現れるので、k 段目のセルは「地点の先頭 + k」の位置に置けばよい（ソート不要）
+    n_steps = np.zeros(len(cells), dtype=np.int64)
+    for a in owners:
+        n_steps[a] += 1
+    start = np.zeros(len(cells), dtype=np.int64)
+    np.cumsum(n_steps[:-1], out=start[1:])
+    path = np.empty(int(n_steps.sum()), dtype=np.int64)
+    for k, (a, c) in enumerate(zip(owners, steps)):
+        path[start[a] + k] = c
+    return np.repeat(np.arange(len(cells), dtype=np.int64), n_steps), path
+
+
+def building_catchments(
+    index: FlowIndex,
+    poly_file: Path,
+    paths: bool = True,
+) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame | None, np.ndarray]:
+    """建物の重心ごとに集水面積・下流経路を求める
+
+    Returns:
+        points: 建物の重心（fid, upstream_cells, upstream_area_m2, downstream_length_m）。
+                範囲外の建物は upstream_cells=0、面積・長さは NaN
+        lines: 重心のセルから流出口までの下流経路（paths=False なら None）
+        cells: 重心のフラットインデックス（範囲外は -1）
+    """
+
+    gdf = load_buildings(poly_file, index.crs, keep_fid=True)
+    centroids = gdf.geometry.centroid
+    cells = xy_to_cells(index, centroids.x.to_numpy(), centroids.y.to_numpy())
+
+    n_up = upstream_counts(index, cells)
+
+    # 下流経路の長さ（セル中心を結んだ折れ線）と、経路が2セル以上ある地点の LineString
+    owner, path = downstream_paths(index, cells)
+    xs, ys = cells_to_xy(index, path)
+    same = owner[1:] == owner[:-1]
+    step = np.hypot(np.diff(xs), np.diff(ys))[same]
+    length = np.bincount(owner[1:][same], weights=step, minlength=len(cells))
+    length[cells < 0] = np.nan
+
+    lines = None
+    if paths:
+        lines = np.full(len(cells), None, dtype=object)
+        n_pts = np.bincount(owner, minlength=len(cells))
+        keep = n_pts[owner] > 1
+        if keep.any():
+            has_line = n_pts > 1
+            lines[has_line] = shapely.linestrings(
+                np.column_stack([xs[keep], ys[keep]]),
+                indices=(np.cumsum(has_line) - 1)[owner[keep]],
+            )
+
+    points = gpd.GeoDataFrame(
+        {
+            "fid": gdf.index.to_numpy(),
+            "upstream_cells": n_up,
+            "upstream_area_m2": np.where(cells >= 0, n_up * index.cell_area, np.nan),
+            "downstream_length_m": length,
+        },
+        geometry=centroids.to_numpy(),
+        crs=index.crs,
+    )
+
+    line_gdf = None
+    if paths:
+        line_gdf = gpd.GeoDataFrame({"fid": gdf.index.to_numpy()}, geometry=lines, crs=index.crs)
+        line_gdf = line_gdf[line_gdf.geometry.notnull()]
+
+    print(f"[Flow] buildings: {len(cells)} (outside raster: {int((cells < 0).sum())})")
+    return points, line_gdf, cells
+
+
+def export_building_catchments(
+    fdir_tif: Path,
+    poly_file: Path,
+    out_gpkg: Path,
+    out_labels_tif: Path | None = None,
+) -> Path:
+    """建物ごとの集水面積・下流経路を GeoPackage に、集水域の塗り分けを GeoTIFF に書き出す"""
+
+    index = load_flow_index(fdir_tif)
+    points, lines, cells = building_catchments(index, poly_file)
+
+    out_gpkg = Path(out_gpkg)
+    out_gpkg.parent.mkdir(parents=True, exist_ok=True)
+    points.to_file(out_gpkg, layer="building_catchments", driver="GPKG")
+    if lines is not None and len(lines):
+        lines.to_file(out_gpkg, layer="downstream_paths", driver="GPKG")
+
+    if out_labels_tif is not None:
+        labels = catchment_labels(index, cells)
+        profile = dict(
+            driver="GTiff",
+            height=index.shape[0],
+            width=index.shape[1],
+            count=1,
+            dtype=rasterio.int32,
+            crs=index.crs,
+            transform=index.transform,
+            nodata=0,
+        )
+        write_raster(out_labels_tif, labels, profile)
+
+    print("[Flow] ✅ exported:", out_gpkg)
+    return out_gpkg
+
+
+if __name__ == "__main__":
+    export_building_catchments(
+        fdir_tif=Path("flow_analysis") / "flow_dir_d8.tif",
+        poly_file=Path("QGIS") / "slope_analysis" / "shiraishi_bld_poly.gpkg",
+        out_gpkg=Path("flow_analysis") / "building_catchments.gpkg",
+        out_labels_tif=Path("flow_analysis") / "building_catchments.tif",
+    )
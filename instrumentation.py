@@ -0,0 +1,298 @@
+"""
+パイプラインの計測（ステップごとの時間・メモリ・I/O）
+- instrumented_run() で実行全体を囲み、各ステップを step() で囲む
+- ステップごとに経過時間・CPU 時間・最大 RSS・tracemalloc のピーク（任意）・
+  読み書きした GeoTIFF のバイト数・画素スループットを記録する
+- 結果は JSON lines（1行1ステップ + 最後に実行全体の1行）に書き出し、標準出力にも要約を出す
+- 計測が無効、または instrumented_run() の外では、step() などは何もしない
+
+QC 統計（2値ラスタの値ごとの画素数）は qc_enabled() が False なら計算しない。
+"""
+
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import sys
+import time
+import tracemalloc
+from typing import Iterator
+import uuid
+
+import numpy as np
+
+try:
+    import resource  # POSIX のみ
+except ImportError:
+    resource = None
+
+
+@dataclass
+class InstrumentationConfig:
+    """計測の設定"""
+
+    enabled: bool = False            # ステップごとの計測を行う
+    report_jsonl: Path | None = None  # JSON lines の出力先（追記）。None なら要約の表示だけ
+    tracemalloc: bool = False        # Python 側の確保（NumPy 配列を含む）のピークも測る（遅くなる）
+    qc: bool = True                  # QC 統計（2値ラスタの値ごとの画素数）を計算・表示する
+
+
+def instrumentation_from_dict(d: dict | None) -> InstrumentationConfig:
+    """YAML の instrumentation セクションから InstrumentationConfig を作る"""
+
+    d = d or {}
+    return InstrumentationConfig(
+        enabled=bool(d.get("enabled", False)),
+        report_jsonl=Path(d["report_jsonl"]) if d.get("report_jsonl") else None,
+        tracemalloc=bool(d.get("tracemalloc", False)),
+        qc=bool(d.get("qc", True)),
+    )
+
+
+# ============================
+# 計測値の取得
+# ============================
+
+def _max_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KiB、macOS は byte
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def _proc_io() -> dict[str, int] | None:
+    """プロセスの累計 I/O（Linux の /proc/self/io。GDAL 内部の読み書きも含む）"""
+
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {"read": int(fields["rchar"]), "write": int(fields["wchar"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _file_size(path: Path) -> int | None:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+# ============================
+# 記録
+# ============================
+
+class _Step:
+    """実行中のステップ1つ分の計測値"""
+
+    def __init__(self, name: str, pixels: int | None, parent: "_Step | None") -> None:
+        self.name = name
+        self.pixels = pixels
+        self.parent = parent
+        self.children_s = 0.0
+        self.py_peak = 0
+        self.reads: list[dict] = []
+        self.writes: list[dict] = []
+        self.qc: dict[str, list] = {}
+
+        self.t0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.rss0 = _max_rss_mb()
+        self.io0 = _proc_io()
+
+
+class Recorder:
+    """1回の実行の計測結果を集め、JSON lines に書き出す"""
+
+    def __init__(self, cfg: InstrumentationConfig, run_name: str) -> None:
+        self.cfg = cfg
+        self.run_name = run_name
+        self.run_id = uuid.uuid4().hex[:12]
+        self.records: list[dict] = []
+        self._stack: list[_Step] = []
+        self._t0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+
+    @contextmanager
+    def step(self, name: str, pixels: int | None = None) -> Iterator[None]:
+        parent = self._stack[-1] if self._stack else None
+        if self.cfg.tracemalloc and tracemalloc.is_tracing():
+            # 入れ子のステップで reset_peak する前に、親のピークを退避する
+            if parent is not None:
+                parent.py_peak = max(parent.py_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        st = _Step(name, pixels, parent)
+        self._stack.append(st)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self._finish_step(st)
+
+    def _finish_step(self, st: _Step) -> None:
+        wall = time.perf_counter() - st.t0
+        cpu = time.process_time() - st.cpu0
+        rss = _max_rss_mb()
+        io1 = _proc_io()
+
+        if self.cfg.tracemalloc and tracemalloc.is_tracing():
+            st.py_peak = max(st.py_peak, tracemalloc.get_traced_memory()[1])
+        if st.parent is not None:
+            st.parent.children_s += wall
+            st.parent.py_peak = max(st.parent.py_peak, st.py_peak)
+
+        rec = {
+            "type": "step",
+            "run_id": self.run_id,
+            "run": self.run_name,
+            "step": st.name,
+            "parent": st.parent.name if st.parent is not None else None,
+            "wall_s": round(wall, 4),
+            "self_s": round(wall - st.children_s, 4),
+            "cpu_s": round(cpu, 4),
+            "max_rss_mb": round(rss, 1) if rss is not None else None,
+            "rss_growth_mb": round(rss - st.rss0, 1) if rss is not None else None,
+            "py_peak_mb": round(st.py_peak / 2 ** 20, 1) if self.cfg.tracemalloc else None,
+            "files_read": st.reads,
+            "files_written": st.writes,
+            "bytes_read": sum(f["bytes"] or 0 for f in st.reads),
+            "bytes_written": sum(f["bytes"] or 0 for f in st.writes),
+            "io_read_bytes": io1["read"] - st.io0["read"] if io1 and st.io0 else None,
+            "io_write_bytes": io1["write"] - st.io0["write"] if io1 and st.io0 else None,
+            "pixels": st.pixels,
+            "mpx_per_s": round(st.pixels / wall / 1e6, 2) if st.pixels and wall > 0 else None,
+            "qc": st.qc or None,
+        }
+        self.records.append(rec)
+
+    def record_file(self, kind: str, path: Path) -> None:
+        if not self._stack:
+            return
+        entry = {"path": str(path), "bytes": _file_size(path)}
+        st = self._stack[-1]
+        (st.reads if kind == "read" else st.writes).append(entry)
+
+    def record_qc(self, name: str, counts: list[tuple[int, int]]) -> None:
+        if self._stack:
+            self._stack[-1].qc[name] = [list(c) for c in counts]
+
+    def summary(self) -> dict:
+        rss = _max_rss_mb()
+        steps = [r for r in self.records if r["type"] == "step"]
+        return {
+            "type": "run",
+            "run_id": self.run_id,
+            "run": self.run_name,
+            "wall_s": round(time.perf_counter() - self._t0, 4),
+            "cpu_s": round(time.process_time() - self._cpu0, 4),
+            "max_rss_mb": round(rss, 1) if rss is not None else None,
+            "bytes_read": sum(r["bytes_read"] for r in steps),
+            "bytes_written": sum(r["bytes_written"] for r in steps),
+            "steps": len(steps),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    def report(self) -> None:
+        """要約を表示し、report_jsonl が指定されていれば追記する"""
+
+        run = self.summary()
+        for r in self.records:
+            rate = f"{r['mpx_per_s']:8.2f} Mpx/s" if r["mpx_per_s"] is not None else " " * 14
+            rss = f"{r['max_rss_mb']:8.0f} MB" if r["max_rss_mb"] is not None else "       -"
+            print(
+                f"[Instr] {r['step']:<20} wall {r['wall_s']:8.3f} s  self {r['self_s']:8.3f} s  "
+                f"cpu {r['cpu_s']:8.3f} s  rss {rss}  {rate}  "
+                f"read {r['bytes_read'] / 2 ** 20:7.1f} MB  written {r['bytes_written'] / 2 ** 20:7.1f} MB"
+            )
+        print(f"[Instr] total wall {run['wall_s']:.3f} s, cpu {run['cpu_s']:.3f} s")
+
+        if self.cfg.report_jsonl:
+            path = Path(self.cfg.report_jsonl)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                for r in self.records + [run]:
+                    f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            print("[Instr] ✅ report appended:", path)
+
+
+# ============================
+# 実行中の Recorder（プロセスに1つ）
+# ============================
+
+_active: Recorder | None = None
+_qc = True
+
+
+@contextmanager
+def instrumented_run(cfg: InstrumentationConfig | None, run_name: str) -> Iterator[Recorder | None]:
+    """実行全体を囲む。既に計測中なら（入れ子の実行）その Recorder をそのまま使う"""
+
+    global _active, _qc
+
+    if _active is not None:
+        yield _active
+        return
+
+    cfg = cfg or InstrumentationConfig()
+    qc_before = _qc
+    _qc = cfg.qc
+    if not cfg.enabled:
+        try:
+            yield None
+        finally:
+            _qc = qc_before
+        return
+
+    started_tracing = cfg.tracemalloc and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    _active = Recorder(cfg, run_name)
+    try:
+        yield _active
+        _active.report()
+    finally:
+        _active = None
+        _qc = qc_before
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def step(name: str, pixels: int | None = None):
+    """ステップを囲むコンテキスト。計測中でなければ何もしない"""
+
+    return _active.step(name, pixels) if _active is not None else nullcontext()
+
+
+def record_read(path: Path) -> None:
+    """計測中のステップに、読み込んだファイル（サイズ）を記録する"""
+
+    if _active is not None:
+        _active.record_file("read", path)
+
+
+def record_write(path: Path) -> None:
+    """計測中のステップに、書き出したファイル（サイズ）を記録する"""
+
+    if _active is not None:
+        _active.record_file("write", path)
+
+
+def qc_enabled() -> bool:
+    """QC 統計を計算するか（instrumentation.qc。実行の外では True）"""
+
+    return _qc
+
+
+def value_counts_u8(array: np.ndarray, name: str | None = None) -> list[tuple[int, int]]:
+    """uint8 ラスタの値ごとの画素数（出現した値だけ）。np.unique のソートの代わりに bincount を使う"""
+
+    counts = np.bincount(array.ravel(), minlength=2)
+    vals = np.flatnonzero(counts)
+    out = list(zip(vals.tolist(), counts[vals].tolist()))
+    if name is not None and _active is not None:
+        _active.record_qc(name, out)
+    return out
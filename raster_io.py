@@ -0,0 +1,243 @@
+"""
+GeoTIFF 書き出しの共通処理
+- 内部タイル化 + オーバービュー付きの Cloud-Optimized GeoTIFF（COG）レイアウト
+- 予測子は整数なら 2（水平差分）、浮動小数なら 3（浮動小数予測）
+- 圧縮コーデックは LZW / ZSTD / DEFLATE から選択
+- 2値マスク（0/1 の uint8）は NBITS=1 で書き出してサイズを抑える
+
+ブロック単位で書き込む場合も open_raster() で開けば、閉じたときに COG へ変換される。
+既存ファイルの一部だけを書き換える場合は update_raster() を使う。
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+import os
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+from instrumentation import record_write
+
+
+CODECS = ("lzw", "zstd", "deflate")
+
+# 出力 profile に引き継ぐキー（入力ラスタ由来のタイル設定などは捨てる）
+_PROFILE_KEYS = ("width", "height", "count", "dtype", "crs", "transform", "nodata")
+
+
+@dataclass
+class RasterWriteOptions:
+    """GeoTIFF 出力の設定"""
+
+    codec: str = "lzw"             # "lzw" / "zstd" / "deflate"
+    level: int | None = None       # ZSTD / DEFLATE の圧縮レベル（None で GDAL 既定）
+    cog: bool = True               # タイル化 + オーバービューの COG レイアウトで書き出す
+    blocksize: int = 512           # 内部タイルのサイズ（px, 16の倍数）
+    overviews: bool = True         # オーバービューを作る（cog=True のときのみ）
+    overview_min_size: int = 256   # オーバービューの最小辺（px）。これより小さい段は作らない
+    nbits_masks: bool = True       # 2値マスクを NBITS=1 で書き出す
+
+    def __post_init__(self) -> None:
+        self.codec = self.codec.lower()
+        if self.codec not in CODECS:
+            raise ValueError(f"unknown codec: {self.codec} (choose from {CODECS})")
+        if self.blocksize % 16 != 0:
+            raise ValueError(f"blocksize must be a multiple of 16: {self.blocksize}")
+
+
+def write_options_from_dict(d: dict | None) -> RasterWriteOptions:
+    """YAML の output セクションから RasterWriteOptions を作る"""
+
+    d = d or {}
+    default = RasterWriteOptions()
+    return RasterWriteOptions(
+        codec=str(d.get("codec", default.codec)),
+        level=d.get("level", default.level),
+        cog=bool(d.get("cog", default.cog)),
+        blocksize=int(d.get("blocksize", default.blocksize)),
+        overviews=bool(d.get("overviews", default.overviews)),
+        overview_min_size=int(d.get("overview_min_size", default.overview_min_size)),
+        nbits_masks=bool(d.get("nbits_masks", default.nbits_masks)),
+    )
+
+
+# ============================
+# profile の組み立て
+# ============================
+
+def creation_profile(profile: dict, options: RasterWriteOptions, mask: bool = False) -> dict:
+    """配列の形・型・座標系だけを profile から取り出し、圧縮・タイル設定を付け直す"""
+
+    out = {k: profile[k] for k in _PROFILE_KEYS if k in profile}
+    out.update(driver="GTiff", compress=options.codec, BIGTIFF="IF_SAFER")
+
+    if mask and options.nbits_masks:
+        # 1bit の画素に予測子は効かない
+        out.update(nbits=1, predictor=1)
+    elif np.dtype(out["dtype"]).kind == "f":
+        out.update(predictor=3)
+    else:
+        out.update(predictor=2)
+
+    if options.level is not None:
+        if options.codec == "zstd":
+            out.update(zstd_level=options.level)
+        elif options.codec == "deflate":
+            out.update(zlevel=options.level)
+
+    if options.cog:
+        out.update(tiled=True, blockxsize=options.blocksize, blockysize=options.blocksize)
+    return out
+
+
+def overview_factors(width: int, height: int, min_size: int) -> list[int]:
+    """最小辺が min_size を下回らない範囲で 2, 4, 8, ... の縮小率を返す"""
+
+    factors = []
+    f = 2
+    while max(width, height) // f >= min_size:
+        factors.append(f)
+        f *= 2
+    return factors
+
+
+def default_resampling(dtype, mask: bool = False) -> Resampling:
+    """オーバービューのリサンプリング（浮動小数は平均、整数・マスクは最近傍）"""
+
+    if not mask and np.dtype(dtype).kind == "f":
+        return Resampling.average
+    return Resampling.nearest
+
+
+# ============================
+# 書き出し
+# ============================
+
+@contextmanager
+def open_raster(
+    out_tif: Path,
+    profile: dict,
+    options: RasterWriteOptions | None = None,
+    mask: bool = False,
+    resampling: Resampling | None = None,
+    sparse: bool = False,
+) -> Iterator[rasterio.io.DatasetWriter]:
+    """書き込み用に GeoTIFF を開く。ブロック単位の書き込みにも使える
+
+    cog=True の場合は一時ファイルに書き込み、閉じたときにオーバービューを作って
+    COG レイアウト（IFD とオーバービューを先頭に置いた GeoTIFF）でコピーする。
+    sparse=True なら書き込まなかったタイル（と全画素 NoData/0 のタイル）はファイルに持たない。
+    """
+
+    options = options or RasterWriteOptions()
+    out_tif = Path(out_tif)
+    out_tif.parent.mkdir(parents=True, exist_ok=True)
+    final = creation_profile(profile, options, mask)
+    if sparse:
+        final.update(sparse_ok=True)
+
+    if not options.cog:
+        with rasterio.open(out_tif, "w", **final) as dst:
+            yield dst
+        record_write(out_tif)
+        return
+
+    # 一時ファイルは NBITS なしの uint8 で書き、最終コピーで NBITS=1 にする
+    tmp = out_tif.with_name(out_tif.name + ".tmp.tif")
+    work = {k: v for k, v in final.items() if k not in ("nbits", "zstd_level", "zlevel")}
+
+    try:
+        with rasterio.open(tmp, "w", **work) as dst:
+            yield dst
+
+            factors = (
+                overview_factors(dst.width, dst.height, options.overview_min_size)
+                if options.overviews else []
+            )
+            if factors:
+                dst.build_overviews(factors, resampling or default_resampling(dst.dtypes[0], mask))
+
+        _copy_as_cog(tmp, out_tif, final)
+    finally:
+        tmp.unlink(missing_ok=True)
+    record_write(out_tif)
+
+
+@contextmanager
+def update_raster(
+    path: Path,
+    options: RasterWriteOptions | None = None,
+    resampling: Resampling | None = None,
+) -> Iterator[rasterio.io.DatasetWriter]:
+    """既存の GeoTIFF を r+ で開き、ウィンドウ単位で書き換える
+
+    閉じたときに既存のオーバービューを作り直し、cog=True なら COG レイアウトへコピーし直す
+    （r+ で書き換えたタイルはファイル末尾に追記され、タイルの並びが崩れるため）。
+    """
+
+    options = options or RasterWriteOptions()
+    path = Path(path)
+
+    # タイルの並びが崩れることは承知の上で開く（閉じた後に COG レイアウトへ戻す）
+    with rasterio.open(path, "r+", IGNORE_COG_LAYOUT_BREAK="YES") as dst:
+        yield dst
+
+        mask = dst.tags(1, ns="IMAGE_STRUCTURE").get("NBITS") == "1"
+        factors = dst.overviews(1)
+        if factors:
+            dst.build_overviews(factors, resampling or default_resampling(dst.dtypes[0], mask))
+
+    if not options.cog:
+        record_write(path)
+        return
+
+    tmp = path.with_name(path.name + ".tmp.tif")
+    os.replace(path, tmp)
+    try:
+        with rasterio.open(tmp) as src:
+            final = creation_profile(src.profile, options, mask)
+        _copy_as_cog(tmp, path, final)
+    except BaseException:
+        os.replace(tmp, path)
+        raise
+    tmp.unlink(missing_ok=True)
+    record_write(path)
+
+
+def _copy_as_cog(src_tif: Path, out_tif: Path, final: dict) -> None:
+    """オーバービュー付きのタイル化 GeoTIFF を、オーバービューごと COG レイアウトでコピーする"""
+
+    copy_opts = {k: v for k, v in final.items() if k not in _PROFILE_KEYS and k != "driver"}
+    # NBITS=1 では TIFF に入らない色解釈が .aux.xml に書き出されるので、PAM を無効にする
+    with rasterio.Env(GDAL_PAM_ENABLED="NO"):
+        rasterio.shutil.copy(src_tif, out_tif, driver="GTiff", copy_src_overviews=True, **copy_opts)
+
+
+def write_raster(
+    out_tif: Path,
+    array: np.ndarray,
+    profile: dict,
+    descriptions: list[str] | None = None,
+    options: RasterWriteOptions | None = None,
+    mask: bool = False,
+    resampling: Resampling | None = None,
+) -> Path:
+    """配列を GeoTIFF に書き出す（2次元なら1バンド、3次元なら複数バンド）
+
+    mask=True は 0/1 の2値ラスタ用で、nbits_masks が有効なら NBITS=1 で保存する。
+    """
+
+    if array.ndim == 2:
+        with open_raster(out_tif, dict(profile, count=1), options, mask, resampling) as dst:
+            dst.write(array, 1)
+        return Path(out_tif)
+
+    with open_raster(out_tif, dict(profile, count=array.shape[0]), options, mask, resampling) as dst:
+        dst.write(array)
+        for i, desc in enumerate(descriptions or [], start=1):
+            dst.set_band_description(i, desc)
+    return Path(out_tif)
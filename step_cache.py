@@ -0,0 +1,255 @@
+"""
+パイプライン各ステップの結果キャッシュ
+- 入力ファイルのフィンガープリント（mtime+サイズ or 内容ハッシュ）とパラメータからキーを作る
+- キーが manifest に登録済みならステップを実行せず、保存済みの結果を再利用する
+- 合計サイズが上限を超えたら、最後に使われた時刻が古いものから削除する（LRU）
+- manifest はロックファイルで排他して読み直してから更新し、一時ファイル + os.replace で置き換える
+  （同じキャッシュを複数のプロセスが使っても、登録が失われたり壊れた manifest を読んだりしない）
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# アルゴリズムを変えて過去の結果を無効にしたい場合に上げる
+CACHE_VERSION = 1
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "manifest.lock"
+
+
+def file_fingerprint(path: Path, key_mode: str = "mtime") -> str:
+    """入力ファイルのフィンガープリントを返す
+
+    key_mode:
+        "mtime": 絶対パス + サイズ + 更新時刻（高速）
+        "hash" : ファイル内容の SHA-256（コピーや touch に影響されない）
+    """
+
+    path = Path(path)
+    st = path.stat()
+
+    if key_mode == "mtime":
+        return f"{path.resolve()}:{st.st_size}:{st.st_mtime_ns}"
+
+    if key_mode == "hash":
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return f"sha256:{h.hexdigest()}"
+
+    raise ValueError(f"unknown key_mode: {key_mode}")
+
+
+class StepCache:
+    """ステップ単位の結果キャッシュ
+
+    enabled=False の場合はキャッシュせず、毎回 compute / produce を実行する。
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_bytes: int,
+        key_mode: str = "mtime",
+        enabled: bool = True,
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = int(max_bytes)
+        self.key_mode = key_mode
+        self.enabled = enabled
+
+        if self.enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # ----------------------------
+    # キー
+    # ----------------------------
+
+    def fingerprint(self, path: Path) -> str:
+        return file_fingerprint(path, self.key_mode)
+
+    def key(self, step: str, *parts: Any) -> str:
+        """ステップ名・入力フィンガープリント・パラメータからキーを作る
+
+        上流ステップのキーを parts に含めると、上流が変わったときに下流も無効になる。
+        """
+
+        payload = json.dumps([CACHE_VERSION, step, *parts], default=str, sort_keys=True)
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+        return f"{step}-{digest}"
+
+    # ----------------------------
+    # 取得 / 登録
+    # ----------------------------
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        """キャッシュ済みならその結果を、なければ compute() の結果を保存して返す"""
+
+        if not self.enabled:
+            return compute()
+
+        manifest = self._load_manifest()
+        entry = manifest.get(key)
+        if entry is not None and (self.cache_dir / entry["files"][0]).exists():
+            print(f"[Cache] hit: {key}")
+            self._touch(key)
+            with open(self.cache_dir / entry["files"][0], "rb") as f:
+                return pickle.load(f)
+
+        result = compute()
+
+        fname = f"{key}.pkl"
+        tmp = self._temp_path(fname)
+        with open(tmp, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.cache_dir / fname)
+        self._register(key, [fname])
+        return result
+
+    def get_or_produce_file(self, key: str, out_path: Path, produce: Callable[[], Any]) -> Path:
+        """ファイルを出力するステップ用。キャッシュ済みならファイルを out_path へ復元する"""
+
+        return self.get_or_produce_files(key, [out_path], produce)[0]
+
+    def get_or_produce_files(self, key: str, out_paths: list[Path], produce: Callable[[], Any]) -> list[Path]:
+        """複数ファイルを出力するステップ用。キャッシュ済みなら全ファイルを復元する"""
+
+        out_paths = [Path(p) for p in out_paths]
+        if not self.enabled:
+            produce()
+            return out_paths
+
+        # get_or_compute（配列）の結果とは別エントリとして管理する
+        key = f"{key}.file"
+
+        manifest = self._load_manifest()
+        entry = manifest.get(key)
+        if entry is not None and all((self.cache_dir / f).exists() for f in entry["files"]):
+            self._touch(key)
+            for fname, out_path in zip(entry["files"], out_paths):
+                print(f"[Cache] hit: {key} -> {out_path}")
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(self.cache_dir / fname, out_path)
+            return out_paths
+
+        produce()
+
+        fnames = []
+        for i, out_path in enumerate(out_paths):
+            fname = f"{key}.{i}{out_path.suffix}"
+            tmp = self._temp_path(fname)
+            shutil.copyfile(out_path, tmp)
+            os.replace(tmp, self.cache_dir / fname)
+            fnames.append(fname)
+        self._register(key, fnames)
+        return out_paths
+
+    # ----------------------------
+    # manifest / LRU
+    # ----------------------------
+
+    def _manifest_path(self) -> Path:
+        return self.cache_dir / MANIFEST_NAME
+
+    def _temp_path(self, fname: str) -> Path:
+        """cache_dir 内の一意な一時ファイル（os.replace で fname に置き換える前の書き込み先）"""
+
+        fd, tmp = tempfile.mkstemp(prefix=f"{fname}.", suffix=".tmp", dir=self.cache_dir)
+        os.close(fd)
+        return Path(tmp)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """manifest の読み直し〜保存をプロセス間で排他する（ロックファイルへの排他ロック）"""
+
+        with open(self.cache_dir / LOCK_NAME, "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK は約10秒で諦めるので取れるまで繰り返す
+                        continue
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _load_manifest(self) -> dict:
+        """登録済みエントリを返す。CACHE_VERSION が異なる manifest は空とみなす
+
+        manifest は os.replace で丸ごと置き換えるので、ロックなしで読んでも書きかけは見えない。
+        """
+
+        path = self._manifest_path()
+        if not path.exists():
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != CACHE_VERSION:
+            return {}
+        return data["entries"]
+
+    def _save_manifest(self, manifest: dict) -> None:
+        """manifest を書き換える（_locked() の中で呼ぶ）"""
+
+        tmp = self._temp_path(MANIFEST_NAME)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "entries": manifest}, f, indent=1)
+        os.replace(tmp, self._manifest_path())
+
+    def _touch(self, key: str) -> None:
+        with self._locked():
+            manifest = self._load_manifest()
+            if key in manifest:
+                manifest[key]["last_used"] = time.time()
+                self._save_manifest(manifest)
+
+    def _register(self, key: str, fnames: list[str]) -> None:
+        # compute() の間に他のプロセスが登録したエントリを消さないよう、ロックしてから読み直す
+        with self._locked():
+            manifest = self._load_manifest()
+            manifest[key] = {
+                "files": fnames,
+                "bytes": sum((self.cache_dir / f).stat().st_size for f in fnames),
+                "last_used": time.time(),
+            }
+            self._evict(manifest, keep=key)
+            self._save_manifest(manifest)
+
+    def _evict(self, manifest: dict, keep: str) -> None:
+        """合計サイズが max_bytes 以下になるまで、古い順に削除する（keep は残す）"""
+
+        total = sum(e["bytes"] for e in manifest.values())
+        for key in sorted(manifest, key=lambda k: manifest[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = manifest.pop(key)
+            for fname in entry["files"]:
+                (self.cache_dir / fname).unlink(missing_ok=True)
+            total -= entry["bytes"]
+            print(f"[Cache] evicted: {key}")
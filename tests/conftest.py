@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# リポジトリ直下のモジュール（flow.py など）を import できるようにする
+sys.path.insert(0, str(ROOT))
+
+# リポジトリに含まれるサンプルデータ（flow_analysis/）
+SAMPLE_DIR = ROOT / "flow_analysis"
+
+
+@pytest.fixture(scope="session")
+def yakatabaru() -> tuple[np.ndarray, np.ndarray]:
+    """サンプル DEM（flow_analysis/yakatabaru.tif）と NoData マスク"""
+
+    with rasterio.open(SAMPLE_DIR / "yakatabaru.tif") as src:
+        dem = src.read(1).astype(np.float32)
+        nodata = src.nodata
+    mask = ~np.isfinite(dem) if nodata is None else (dem == nodata) | ~np.isfinite(dem)
+    return dem, mask
+
+
+@pytest.fixture(scope="session")
+def flow_dir_d8() -> np.ndarray:
+    """サンプルの D8 流向（flow_analysis/flow_dir_d8.tif, 1..8, 流れ先なし 0）"""
+
+    with rasterio.open(SAMPLE_DIR / "flow_dir_d8.tif") as src:
+        return src.read(1)
@@ -0,0 +1,83 @@
+"""
+距離計算の2つのエンジン（bounded: 半径内だけ探索 / edt: 全画像の距離変換）の一致と Params の検証
+"""
+
+import numpy as np
+import pytest
+import rasterio
+
+from DEM_to_slope_risk_PL import (
+    Params,
+    _distance_m_float32,
+    bounded_distance_m,
+    compute_highrisk_score_stack,
+    compute_highrisk_stack,
+    landcover_lut,
+)
+
+PIXEL_SIZE = 2.5
+
+
+@pytest.fixture
+def masks() -> tuple[np.ndarray, np.ndarray]:
+    """疎な危険斜面（source）と建物（house）"""
+
+    rng = np.random.default_rng(3)
+    slope = rng.random((80, 90)) < 0.01
+    house = rng.random((80, 90)) < 0.2
+    return slope, house
+
+
+@pytest.mark.parametrize("radius_m", [5.0, 12.5, 30.0])
+def test_bounded_matches_edt_within_radius_and_is_inf_beyond(masks, radius_m):
+    slope, house = masks
+    idx = np.flatnonzero(house)
+    bounded = bounded_distance_m(slope, idx, PIXEL_SIZE, radius_m)
+    edt = _distance_m_float32(~slope, PIXEL_SIZE).ravel()[idx]
+
+    within = edt <= np.float32(radius_m)
+    assert within.any() and (~within).any()
+    np.testing.assert_array_equal(bounded[within].astype(np.float32), edt[within])
+    assert np.all(np.isinf(bounded[~within]))
+
+
+def test_highrisk_stack_is_the_same_for_both_engines(masks):
+    slope, house = masks
+    transform = rasterio.Affine(PIXEL_SIZE, 0, 0, 0, -PIXEL_SIZE, 0)
+    radii = [5.0, 12.5, 30.0]
+    bounded = compute_highrisk_stack(house.astype(np.uint8), slope.astype(np.uint8), transform, radii, "bounded")
+    edt = compute_highrisk_stack(house.astype(np.uint8), slope.astype(np.uint8), transform, radii, "edt")
+    np.testing.assert_array_equal(bounded, edt)
+
+
+def test_params_rejects_unknown_distance_engine():
+    with pytest.raises(ValueError, match="distance_engine"):
+        Params(slope_threshold=30.0, risk_radius_m=10.0, distance_engine="EDT")
+    assert Params(slope_threshold=30.0, risk_radius_m=10.0, distance_engine="edt").distance_engine == "edt"
+
+
+def test_landcover_score_stack_uses_the_requested_engine(masks):
+    slope, house = masks
+    transform = rasterio.Affine(PIXEL_SIZE, 0, 0, 0, -PIXEL_SIZE, 0)
+    radii = [5.0, 12.5, 30.0]
+    landcover = np.random.default_rng(4).integers(0, 4, slope.shape).astype(np.uint8)
+    lut = landcover_lut({0: 0.25, 1: 0.5, 2: 1.0, 3: 2.0}, 1.0, None, np.uint8)
+
+    # 総当たり: 建物セルごとに、最寄りの（同じ距離なら全ての）危険斜面セルの係数
+    src_r, src_c = np.nonzero(slope)
+    bld_r, bld_c = np.nonzero(house)
+    d2 = (bld_r[:, None] - src_r) ** 2 + (bld_c[:, None] - src_c) ** 2
+    nearest_weights = [set(lut[landcover[src_r[d == d.min()], src_c[d == d.min()]]]) for d in d2]
+
+    args = (house.astype(np.uint8), slope.astype(np.uint8), landcover, lut, transform, radii)
+    for engine in ("bounded", "edt"):
+        risk, score = compute_highrisk_score_stack(*args, engine)
+        np.testing.assert_array_equal(risk, compute_highrisk_stack(*args[:2], transform, radii, engine))
+        # 係数は半径内の最寄り危険斜面の係数（同じ距離の最寄りが複数あれば、そのどれか）
+        for risk_zone, score_zone in zip(risk, score):
+            assert np.array_equal(score_zone > 0, risk_zone == 1)
+            got = score_zone[house]
+            assert all(g in w for g, w, r in zip(got, nearest_weights, risk_zone[house]) if r)
+
+    with pytest.raises(ValueError, match="distance_engine"):
+        compute_highrisk_score_stack(*args, "EDT")
@@ -0,0 +1,89 @@
+"""
+flow.py のベクトル化した D8 流向・集水面積が、セル単位ループの参照実装と同じ結果になることの確認
+"""
+
+import numpy as np
+import pytest
+
+import flow
+
+
+def _random(rng):
+    return (rng.random((40, 50)) * 100.0).astype(np.float32), np.zeros((40, 50), dtype=bool)
+
+
+def _tied(rng):
+    # 整数の標高（0..2）で同じ落差の方向が多数できる。コードの小さい方を採ること
+    return rng.integers(0, 3, (40, 50)).astype(np.float32), np.zeros((40, 50), dtype=bool)
+
+
+def _flat(rng):
+    return np.full((20, 30), 5.0, dtype=np.float32), np.zeros((20, 30), dtype=bool)
+
+
+def _nodata_adjacent(rng):
+    # NoData 値（-9999）は最も低いので、マスクを無視すると必ず流れ先に選ばれてしまう
+    dem, _ = _random(rng)
+    mask = rng.random(dem.shape) < 0.1
+    mask[10:20, 15:30] = True
+    mask[:, 0] = True
+    dem[mask] = -9999.0
+    return dem, mask
+
+
+@pytest.mark.parametrize("make", [_random, _tied, _flat, _nodata_adjacent],
+                         ids=["random", "tied", "flat", "nodata"])
+def test_d8_matches_reference(make):
+    dem, mask = make(np.random.default_rng(0))
+    fdir = flow.d8_flow_direction(dem, mask)
+    assert np.array_equal(fdir, flow.d8_flow_direction_reference(dem, mask))
+
+
+def test_d8_flat_has_no_receiver():
+    dem, mask = _flat(None)
+    assert not flow.d8_flow_direction(dem, mask).any()
+
+
+def test_d8_matches_reference_on_sample_dem(yakatabaru):
+    dem, mask = yakatabaru
+    for z in (dem, flow.fill_depressions(dem, mask)):
+        assert np.array_equal(flow.d8_flow_direction(z, mask), flow.d8_flow_direction_reference(z, mask))
+
+
+# ============================
+# 集水面積
+# ============================
+
+def _accumulation_case(rng):
+    """外周セルの流れ先がグリッドの外・NoData セルが流れ込みを受ける、循環のない流向"""
+
+    dem = (rng.random((42, 52)) * 100.0).astype(np.float32)
+    # 一回り大きい DEM の D8 を切り出すと、外周セルの多くはグリッドの外へ流れる
+    fdir = flow.d8_flow_direction(dem, np.zeros(dem.shape, dtype=bool))[1:-1, 1:-1].copy()
+    # マスクなしで求めた流向にあとから NoData を置くので、NoData へ流れ込むセルができる
+    mask = rng.random(fdir.shape) < 0.05
+    mask[15:22, 20:35] = True
+    return fdir, mask
+
+
+def test_accumulation_case_has_border_and_nodata_receivers():
+    fdir, mask = _accumulation_case(np.random.default_rng(1))
+    recv = flow.flow_receivers(fdir, mask)
+    border = np.zeros(fdir.shape, dtype=bool)
+    border[[0, -1], :] = border[:, [0, -1]] = True
+    assert np.any(border.ravel() & (fdir.ravel() > 0) & (recv < 0))
+    assert np.any(~mask.ravel() & (fdir.ravel() > 0) & (recv < 0) & ~border.ravel())
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_flow_accumulation_matches_reference(seed):
+    fdir, mask = _accumulation_case(np.random.default_rng(seed))
+    acc = flow.flow_accumulation(fdir, mask)
+    assert np.array_equal(acc, flow.flow_accumulation_reference(fdir, mask))
+
+
+def test_flow_accumulation_matches_reference_on_sample_dem(yakatabaru):
+    dem, mask = yakatabaru
+    fdir = flow.d8_flow_direction(flow.fill_depressions(dem, mask), mask)
+    acc = flow.flow_accumulation(fdir, mask)
+    assert np.array_equal(acc, flow.flow_accumulation_reference(fdir, mask))
@@ -0,0 +1,205 @@
+"""
+flow_kernels（Cython）と flow.py の Python 実装が同じ結果になることの確認
+- 窪地埋め: 埋めた後の標高をビット単位で比較（合成 DEM と flow_analysis/yakatabaru.tif）
+- 上流探索: 起点の集合ごとに上流セルの列を比較（合成 DEM と flow_analysis/flow_dir_d8.tif）
+
+カーネルとの比較は flow_kernels をビルドしていない環境（python build_kernels.py 未実行）ではスキップする。
+Python 実装（フォールバック）の既知の結果との比較は常に実行する。
+"""
+
+import numpy as np
+import pytest
+
+import flow
+
+try:
+    import flow_kernels
+except ImportError:
+    flow_kernels = None
+
+needs_kernels = pytest.mark.skipif(
+    flow_kernels is None, reason="flow_kernels is not built (python build_kernels.py)"
+)
+
+
+def random_dem(rng: np.random.Generator, shape=(120, 150)) -> np.ndarray:
+    """起伏と窪地の多いランダムな DEM"""
+
+    return (rng.random(shape) * 100.0).astype(np.float32)
+
+
+def tie_heavy_dem(rng: np.random.Generator, shape=(120, 150)) -> np.ndarray:
+    """標高が数段階しかない（平坦部と同じ標高のセルが多い）DEM"""
+
+    return rng.integers(0, 4, size=shape).astype(np.float32)
+
+
+def nodata_dem(rng: np.random.Generator, shape=(120, 150)) -> tuple[np.ndarray, np.ndarray]:
+    """NoData の穴（点と矩形）を含む DEM"""
+
+    dem = random_dem(rng, shape)
+    mask = rng.random(shape) < 0.05
+    mask[30:50, 40:90] = True
+    mask[:, 0] = True
+    dem[mask] = -9999.0
+    return dem, mask
+
+
+def _cases():
+    rng = np.random.default_rng(0)
+    shape = (120, 150)
+    yield "random", random_dem(rng, shape), np.zeros(shape, dtype=bool)
+    yield "ties", tie_heavy_dem(rng, shape), np.zeros(shape, dtype=bool)
+    yield "flat", np.full(shape, 5.0, dtype=np.float32), np.zeros(shape, dtype=bool)
+    dem, mask = nodata_dem(rng, shape)
+    yield "nodata", dem, mask
+    dem = tie_heavy_dem(rng, shape)
+    dem[mask] = -9999.0
+    yield "ties+nodata", dem, mask
+
+
+CASES = list(_cases())
+IDS = [c[0] for c in CASES]
+
+
+def _fill(dem: np.ndarray, mask: np.ndarray, kernels, monkeypatch) -> np.ndarray:
+    monkeypatch.setattr(flow, "_kernels", kernels)
+    return flow.fill_depressions(dem, mask)
+
+
+# ============================
+# Python 実装（フォールバック）: 既知の結果
+# ============================
+
+def test_priority_flood_python_known_result(monkeypatch):
+    """窪地（1, 2, 2）は縁の 5 から nextafter ずつ高くなり、縁より高いセル（7）はそのまま"""
+
+    dem = np.array(
+        [
+            [5, 5, 5, 5],
+            [5, 1, 2, 5],
+            [5, 2, 7, 5],
+            [5, 5, 5, 5],
+        ],
+        dtype=np.float32,
+    )
+    filled = _fill(dem, np.zeros(dem.shape, dtype=bool), None, monkeypatch)
+
+    up = np.float32(np.inf)
+    e1 = np.nextafter(np.float32(5), up)
+    e2 = np.nextafter(e1, up)
+    expected = dem.copy()
+    expected[1, 1] = e1
+    expected[1, 2] = expected[2, 1] = e2
+    assert np.array_equal(filled.view(np.uint32), expected.view(np.uint32))
+
+
+def test_trace_upstream_python_known_result():
+    # 0 ← 1 ← 2, 1 ← 3 ← 4, 5 は孤立（流れ先なし）
+    recv = np.array([-1, 0, 1, 1, 3, -1], dtype=np.int64)
+    indptr, donors = flow.donor_index(recv)
+    trace = lambda starts: flow.trace_upstream_python(indptr, donors, np.array(starts, dtype=np.int64)).tolist()
+
+    assert trace([1]) == [1, 2, 3, 4]
+    assert trace([0]) == [0, 1, 2, 3, 4]
+    assert trace([3, 5]) == [3, 4, 5]
+    assert trace([2]) == [2]
+
+
+@pytest.mark.parametrize("compiled", [False, pytest.param(True, marks=needs_kernels)], ids=["python", "kernels"])
+def test_trace_upstream_stops_on_cycles(compiled):
+    # 1 → 2 → 3 → 1 の循環と、循環へ流れ込む 4。訪問済み配列がなくても起点 1 に戻ったところで止まる
+    recv = np.array([-1, 2, 3, 1, 2], dtype=np.int64)
+    indptr, donors = flow.donor_index(recv)
+    trace = flow_kernels.trace_upstream if compiled else flow.trace_upstream_python
+    assert trace(indptr, donors, np.array([1], dtype=np.int64)).tolist() == [1, 2, 3, 4]
+    assert trace(indptr, donors, np.array([0], dtype=np.int64)).tolist() == [0]
+
+
+# ============================
+# カーネルと Python 実装の一致
+# ============================
+
+@needs_kernels
+@pytest.mark.parametrize("name, dem, mask", CASES, ids=IDS)
+def test_priority_flood_parity(name, dem, mask, monkeypatch):
+    filled_c = _fill(dem, mask, flow_kernels, monkeypatch)
+    filled_py = _fill(dem, mask, None, monkeypatch)
+    assert np.array_equal(filled_c.view(np.uint32), filled_py.view(np.uint32))
+
+
+@pytest.mark.parametrize("name, dem, mask", CASES, ids=IDS)
+def test_filled_dem_drains(name, dem, mask, monkeypatch):
+    """埋めた後は、出口（外周・NoData に接するセル）以外の全セルに流れ先がある"""
+
+    filled = _fill(dem, mask, flow_kernels, monkeypatch)  # カーネルがなければ Python 実装
+    fdir = flow.d8_flow_direction(filled, mask)
+    assert np.all(filled[~mask] >= dem[~mask])
+
+    edge = np.zeros(mask.shape, dtype=bool)
+    edge[[0, -1], :] = True
+    edge[:, [0, -1]] = True
+    padded = np.pad(mask, 1, constant_values=True)
+    for dr, dc in flow.DIRS:
+        edge |= padded[1 + dr:mask.shape[0] + 1 + dr, 1 + dc:mask.shape[1] + 1 + dc]
+    assert not np.any((fdir == 0) & ~mask & ~edge)
+
+
+@needs_kernels
+def test_priority_flood_parity_on_sample_dem(yakatabaru, monkeypatch):
+    dem, mask = yakatabaru
+    filled_c = _fill(dem, mask, flow_kernels, monkeypatch)
+    filled_py = _fill(dem, mask, None, monkeypatch)
+    assert np.array_equal(filled_c.view(np.uint32), filled_py.view(np.uint32))
+
+
+@needs_kernels
+@pytest.mark.parametrize("name, dem, mask", CASES, ids=IDS)
+def test_trace_upstream_parity(name, dem, mask, monkeypatch):
+    filled = _fill(dem, mask, flow_kernels, monkeypatch)
+    recv = flow.flow_receivers(flow.d8_flow_direction(filled, mask), mask)
+    indptr, donors = flow.donor_index(recv)
+
+    rng = np.random.default_rng(1)
+    valid = np.flatnonzero(~mask.ravel())
+    outlets = np.flatnonzero((recv < 0) & ~mask.ravel())
+    for starts in (
+        valid[:1],
+        rng.choice(valid, 50, replace=False),
+        outlets,
+        np.arange(recv.size),
+    ):
+        starts = np.unique(starts.astype(np.int64))
+        got = flow_kernels.trace_upstream(indptr, donors, starts)
+        ref = flow.trace_upstream_python(indptr, donors, starts)
+        assert np.array_equal(got, ref)
+
+
+@needs_kernels
+def test_trace_upstream_parity_on_sample_flow_dir(flow_dir_d8):
+    # 流向 0 は流れ先なし（NoData も 0）。flow_query.load_flow_index と同じ作り方
+    recv = flow.flow_receivers(flow_dir_d8, np.zeros(flow_dir_d8.shape, dtype=bool))
+    indptr, donors = flow.donor_index(recv)
+
+    rng = np.random.default_rng(2)
+    outlets = np.flatnonzero(recv < 0)
+    for starts in (
+        rng.choice(recv.size, 1, replace=False),
+        rng.choice(recv.size, 200, replace=False),
+        outlets,
+    ):
+        starts = np.unique(starts.astype(np.int64))
+        got = flow_kernels.trace_upstream(indptr, donors, starts)
+        ref = flow.trace_upstream_python(indptr, donors, starts)
+        assert np.array_equal(got, ref)
+
+
+@needs_kernels
+def test_trace_upstream_from_outlets_covers_all_valid_cells(monkeypatch):
+    _, dem, mask = CASES[IDS.index("nodata")]
+    filled = _fill(dem, mask, flow_kernels, monkeypatch)
+    recv = flow.flow_receivers(flow.d8_flow_direction(filled, mask), mask)
+    indptr, donors = flow.donor_index(recv)
+    outlets = np.flatnonzero((recv < 0) & ~mask.ravel())
+    got = flow_kernels.trace_upstream(indptr, donors, outlets.astype(np.int64))
+    assert np.array_equal(got, np.flatnonzero(~mask.ravel()))
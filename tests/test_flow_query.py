@@ -0,0 +1,65 @@
+"""
+flow_query のまとめた問い合わせ（1回の上流探索による塗り分け）が、地点ごとに上流をたどった結果と一致することの確認
+"""
+
+import numpy as np
+import pytest
+import rasterio
+
+import flow
+from flow_query import (
+    FlowIndex,
+    batch_upstream_area,
+    catchment_labels,
+    downstream_path,
+    downstream_paths,
+    upstream_cells,
+)
+
+
+@pytest.fixture
+def index() -> FlowIndex:
+    rng = np.random.default_rng(7)
+    dem = (rng.random((60, 80)) * 50.0).astype(np.float32)
+    nodata = np.zeros(dem.shape, dtype=bool)
+    nodata[20:25, 30:50] = True
+    dem = flow.fill_depressions(dem, nodata)
+    recv = flow.flow_receivers(flow.d8_flow_direction(dem, nodata), nodata)
+    indptr, donors = flow.donor_index(recv)
+    return FlowIndex(recv, indptr, donors, rasterio.Affine(2.0, 0, 0, 0, -2.0, 0), None, dem.shape)
+
+
+@pytest.fixture
+def cells(index: FlowIndex) -> np.ndarray:
+    """ランダムな地点に、重複・範囲外・入れ子（別の地点のすぐ下流）の地点を足したもの"""
+
+    rng = np.random.default_rng(8)
+    c = rng.integers(0, index.recv.size, 40)
+    nested = index.recv[c[:10]]
+    return np.concatenate([c, c[:5], [-1], nested[nested >= 0]])
+
+
+def test_batch_upstream_area_matches_single_traces(index, cells):
+    expected = [upstream_cells(index, c).size * index.cell_area if c >= 0 else np.nan for c in cells]
+    np.testing.assert_array_equal(batch_upstream_area(index, cells), expected)
+
+
+def test_catchment_labels_assign_nearest_downstream_point(index, cells):
+    # 大きい集水域から塗り、上流側の小さい集水域で上書きする（同じセルの地点は後の地点）
+    expected = np.zeros(index.recv.size, dtype=np.int32)
+    catchments = [(upstream_cells(index, c), i + 1) for i, c in enumerate(cells) if c >= 0]
+    catchments.sort(key=lambda t: t[0].size, reverse=True)
+    for up, label in catchments:
+        expected[up] = label
+
+    np.testing.assert_array_equal(catchment_labels(index, cells), expected.reshape(index.shape))
+
+
+def test_downstream_paths_match_single_paths(index, cells):
+    owner, path = downstream_paths(index, cells)
+    for i, c in enumerate(cells):
+        got = path[owner == i]
+        if c < 0:
+            assert got.size == 0
+        else:
+            np.testing.assert_array_equal(got, downstream_path(index, c))
@@ -0,0 +1,120 @@
+"""
+建物レイヤの差分更新（dirty_windows → highrisk_window → patch_highrisk_windows）の結果が、
+同じ建物で全体を計算し直した Step4 のラスタと一致することの確認
+"""
+
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+import shapely
+
+from DEM_to_slope_risk_PL import Config, IOConfig, Params, RunOptions, highrisk_output_paths, run_pipeline
+
+PIXEL_SIZE = 2.0
+X0, Y0 = 1000.0, 2000.0
+SHAPE = (100, 120)
+CRS = "EPSG:6670"
+
+# fid → 建物（外接矩形）。2 と 4 は隣り合い、5 はラスタの右下の角にある
+BUILDINGS = {
+    1: (1020, 1900, 1030, 1910),
+    2: (1060, 1900, 1072, 1912),
+    3: (1100, 1850, 1110, 1860),
+    4: (1073, 1900, 1080, 1912),
+    5: (1232, 1800, 1240, 1808),
+    6: (1150, 1950, 1160, 1960),
+}
+
+# 2: 形を変更、3: 削除、5: ラスタの外へはみ出すよう変更、7: 4 のすぐ右に追加、8: ラスタの左端に追加
+EDITED = {
+    **{fid: b for fid, b in BUILDINGS.items() if fid != 3},
+    2: (1058, 1898, 1071, 1913),
+    5: (1228, 1796, 1244, 1810),
+    7: (1081, 1900, 1088, 1910),
+    8: (1000, 1940, 1006, 1950),
+}
+
+
+def write_buildings(path: Path, buildings: dict[int, tuple]) -> Path:
+    gdf = gpd.GeoDataFrame(
+        {"fid": list(buildings)}, geometry=[shapely.box(*b) for b in buildings.values()], crs=CRS
+    )
+    gdf.to_file(path, driver="GPKG")
+    return path
+
+
+@pytest.fixture
+def grid(tmp_path) -> tuple[Path, Path]:
+    """平地に 2 本の急斜面（約 39 度）の帯がある DEM（NoData の穴あり）と、同じグリッドの参照ラスタ
+
+    帯は x = 1080〜1140 m と y = 1940〜1960 m。建物の一部だけが半径内に入るように置いている。
+    """
+
+    y, x = np.mgrid[0:SHAPE[0], 0:SHAPE[1]] * PIXEL_SIZE
+    dem = 100.0 + 0.8 * np.clip(x - 80.0, 0.0, 60.0) + 0.8 * np.clip(y - 40.0, 0.0, 20.0)
+    dem[60:66, 30:40] = -9999.0
+
+    profile = dict(
+        driver="GTiff", height=SHAPE[0], width=SHAPE[1], count=1, crs=CRS,
+        transform=rasterio.Affine(PIXEL_SIZE, 0, X0, 0, -PIXEL_SIZE, Y0),
+    )
+    dem_tif, ref_tif = tmp_path / "dem.tif", tmp_path / "ref.tif"
+    with rasterio.open(dem_tif, "w", dtype="float64", nodata=-9999.0, **profile) as dst:
+        dst.write(dem, 1)
+    with rasterio.open(ref_tif, "w", dtype="uint8", **profile) as dst:
+        dst.write(np.zeros(SHAPE, dtype=np.uint8), 1)
+    return dem_tif, ref_tif
+
+
+def make_config(out_dir: Path, poly_file: Path, grid, multiband: bool, incremental: bool) -> Config:
+    dem_tif, ref_tif = grid
+    io = IOConfig(
+        poly_file=poly_file,
+        ref_raster=ref_tif,
+        bld_bin_tif=out_dir / "houses.tif",
+        dem_tif=dem_tif,
+        slope_deg_tif=out_dir / "slope.tif",
+        slope_bin_tif=out_dir / "slope_bin.tif",
+        bld_risk_tif=out_dir / "risk.tif",
+        bld_risk_tif_template=str(out_dir / "risk_{risk_radius_m}m.tif"),
+        bld_risk_multiband=multiband,
+    )
+    params = Params(slope_threshold=30.0, risk_radius_m=5.0, risk_radii_m=[5.0, 12.5])
+    options = RunOptions(persist_intermediates=True, incremental=incremental)
+    return Config(io=io, params=params, options=options)
+
+
+def read_outputs(config: Config) -> list[np.ndarray]:
+    paths = highrisk_output_paths(config.io, config.params.risk_radii_m) + [config.io.bld_bin_tif]
+    arrays = []
+    for path in paths:
+        with rasterio.open(path) as src:
+            arrays.append(src.read())
+    return arrays
+
+
+@pytest.mark.parametrize("multiband", [False, True], ids=["per_radius", "multiband"])
+def test_patched_outputs_match_full_recompute(tmp_path, grid, multiband):
+    poly = write_buildings(tmp_path / "buildings.gpkg", BUILDINGS)
+
+    # 1回目: 前回の状態がないので全体を計算し、建物の状態を保存する
+    inc = make_config(tmp_path / "inc", poly, grid, multiband, incremental=True)
+    run_pipeline(inc)
+    before = read_outputs(inc)
+
+    # 建物を変更・追加・削除して差分更新
+    write_buildings(poly, EDITED)
+    run_pipeline(inc)
+    patched = read_outputs(inc)
+
+    full = make_config(tmp_path / "full", write_buildings(tmp_path / "edited.gpkg", EDITED), grid, multiband, False)
+    run_pipeline(full)
+    expected = read_outputs(full)
+
+    # 変更の前後でリスクが実際に変わっていること（何も書き換えなくても通るテストにしない）
+    assert any(not np.array_equal(a, b) for a, b in zip(before, expected))
+    for got, want in zip(patched, expected):
+        np.testing.assert_array_equal(got, want)
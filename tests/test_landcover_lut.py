@@ -0,0 +1,35 @@
+"""
+土地被覆の係数テーブル（landcover_lut）の NoData・型の扱い
+"""
+
+import numpy as np
+import pytest
+
+from DEM_to_slope_risk_PL import landcover_lut
+
+
+def test_codes_nodata_and_codes_beyond_the_table():
+    lut = landcover_lut({1: 0.5, 3: 2.0}, 1.0, 255, np.uint8)
+    codes = np.array([0, 1, 3, 255, 254])
+    np.testing.assert_array_equal(np.take(lut, codes, mode="clip"), [1.0, 0.5, 2.0, 0.0, 1.0])
+    # テーブルより大きいコードは default_weight
+    assert np.take(lut, [1000], mode="clip")[0] == 1.0
+
+
+def test_float_nodata_with_integer_value_is_accepted():
+    lut = landcover_lut({1: 0.5}, 1.0, 0.0, np.int16)
+    assert lut[0] == 0.0 and lut[1] == 0.5
+
+
+@pytest.mark.parametrize(
+    "nodata, dtype",
+    [
+        (None, np.float32),      # 浮動小数のラスタ
+        (np.nan, np.uint8),      # NaN の NoData
+        (2.5, np.uint8),         # 整数でない NoData
+        (-9999, np.int16),       # 負の NoData（クリップで 0 番の係数になってしまう）
+    ],
+)
+def test_rejects_rasters_that_cannot_index_the_table(nodata, dtype):
+    with pytest.raises(ValueError):
+        landcover_lut({1: 0.5}, 1.0, nodata, dtype)
@@ -0,0 +1,23 @@
+"""
+複数半径の出力先・バンド名の表記（小数の半径が整数に丸められて重ならないこと）
+"""
+
+from pathlib import Path
+
+import pytest
+
+from DEM_to_slope_risk_PL import Params, radius_output_paths
+
+
+def test_fractional_radii_get_distinct_paths():
+    paths = radius_output_paths("out/risk_{risk_radius_m}m.tif", [10.0, 12.5, 12.9], multiband=False)
+    assert paths == [Path("out/risk_10m.tif"), Path("out/risk_12.5m.tif"), Path("out/risk_12.9m.tif")]
+    assert radius_output_paths("out/risk_{risk_radius_m}m.tif", [10, 12.5], multiband=True) == [
+        Path("out/risk_10-12.5m.tif")
+    ]
+
+
+def test_params_rejects_radii_with_the_same_label():
+    with pytest.raises(ValueError, match="risk_radii_m"):
+        Params(slope_threshold=30.0, risk_radius_m=10.0, risk_radii_m=[10.0, 10])
+    assert Params(slope_threshold=30.0, risk_radius_m=10.0, risk_radii_m=[12.5, 12.9]).risk_radii_m == [12.5, 12.9]
@@ -0,0 +1,66 @@
+"""
+Step2 の傾斜角: ブロック処理と一括処理の一致、float32 版と float64 版の差（NoData の穴・ブロック境界を含む合成 DEM）
+"""
+
+import numpy as np
+import pytest
+import rasterio
+
+from DEM_to_slope_risk_PL import _compute_slope_blocked, _horn_slope_deg, _horn_slope_deg_f32, compute_slope_array
+
+NODATA = -9999.0
+
+# float32 版の許容誤差（度）。標高 1000 m 付近の float32 の刻みは約 6e-5 m で、
+# 8近傍の差分から勾配を作ると 1 m 格子でも傾斜角の差は 1e-3 度に収まる
+F32_ATOL_DEG = 1e-3
+
+
+def synthetic_dem(shape=(70, 85)) -> np.ndarray:
+    """標高 200〜1000 m 程度のなだらかな起伏に凹凸を足し、NoData の穴をあけた DEM"""
+
+    rng = np.random.default_rng(5)
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    dem = 600.0 + 300.0 * np.sin(rows / 9.0) * np.cos(cols / 13.0) + rng.random(shape) * 5.0
+    dem[rng.random(shape) < 0.02] = NODATA
+    dem[30:36, 40:52] = NODATA   # ブロック境界（32）をまたぐ穴
+    dem[:, -1] = NODATA
+    return dem
+
+
+@pytest.fixture
+def dem_tif(tmp_path):
+    dem = synthetic_dem()
+    path = tmp_path / "dem.tif"
+    profile = dict(
+        driver="GTiff", height=dem.shape[0], width=dem.shape[1], count=1, dtype="float64",
+        nodata=NODATA, crs="EPSG:6670", transform=rasterio.Affine(5.0, 0, 0, 0, -5.0, 0),
+    )
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(dem, 1)
+    return path
+
+
+@pytest.mark.parametrize("slope_dtype", ["float64", "float32"])
+def test_blocked_slope_matches_whole_raster(dem_tif, tmp_path, slope_dtype):
+    whole, _ = compute_slope_array(dem_tif, slope_dtype)
+
+    out = _compute_slope_blocked(dem_tif, tmp_path / "slope.tif", 32, slope_dtype=slope_dtype)
+    with rasterio.open(out) as src:
+        blocked = src.read(1)
+
+    assert (whole == NODATA).any()
+    np.testing.assert_array_equal(blocked, whole)
+
+
+@pytest.mark.parametrize("cell_size", [5.0, 1.0])
+def test_float32_horn_slope_matches_float64(cell_size):
+    dem = synthetic_dem()
+    dem[dem == NODATA] = np.nan
+
+    ref = _horn_slope_deg(dem, cell_size, cell_size)
+    got = _horn_slope_deg_f32(dem.astype(np.float32), cell_size, cell_size)
+
+    assert got.dtype == np.float32
+    # NoData（NaN）になる画素は同じ
+    np.testing.assert_array_equal(np.isnan(got), np.isnan(ref))
+    np.testing.assert_allclose(got, ref, rtol=0, atol=F32_ATOL_DEG)
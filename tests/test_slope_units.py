@@ -0,0 +1,52 @@
+"""
+slope_units の半流域（左岸・右岸）の判定
+"""
+
+import numpy as np
+import pytest
+
+import flow
+from slope_units import watershed_units
+
+
+def straight_channel(flow_east: bool, shape=(21, 40)) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """中央の行を流路とする、まっすぐな谷の DEM（flow_east なら東へ、そうでなければ西へ流れる）"""
+
+    nrows, ncols = shape
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    mid = nrows // 2
+    along = (ncols - 1 - cols) if flow_east else cols
+    dem = (np.abs(rows - mid) * 1.0 + along * 0.01).astype(np.float32)
+
+    valid = np.ones(shape, dtype=bool)
+    recv = flow.flow_receivers(flow.d8_flow_direction(dem, ~valid), ~valid)
+    streams = np.zeros(shape, dtype=np.uint8)
+    streams[mid, :] = 1
+    return recv, streams, valid
+
+
+@pytest.mark.parametrize("flow_east", [True, False])
+def test_bank_sides_of_straight_channel(flow_east):
+    recv, streams, valid = straight_channel(flow_east)
+    labels, attrs = watershed_units(recv, streams, valid, split_banks=True)
+    mid = labels.shape[0] // 2
+
+    # 外周のセルは D8 の流出口（それぞれ別ユニット）なので、内側だけを見る
+    def bank_of(rows) -> set[int]:
+        return {int(attrs["bank"][lab - 1]) for lab in np.unique(labels[rows, 1:-1])}
+
+    north, south = bank_of(slice(1, mid)), bank_of(slice(mid + 1, -1))
+    # 下流を向いて左が左岸（0）。東へ流れるなら北が左岸、西へ流れるなら南が左岸
+    assert north == ({0} if flow_east else {1})
+    assert south == ({1} if flow_east else {0})
+
+
+def test_without_bank_split_each_segment_is_one_unit():
+    recv, streams, valid = straight_channel(True)
+    labels, attrs = watershed_units(recv, streams, valid, split_banks=False)
+    assert np.all(labels > 0)
+    assert np.all(attrs["bank"] == -1)
+
+    inner = np.unique(labels[1:-1, 1:-1])
+    assert inner.size == 1
+    assert attrs["segment_id"][inner[0] - 1] >= 0
@@ -0,0 +1,31 @@
+"""
+StepCache の manifest を複数のプロセスから同時に更新しても、登録が失われないことの確認
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+
+import numpy as np
+
+from step_cache import MANIFEST_NAME, StepCache
+
+
+def _fill(cache_dir: str, worker: int, n_keys: int) -> None:
+    cache = StepCache(cache_dir, max_bytes=1 << 30)
+    for i in range(n_keys):
+        key = cache.key("step", worker, i)
+        cache.get_or_compute(key, lambda: np.full(16, worker * 1000 + i))
+
+
+def test_concurrent_registrations_are_all_kept(tmp_path):
+    workers, n_keys = 4, 25
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_fill, [str(tmp_path)] * workers, range(workers), [n_keys] * workers))
+
+    entries = json.loads((tmp_path / MANIFEST_NAME).read_text(encoding="utf-8"))["entries"]
+    assert len(entries) == workers * n_keys
+    assert not list(tmp_path.glob("*.tmp"))
+
+    cache = StepCache(tmp_path, max_bytes=1 << 30)
+    key = cache.key("step", 2, 7)
+    np.testing.assert_array_equal(cache.get_or_compute(key, lambda: None), np.full(16, 2007))